@@ -0,0 +1,321 @@
+import io
+import json
+import os
+import time
+from cache import normalize_messages, sampling_params
+
+_ROLES = { "human": "user", "ai": "assistant", "system": "system" }
+
+
+def to_api_messages(prompt):
+    return [{ "role": _ROLES[role], "content": content } for role, content in normalize_messages(prompt)]
+
+
+class OpenAIBatchBackend:
+    """
+    OpenAI Batch API: requests are uploaded as a JSONL file and answered within the completion window.
+    """
+    def __init__(self, api_key, model_name, params=None, base_url=None):
+        import openai
+
+        self.client = openai.OpenAI(api_key=api_key or "EMPTY", base_url=base_url)
+        self.model_name = model_name
+        self.params = { k: v for k, v in (params or {}).items() if k in ["temperature", "max_tokens", "top_p"] and v is not None }
+
+    def submit(self, requests):
+        lines = [
+            json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": { "model": self.model_name, "messages": to_api_messages(prompt), **self.params },
+            }, ensure_ascii=False)
+            for custom_id, prompt in requests
+        ]
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", io.BytesIO(("\n".join(lines) + "\n").encode("utf8"))),
+            purpose="batch"
+        )
+        job = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return job.id
+
+    def status(self, job_id):
+        job = self.client.batches.retrieve(job_id)
+        if job.status in ["completed", "failed", "expired", "cancelled"]:
+            return "ended"
+        return "in_progress"
+
+    def results(self, job_id):
+        job = self.client.batches.retrieve(job_id)
+        results = {}
+        if job.output_file_id is None:
+            return results
+
+        for line in self.client.files.content(job.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if item.get("error") is None and response.get("status_code") == 200:
+                results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return results
+
+
+class AnthropicBatchBackend:
+    """
+    Anthropic Message Batches API.
+    """
+    def __init__(self, api_key, model_name, params=None, base_url=None):
+        import anthropic
+
+        self.client = anthropic.Anthropic(api_key=api_key, base_url=base_url)
+        self.model_name = model_name
+        params = { k: v for k, v in (params or {}).items() if v is not None }
+        self.params = { "max_tokens": 4096, **params }
+
+    def submit(self, requests):
+        job = self.client.messages.batches.create(requests=[
+            {
+                "custom_id": custom_id,
+                "params": { "model": self.model_name, "messages": to_api_messages(prompt), **self.params },
+            }
+            for custom_id, prompt in requests
+        ])
+        return job.id
+
+    def status(self, job_id):
+        job = self.client.messages.batches.retrieve(job_id)
+        return "ended" if job.processing_status == "ended" else "in_progress"
+
+    def results(self, job_id):
+        results = {}
+        for item in self.client.messages.batches.results(job_id):
+            if item.result.type == "succeeded":
+                results[item.custom_id] = "".join(
+                    block.text for block in item.result.message.content if block.type == "text"
+                )
+        return results
+
+
+class BatchJobLog:
+    """
+    Persisted list of submitted batch jobs and the requests in each, so a restarted run polls
+    the jobs it already paid for instead of submitting them again. It also counts the submissions of
+    every custom id, so a request that keeps failing isn't resubmitted forever.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jobs = []
+        self.attempts = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as reader:
+                log = json.load(reader)
+            # Logs written before attempts were counted are a plain list of jobs.
+            if isinstance(log, list):
+                self.jobs = log
+            else:
+                self.jobs, self.attempts = log["jobs"], log["attempts"]
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as writer:
+            json.dump({ "jobs": self.jobs, "attempts": self.attempts }, writer, indent="\t", ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def add(self, job_id, custom_ids):
+        self.jobs.append({ "job_id": job_id, "custom_ids": custom_ids, "submitted_at": time.time() })
+        for custom_id in custom_ids:
+            self.attempts[custom_id] = self.attempts.get(custom_id, 0) + 1
+        self.save()
+
+    def remove(self, job_id):
+        self.jobs = [job for job in self.jobs if job["job_id"] != job_id]
+        self.save()
+
+    def in_flight(self):
+        return { custom_id for job in self.jobs for custom_id in job["custom_ids"] }
+
+
+class BatchRewriter:
+    """
+    Drive rewrite.py through a provider batch API.
+
+    Every round reconciles finished jobs into the checkpoint store, then submits what can run next:
+    one rewrite request per user instruction of rows without a record, and the next response turn of every
+    conversation that has its instructions. Multi-turn conversations therefore advance one turn per batch,
+    with finished turns kept in `partial_responses` until the last one arrives.
+
+    Custom ids are `rewrite-{id}-{i}` and `response-{id}-{turn}`. A row whose rewrites didn't all succeed
+    is resubmitted as a whole. After `max_attempts` submissions of a request, its row is stored with a
+    `failed` entry instead (and no responses), which later rounds and runs skip.
+    """
+    def __init__(self, backend, store, job_log, dataset, rewrite_func, max_requests_per_job=10000, poll_interval=60,
+                 max_attempts=3):
+        self.backend = backend
+        self.store = store
+        self.job_log = job_log
+        self.dataset = dataset
+        self.rewrite_func = rewrite_func
+        self.max_requests_per_job = max_requests_per_job
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def user_instructions(row):
+        return [msg["content"] for msg in row["messages"] if msg["from"] == "user"]
+
+    def reconcile(self):
+        records = { data["id"]: data for data in self.store.load() }
+
+        for job in list(self.job_log.jobs):
+            if self.backend.status(job["job_id"]) != "ended":
+                continue
+
+            results = self.backend.results(job["job_id"])
+            rewrites = {}
+            for custom_id in job["custom_ids"]:
+                phase, idx, position = custom_id.rsplit("-", 2)
+                idx, position = int(idx), int(position)
+                text = results.get(custom_id)
+
+                if phase == "rewrite":
+                    rewrites.setdefault(idx, {})[position] = text
+                elif text is not None:
+                    self._apply_response(records, idx, position, text)
+
+            for idx, texts in rewrites.items():
+                if idx in records or any(text is None for text in texts.values()):
+                    continue
+                records[idx] = {
+                    "id": idx,
+                    "original_conversation": self.dataset[idx]["messages"],
+                    "instructions": [texts[i] for i in range(len(texts))]
+                }
+                self.store.append(records[idx])
+
+            self.store.sync()
+            self.job_log.remove(job["job_id"])
+
+        return records
+
+    def _apply_response(self, records, idx, turn, text):
+        data = records.get(idx)
+        if data is None or "responses" in data:
+            return
+
+        partial = data.setdefault("partial_responses", [])
+        if len(partial) != turn:
+            return
+
+        partial.append(text)
+        if len(partial) == len(data["instructions"]):
+            data["responses"] = data.pop("partial_responses")
+        self.store.append(data)
+
+    def _fail(self, records, idx, custom_id):
+        data = records.setdefault(idx, { "id": idx, "original_conversation": self.dataset[idx]["messages"] })
+        data["failed"] = { "custom_id": custom_id, "attempts": self.job_log.attempts[custom_id] }
+        self.store.append(data)
+
+    def pending_requests(self, records, ids):
+        in_flight = self.job_log.in_flight()
+        requests = []
+
+        for idx in ids:
+            data = records.get(idx)
+            if data is not None and "failed" in data:
+                continue
+            if data is None:
+                instructions = self.user_instructions(self.dataset[idx])
+                if not len(instructions):
+                    records[idx] = { "id": idx, "original_conversation": self.dataset[idx]["messages"], "instructions": [] }
+                    self.store.append(records[idx])
+                    data = records[idx]
+                else:
+                    group = [
+                        (f"rewrite-{idx}-{i}", self.rewrite_func(instruction))
+                        for i, instruction in enumerate(instructions)
+                    ]
+                    custom_id = group[0][0]
+                    if custom_id in in_flight:
+                        continue
+                    if self.job_log.attempts.get(custom_id, 0) >= self.max_attempts:
+                        self._fail(records, idx, custom_id)
+                    else:
+                        requests.append(group)
+                    continue
+
+            if "responses" in data:
+                continue
+
+            partial = data.get("partial_responses", [])
+            turn = len(partial)
+            if turn == len(data["instructions"]):
+                data["responses"] = data.pop("partial_responses", [])
+                self.store.append(data)
+                continue
+
+            custom_id = f"response-{idx}-{turn}"
+            if custom_id in in_flight:
+                continue
+            if self.job_log.attempts.get(custom_id, 0) >= self.max_attempts:
+                self._fail(records, idx, custom_id)
+                continue
+
+            prompt = []
+            for instruction, response in zip(data["instructions"], partial):
+                prompt += [("human", instruction), ("ai", response)]
+            prompt.append(("human", data["instructions"][turn]))
+            requests.append([(custom_id, prompt)])
+
+        return requests
+
+    def submit(self, groups):
+        job, n_submitted = [], 0
+        for group in groups + [None]:
+            if job and (group is None or len(job) + len(group) > self.max_requests_per_job):
+                job_id = self.backend.submit(job)
+                self.job_log.add(job_id, [custom_id for custom_id, _ in job])
+                n_submitted += len(job)
+                job = []
+            if group is not None:
+                job += group
+        return n_submitted
+
+    def run(self, ids):
+        while True:
+            records = self.reconcile()
+            n_submitted = self.submit(self.pending_requests(records, ids))
+            self.store.sync()
+
+            n_done = sum(1 for idx in ids if "responses" in records.get(idx, {}))
+            n_failed = sum(1 for idx in ids if "failed" in records.get(idx, {}))
+            print(f"[batch] {n_done}/{len(ids)} done, {n_failed} failed after {self.max_attempts} attempts, "
+                  f"{n_submitted} requests submitted, {len(self.job_log.jobs)} jobs in flight")
+
+            if not self.job_log.jobs:
+                break
+            time.sleep(self.poll_interval)
+
+
+def add_batch_args(parser):
+    parser.add_argument("--batch", action="store_true",
+                        help="Use the provider batch API instead of synchronous calls")
+    parser.add_argument("--batch_base_url", type=str, default=None,
+                        help="Base URL of the batch API, e.g. a local stub server")
+    parser.add_argument("--batch_max_requests", type=int, default=10000,
+                        help="Maximum number of requests in one batch job")
+    parser.add_argument("--batch_poll_interval", type=float, default=60)
+    parser.add_argument("--batch_max_attempts", type=int, default=3,
+                        help="Submissions of a request before its row is stored as failed")
+
+
+def batch_backend_from_args(args, api_key, agent):
+    params = sampling_params(agent)
+    if args.llm == "claude":
+        return AnthropicBatchBackend(api_key, args.model_name, params=params, base_url=args.batch_base_url)
+    return OpenAIBatchBackend(api_key, args.model_name, params=params, base_url=args.batch_base_url)
@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_stage(name, cmd, log_path):
+    """
+    Run one pipeline stage as a subprocess and measure its wall time, CPU time and peak memory.
+    """
+    with open(log_path, "a", encoding="utf8") as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=ROOT, stdout=log, stderr=log)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        raise RuntimeError(f"Stage {name} failed with exit code {exit_code}, see {log_path}")
+
+    return {
+        "stage": name,
+        "seconds": elapsed,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        "max_rss_mb": rusage.ru_maxrss / 1024,
+    }
+
+
+def count_records(path):
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf8") as reader:
+            return sum(1 for _ in reader)
+    with open(path, "r", encoding="utf8") as reader:
+        return len(json.load(reader))
+
+
+def make_sharegpt_dataset(examples_path, dataset_dir, n_rows, seed):
+    """
+    Build a local ShareGPT-style dataset from the seed instructions, loadable with `load_dataset(dataset_dir)`.
+    """
+    with open(examples_path, "r", encoding="utf8") as reader:
+        instructions = [e["instruction"] for e in json.load(reader)]
+
+    rng = random.Random(seed)
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, "train.jsonl"), "w", encoding="utf8") as writer:
+        for _ in range(n_rows):
+            messages = []
+            for _ in range(rng.randint(1, 3)):
+                messages.append({ "from": "user", "content": rng.choice(instructions) })
+                messages.append({ "from": "assistant", "content": rng.choice(instructions) })
+            writer.write(json.dumps({ "messages": messages }, ensure_ascii=False) + "\n")
+
+
+def fake_llm_cli(args):
+    return [
+        "--llm", "fake",
+        "--model_name", "fake",
+        "--fake_latency", str(args.latency),
+        "--fake_latency_dist", args.latency_dist,
+        "--fake_error_rate", str(args.error_rate),
+        "--fake_response_length", str(args.response_length),
+        "--fake_seed", str(args.seed),
+    ]
+
+
+def benchmark(args, work_dir):
+    log_path = os.path.join(work_dir, "benchmark.log")
+    results = []
+
+    syn_path = os.path.join(work_dir, "syn.json")
+    result = run_stage("gen_data", [
+        sys.executable, "gen_data.py",
+        "--begin_examples_path", args.begin_examples_path,
+        "--saved_path", syn_path,
+        "--n_data", str(args.n_data),
+        "--n_examples", str(args.n_examples),
+        "--concurrency", str(args.concurrency),
+        "--add_to_pool",
+    ] + fake_llm_cli(args), log_path)
+    result["records"] = count_records(syn_path)
+    results.append(result)
+
+    syn_output_path = os.path.join(work_dir, "syn.jsonl")
+    result = run_stage("format_syn", [
+        sys.executable, "format.py",
+        "--task", "syn",
+        "--src_path", syn_path,
+        "--output_path", syn_output_path,
+    ], log_path)
+    result["records"] = count_records(syn_output_path)
+    results.append(result)
+
+    dataset_dir = os.path.join(work_dir, "sharegpt")
+    make_sharegpt_dataset(args.begin_examples_path, dataset_dir, args.n_rows, args.seed)
+
+    evol_path = os.path.join(work_dir, "evol.json")
+    result = run_stage("rewrite", [
+        sys.executable, "rewrite.py",
+        "--dataset", dataset_dir,
+        "--saved_path", evol_path,
+        "--concurrency", str(args.concurrency),
+    ] + fake_llm_cli(args), log_path)
+    result["records"] = count_records(evol_path)
+    results.append(result)
+
+    evol_output_path = os.path.join(work_dir, "evol.jsonl")
+    result = run_stage("format_evol", [
+        sys.executable, "format.py",
+        "--task", "evol",
+        "--src_path", evol_path,
+        "--output_path", evol_output_path,
+    ], log_path)
+    result["records"] = count_records(evol_output_path)
+    results.append(result)
+
+    for result in results:
+        result["conversations_per_second"] = result["records"] / result["seconds"] if result["seconds"] else 0.0
+    return results
+
+
+def print_report(results):
+    print(f"{'stage':<12}{'records':>10}{'seconds':>10}{'conv/s':>10}{'cpu s':>10}{'rss MB':>10}")
+    for r in results:
+        print(f"{r['stage']:<12}{r['records']:>10}{r['seconds']:>10.2f}{r['conversations_per_second']:>10.2f}"
+              f"{r['cpu_seconds']:>10.2f}{r['max_rss_mb']:>10.1f}")
+
+
+def main(args):
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = benchmark(args, work_dir)
+    else:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = benchmark(args, args.work_dir)
+
+    print_report(results)
+
+    if args.report_path is not None:
+        with open(args.report_path, "w", encoding="utf8") as writer:
+            json.dump({ "args": vars(args), "stages": results }, writer, indent="\t", ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="End-to-end throughput benchmark of gen_data.py, rewrite.py and format.py against the fake LLM"
+    )
+    parser.add_argument("--begin_examples_path", type=str, default=os.path.join(ROOT, "data", "begin_examples.json"))
+    parser.add_argument("--n_data", type=int, default=200,
+                        help="Number of conversations generated by gen_data.py")
+    parser.add_argument("--n_rows", type=int, default=200,
+                        help="Number of ShareGPT rows rewritten by rewrite.py")
+    parser.add_argument("--n_examples", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mean fake LLM latency in seconds. Keep it at 0 to measure pipeline overhead only")
+    parser.add_argument("--latency_dist", choices=["constant", "exponential", "lognormal"], default="constant")
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--response_length", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Keep the intermediate files here instead of a temporary directory")
+    parser.add_argument("--report_path", type=str, default=None,
+                        help="Write the results as JSON")
+
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+from contextlib import contextmanager
+from langchain_core.messages import AIMessage, BaseMessage
+
+SAMPLING_PARAMS = ["temperature", "max_tokens", "top_p", "top_k"]
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+def normalize_messages(prompt):
+    """
+    Turn a prompt (a string or a list of messages) into a list of (role, content) pairs
+    so equivalent requests produce the same cache key.
+    """
+    if isinstance(prompt, str):
+        prompt = [("human", prompt)]
+
+    messages = []
+    for message in prompt:
+        if isinstance(message, BaseMessage):
+            role, content = message.type, message.content
+        else:
+            role, content = message
+        if isinstance(content, str):
+            content = unicodedata.normalize("NFC", content.replace("\r\n", "\n"))
+        messages.append([role, content])
+    return messages
+
+
+def content_text(content):
+    if isinstance(content, str):
+        return content
+    return "".join(block if isinstance(block, str) else block.get("text", "") for block in content)
+
+
+def sampling_params(agent):
+    return { name: getattr(agent, name, None) for name in SAMPLING_PARAMS }
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of chat model responses, keyed by provider, model, the normalized
+    messages and the sampling parameters.
+
+    mode:
+        "readwrite": look up, and store responses of misses
+        "readonly":  look up, never store
+        "replay":    look up, raise CacheMiss on misses so a run is fully deterministic
+    """
+    def __init__(self, path, mode="readwrite", max_entries=None, max_bytes=None):
+        if not mode in ["readwrite", "readonly", "replay"]:
+            raise ValueError(
+                f"The cache mode {mode} doesn't exist"
+            )
+
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+        # The entry count and byte size, kept in one row so that eviction doesn't scan the table on every write.
+        # Every process sharing the cache updates it in the transaction of its writes.
+        with self._write():
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS totals ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), n_entries INTEGER NOT NULL, n_bytes INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO totals SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            )
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the totals read in the transaction stay exact.
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _add_totals(self, n_entries, n_bytes):
+        self.conn.execute(
+            "UPDATE totals SET n_entries = n_entries + ?, n_bytes = n_bytes + ? WHERE id = 0", (n_entries, n_bytes)
+        )
+
+    @staticmethod
+    def make_key(provider, model_name, prompt, params):
+        payload = json.dumps({
+            "provider": provider,
+            "model": model_name,
+            "messages": normalize_messages(prompt),
+            "params": params,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMiss(key)
+            return None
+
+        self.hits += 1
+        if self.mode == "readwrite":
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        value = json.loads(row[0])
+        return AIMessage(content=value["content"], response_metadata=value.get("response_metadata", {}))
+
+    def put(self, key, message):
+        if self.mode != "readwrite":
+            return
+
+        value = json.dumps({
+            "content": message.content,
+            "response_metadata": message.response_metadata,
+        }, ensure_ascii=False, default=str)
+        size = len(value.encode("utf8"))
+        with self._write():
+            # An overwritten entry only changes the byte count by the difference in size.
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            if old is None:
+                self._add_totals(1, size)
+            else:
+                self._add_totals(0, size - old[0])
+            self._evict()
+
+    def _evict(self):
+        # Least recently used entries go first.
+        while True:
+            n_entries, n_bytes = self.conn.execute("SELECT n_entries, n_bytes FROM totals WHERE id = 0").fetchone()
+            if (self.max_entries is None or n_entries <= self.max_entries) and \
+               (self.max_bytes is None or n_bytes <= self.max_bytes):
+                break
+            row = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            self._add_totals(-1, -row[1])
+            self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def add_cache_args(parser):
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="SQLite file caching LLM responses. Caching is disabled when not given")
+    parser.add_argument("--cache_mode", choices=["readwrite", "readonly", "replay"], default="readwrite")
+    parser.add_argument("--cache_max_entries", type=int, default=None)
+    parser.add_argument("--cache_max_mb", type=float, default=None)
+
+
+def cache_from_args(args):
+    if args.cache_path is None:
+        return None
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.cache_path)), exist_ok=True)
+    return ResponseCache(
+        path=args.cache_path,
+        mode=args.cache_mode,
+        max_entries=args.cache_max_entries,
+        max_bytes=None if args.cache_max_mb is None else int(args.cache_max_mb * 1024 * 1024),
+    )
@@ -0,0 +1,228 @@
+import json
+import os
+
+
+def default_checkpoint_path(saved_path):
+    return os.path.splitext(saved_path)[0] + ".ckpt.jsonl"
+
+
+def write_json_list(all_data, output_path):
+    """
+    Atomically write records as a single JSON list, the layout format.py reads. `all_data` may be any
+    iterable, records are written one at a time as `json.dump(list(all_data), indent="\t")` would.
+    """
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as writer:
+        writer.write("[")
+        empty = True
+        for data in all_data:
+            writer.write("\n" if empty else ",\n")
+            writer.write("\n".join("\t" + line for line in json.dumps(data, indent="\t", ensure_ascii=False).split("\n")))
+            empty = False
+        writer.write("]" if empty else "\n]")
+    os.replace(tmp_path, output_path)
+
+
+class IdBitmap:
+    """
+    A set of non-negative integer ids stored as a bitmap, one bit per id.
+    """
+    def __init__(self, size=0):
+        self._bits = bytearray((size + 7) // 8)
+        self._count = 0
+
+    def add(self, idx):
+        byte, bit = divmod(idx, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(byte - len(self._bits) + 1))
+        if not self._bits[byte] >> bit & 1:
+            self._bits[byte] |= 1 << bit
+            self._count += 1
+
+    def __contains__(self, idx):
+        byte, bit = divmod(idx, 8)
+        return byte < len(self._bits) and bool(self._bits[byte] >> bit & 1)
+
+    def __len__(self):
+        return self._count
+
+
+class CheckpointStore:
+    """
+    Append-only JSONL checkpoint. Each record is written as one line and flushed right away, so a crash
+    loses at most the record being written. fsync is batched every `fsync_every` records.
+
+    When `key` is given, a later record with the same key replaces the earlier one on load.
+    """
+    def __init__(self, path, key=None, fsync_every=16):
+        self.path = path
+        self.key = key
+        self.fsync_every = fsync_every
+        self._writer = None
+        self._reader = None
+        self._size = 0
+        self._unsynced = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def iter_records(self, repair=True, offsets=False):
+        """
+        Stream the raw records in the order they were appended, as (byte offset, record) pairs with `offsets`.
+        A truncated last line is skipped, and removed from the file unless `repair` is False (for logs another
+        process is still writing).
+        """
+        if not self.exists():
+            return
+
+        if repair:
+            self._repair()
+
+        with open(self.path, "rb") as reader:
+            offset = 0
+            for line in reader:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                yield (offset, record) if offsets else record
+                offset += len(line)
+
+    def read(self, offset):
+        """
+        The record appended at byte `offset`.
+        """
+        if self._reader is None:
+            self._reader = open(self.path, "rb")
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline())
+
+    def load(self):
+        """
+        Rebuild the state by streaming the log. Keyed records keep the position of their first occurrence.
+        """
+        if not self.exists():
+            return []
+
+        if self.key is None:
+            return list(self.iter_records())
+
+        records = {}
+        for record in self.iter_records():
+            records[self.key(record)] = record
+        return list(records.values())
+
+    def done_ids(self, size=0, predicate=None):
+        """
+        Ids of the keyed records in the log (optionally only those matching `predicate`), in one streaming pass.
+        """
+        done = IdBitmap(size)
+        for record in self.iter_records():
+            if predicate is None or predicate(record):
+                done.add(self.key(record))
+        return done
+
+    def _repair(self):
+        # Drop a partially written last line so that the next append starts on a fresh line.
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+
+            f.seek(0)
+            good = 0
+            for line in f:
+                if line.endswith(b"\n"):
+                    good += len(line)
+            f.truncate(good)
+
+    def append(self, record):
+        """
+        Append `record` and return its byte offset, for `read`.
+        """
+        if self._writer is None:
+            self._writer = open(self.path, "ab")
+            self._size = self._writer.seek(0, os.SEEK_END)
+
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf8")
+        self._writer.write(line)
+        self._writer.flush()
+        offset = self._size
+        self._size += len(line)
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+        return offset
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def sync(self):
+        if self._writer is None:
+            return
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._writer is None:
+            return
+        self.sync()
+        self._writer.close()
+        self._writer = None
+
+    def rewrite(self, records):
+        """
+        Atomically replace the log with `records`, e.g. the live records of a keyed log. The file is removed
+        when there are none.
+        """
+        self.close()
+        records = list(records)
+        if not records:
+            if self.exists():
+                os.remove(self.path)
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as writer:
+            for record in records:
+                writer.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf8"))
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.replace(tmp_path, self.path)
+
+    def import_json(self, json_path):
+        """
+        Seed an empty log from a JSON file written by an older run.
+        """
+        if self.exists() or not os.path.exists(json_path):
+            return
+
+        with open(json_path, "r", encoding="utf8") as reader:
+            all_data = json.load(reader)
+
+        self.extend(all_data)
+        self.sync()
+
+    def compact(self, output_path, sort_key=None):
+        """
+        Write the current state as a single JSON list, the layout format.py reads. An unkeyed log is
+        streamed in append order, so compaction doesn't load it into memory.
+        """
+        if self.key is None and sort_key is None:
+            write_json_list(self.iter_records(), output_path)
+            return
+
+        all_data = self.load()
+        if sort_key is not None:
+            all_data = sorted(all_data, key=sort_key)
+
+        write_json_list(all_data, output_path)
@@ -0,0 +1,189 @@
+import contextvars
+from contextlib import contextmanager
+from functools import lru_cache
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from metrics import input_token_breakdown, token_usage
+
+_encoding = None
+_current_usage = contextvars.ContextVar("conversation_usage", default=None)
+
+CACHE_CONTROL = { "type": "ephemeral" }
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text):
+    """
+    Local token count with tiktoken's cl100k_base, or one token per character when tiktoken or its
+    encoding file isn't available.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return len(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def turn_tokens(turn):
+    return count_tokens(turn.get("instruction", "")) + count_tokens(turn.get("output", ""))
+
+
+def cache_block(text):
+    return [{ "type": "text", "text": text, "cache_control": CACHE_CONTROL }]
+
+
+class ContextWindow:
+    """
+    Keeps multi-turn prompts within `max_tokens` by dropping the oldest turns after the first `keep_first`
+    ones (which set the topic). An optional `summarizer(dropped_turns) -> str` replaces them with a summary.
+
+    With `cache_prefix`, the stable part of the prompt (earlier turns) is marked as a prompt caching
+    breakpoint for providers that need explicit markers (Anthropic). It is only marked when at least
+    `min_cache_tokens` long, below which providers don't cache.
+    """
+    def __init__(self, max_tokens=None, keep_first=1, summarizer=None, cache_prefix=False, min_cache_tokens=1024):
+        self.max_tokens = max_tokens
+        self.keep_first = keep_first
+        self.summarizer = summarizer
+        self.cache_prefix = cache_prefix
+        self.min_cache_tokens = min_cache_tokens
+
+    def fit(self, dialogue):
+        """
+        Returns the turns to keep and the turns dropped from the middle of `dialogue`.
+        """
+        if self.max_tokens is None:
+            return dialogue, []
+
+        costs = [turn_tokens(turn) for turn in dialogue]
+        if sum(costs) <= self.max_tokens:
+            return dialogue, []
+
+        head = min(self.keep_first, len(dialogue) - 1)
+        budget = self.max_tokens - sum(costs[:head])
+        start = len(dialogue) - 1
+        budget -= costs[start]
+        while start - 1 >= head and costs[start - 1] <= budget:
+            start -= 1
+            budget -= costs[start]
+
+        dropped = dialogue[head:start]
+        usage = current_usage()
+        if usage is not None:
+            usage.trimmed_turns += len(dropped)
+        return dialogue[:head] + dialogue[start:], dropped
+
+    def to_messages(self, dialogue, provider=None):
+        """
+        Chat messages for `dialogue` (a list of {"instruction", "output"} turns) within the token budget.
+        """
+        kept, dropped = self.fit(dialogue)
+
+        messages = []
+        if len(dropped) and self.summarizer is not None:
+            messages.append(SystemMessage(content=self.summarizer(dropped)))
+        for turn in kept:
+            if "instruction" in turn:
+                messages.append(HumanMessage(content=turn["instruction"]))
+            if "output" in turn:
+                messages.append(AIMessage(content=turn["output"]))
+
+        if self.should_mark(provider) and len(messages) >= 2:
+            prefix_tokens = sum(turn_tokens(turn) for turn in kept[:-1])
+            if prefix_tokens >= self.min_cache_tokens:
+                last = messages[-2]
+                messages[-2] = type(last)(content=cache_block(last.content))
+        return messages
+
+    def split_prompt(self, parts, provider=None):
+        """
+        A single-message prompt from its `parts`, with everything but the last part marked as a prompt caching
+        breakpoint. Each part is its own content block, so a later prompt made of the same leading parts hits
+        the cache at their boundary.
+        """
+        prompt = "".join(parts)
+        if not self.should_mark(provider) or len(parts) < 2:
+            return prompt
+        if sum(count_tokens(part) for part in parts[:-1]) < self.min_cache_tokens:
+            return prompt
+
+        blocks = [{ "type": "text", "text": part } for part in parts[:-2]]
+        blocks += cache_block(parts[-2]) + [{ "type": "text", "text": parts[-1] }]
+        return [HumanMessage(content=blocks)]
+
+    def should_mark(self, provider):
+        return self.cache_prefix and provider == "claude"
+
+
+class ConversationUsage:
+    """
+    Token usage of one conversation, split into cached and uncached input tokens.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.cached_input_tokens = 0
+        self.uncached_input_tokens = 0
+        self.output_tokens = 0
+        self.trimmed_turns = 0
+
+    def add(self, message):
+        cached, uncached = input_token_breakdown(message)
+        self.calls += 1
+        self.cached_input_tokens += cached
+        self.uncached_input_tokens += uncached
+        self.output_tokens += token_usage(message)[1]
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "cached_input_tokens": self.cached_input_tokens,
+            "uncached_input_tokens": self.uncached_input_tokens,
+            "output_tokens": self.output_tokens,
+            "trimmed_turns": self.trimmed_turns,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        usage = cls()
+        for name, value in data.items():
+            setattr(usage, name, value)
+        return usage
+
+
+@contextmanager
+def track_usage(usage=None):
+    """
+    Collect the usage of every LLM call made inside the block (per asyncio task) into a ConversationUsage,
+    or into `usage` to keep counting a resumed conversation.
+    """
+    usage = usage if usage is not None else ConversationUsage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def current_usage():
+    return _current_usage.get()
+
+
+def add_context_args(parser):
+    parser.add_argument("--context_max_tokens", type=int, default=None,
+                        help="Token budget of the dialogue resent on every turn. Older turns are dropped beyond it")
+    parser.add_argument("--context_keep_first", type=int, default=1,
+                        help="Number of opening turns always kept in the context")
+    parser.add_argument("--prompt_cache", action="store_true",
+                        help="Mark the stable prompt prefix for provider-side prompt caching (claude)")
+
+
+def context_from_args(args):
+    return ContextWindow(
+        max_tokens=args.context_max_tokens,
+        keep_first=args.context_keep_first,
+        cache_prefix=args.prompt_cache,
+    )
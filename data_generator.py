@@ -1,13 +1,77 @@
+import asyncio
 from abc import ABC, abstractmethod
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain.prompts.prompt import PromptTemplate
+from collections import deque
+from functools import lru_cache
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain.output_parsers import PydanticOutputParser
-from schema import Instruction, InstructionInputs
+from context import ConversationUsage
+from llm_client import LLMClient
 from prompts import *
+from schema import InstructionCandidates
 import dotenv
 
+@lru_cache(maxsize=None)
+def instruction_candidates_parser():
+    from langchain.output_parsers import PydanticOutputParser
+    return PydanticOutputParser(pydantic_object=InstructionCandidates)
+
+def candidate_to_instruction(candidate):
+    if candidate.input.strip() in ["None", ""]:
+        return candidate.instruction
+    return candidate.instruction + "\n\n" + candidate.input
+
+class PartialConversation:
+    """
+    A conversation being generated, as a state machine resumable from its last finished call. The stage
+    is derived from the dialogue: its first instruction, then the response to the last instruction, then a
+    follow-up instruction until `turns` turns are done. `failures` counts the failed calls of the current turn.
+    """
+    def __init__(self, turns, dialogue=None, failures=0, usage=None, key=None, slot=None):
+        self.turns = turns
+        self.dialogue = dialogue or []
+        self.failures = failures
+        self.usage = usage if usage is not None else ConversationUsage()
+        self.key = key
+        self.slot = slot
+        self.abandoned = False
+
+    def stage(self):
+        if not self.dialogue:
+            return "first_instruction"
+        if not "output" in self.dialogue[-1]:
+            return "response"
+        if len(self.dialogue) < self.turns:
+            return "follow_up_instruction"
+        return "done"
+
+    def apply(self, text):
+        if self.stage() == "response":
+            self.dialogue[-1]["output"] = text
+            self.failures = 0
+        else:
+            self.dialogue.append({ "instruction": text })
+
+    def fail(self):
+        # A follow-up instruction whose response failed is generated again with the retry, the first
+        # instruction (the topic of the conversation) is kept.
+        if self.stage() == "response" and len(self.dialogue) > 1:
+            self.dialogue.pop()
+        self.failures += 1
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "slot": self.slot,
+            "turns": self.turns,
+            "dialogue": self.dialogue,
+            "failures": self.failures,
+            "usage": self.usage.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["turns"], dialogue=data["dialogue"], failures=data["failures"],
+                   usage=ConversationUsage.from_dict(data["usage"]), key=data["key"], slot=data["slot"])
+
 class DataGenerator(ABC):
     """
     A data generator generating synthetic multi-turn instruction-following dataset
@@ -26,112 +90,249 @@ class DataGenerator(ABC):
         """
         pass
 
-class LLMDataGenerator(DataGenerator):
-    def __init__(self, llm, model_name, api_key):
-        self._validation(llm)
-
-        self.llm = llm
-        self.model_name = model_name
-
-        if self.llm == "claude":
-            self.agent = ChatAnthropic(model=self.model_name, anthropic_api_key=api_key, default_request_timeout=60)
-        elif self.llm == "openai":
-            self.agent = ChatOpenAI(model=self.model_name, openai_api_key=api_key, timeout=60)
-
-    def _validation(self, llm):
-        if not llm in ["claude", "openai"]:
-            raise ValueError(
-                f"The LLM {llm} doesn't exist"
-            )
+class LLMDataGenerator(DataGenerator, LLMClient):
+    def __init__(self, llm, model_name, api_key, cache=None, agent=None, metrics=None, rate_limiter=None, retry=None,
+                 context=None, quality_gate=None, n_candidates=1, streaming=None, turn_retries=2):
+        self._init_agent(llm, model_name, api_key, cache=cache, agent=agent, metrics=metrics,
+                         rate_limiter=rate_limiter, retry=retry, context=context, streaming=streaming)
+        self.quality_gate = quality_gate
+        # With n_candidates > 1, one call asks for that many first instructions and the extras are
+        # queued for the following conversations. Concurrent conversations wait for the call in flight.
+        self.n_candidates = n_candidates
+        self.candidates = deque()
+        self._candidates_lock = asyncio.Lock()
+        self.turn_retries = turn_retries
     
     def generate(self):
         pass
 
-    def few_shot_generate(self, examples, turns):
-        first_instruction = self.generate_first_instruction(examples)
-        if first_instruction is None:
-            return []
-        
-        dialogue = [{ "instruction": first_instruction.content }]
-        first_response = self.response_to_multi_turn_instruction(dialogue=dialogue)
+    def _checked(self, stage, output, examples=None):
+        """
+        `output` if it passes the quality gate, None (like a failed call) otherwise.
+        """
+        if output is None or self.quality_gate is None:
+            return output
 
-        if first_response is None:
-            return []
+        rule = self.quality_gate.check(output.content, stage, examples)
+        if rule is not None:
+            return None
+        return output
+
+    def _passing_candidates(self, candidates, examples):
+        instructions = [candidate_to_instruction(candidate) for candidate in candidates]
+        if self.quality_gate is None:
+            return instructions
+        return [text for text in instructions if self.quality_gate.check(text, "instruction", examples) is None]
+
+    def next_first_instruction(self, examples, attempt=0):
+        if self.n_candidates <= 1:
+            output = self._checked("instruction", self.generate_first_instruction(examples, attempt), examples)
+            return None if output is None else output.content
+
+        if not self.candidates:
+            candidates = self.generate_instruction_candidates(examples, attempt)
+            self.candidates.extend(self._passing_candidates(candidates, examples))
+        return self.candidates.popleft() if self.candidates else None
+
+    async def anext_first_instruction(self, examples, attempt=0):
+        if self.n_candidates <= 1:
+            output = self._checked("instruction", await self.agenerate_first_instruction(examples, attempt), examples)
+            return None if output is None else output.content
+
+        if not self.candidates:
+            async with self._candidates_lock:
+                if not self.candidates:
+                    candidates = await self.agenerate_instruction_candidates(examples, attempt)
+                    self.candidates.extend(self._passing_candidates(candidates, examples))
+        return self.candidates.popleft() if self.candidates else None
+
+    def _first_instruction(self, examples, instruction_filter, attempt=0):
+        first_instruction = self.next_first_instruction(examples, attempt)
+        if first_instruction is not None and instruction_filter is not None and not instruction_filter(first_instruction):
+            print("[x] Rejected => " + first_instruction)
+            return None
+        return first_instruction
 
-        dialogue[0]["output"] = first_response.content
+    async def _afirst_instruction(self, examples, instruction_filter, attempt=0):
+        first_instruction = await self.anext_first_instruction(examples, attempt)
+        if first_instruction is not None and instruction_filter is not None and not instruction_filter(first_instruction):
+            return None
+        return first_instruction
+
+    def _step(self, state, examples, instruction_filter):
+        stage = state.stage()
+        if stage == "first_instruction":
+            return self._first_instruction(examples, instruction_filter, state.failures)
+        if stage == "follow_up_instruction":
+            output = self.generate_multi_turn_instruction(dialogue=state.dialogue, attempt=state.failures)
+            output = self._checked("instruction", output)
+        else:
+            output = self.response_to_multi_turn_instruction(dialogue=state.dialogue, attempt=state.failures)
+            output = self._checked("response", output)
+        return None if output is None else output.content
+
+    async def _astep(self, state, examples, instruction_filter):
+        stage = state.stage()
+        if stage == "first_instruction":
+            return await self._afirst_instruction(examples, instruction_filter, state.failures)
+        if stage == "follow_up_instruction":
+            output = await self.agenerate_multi_turn_instruction(dialogue=state.dialogue, attempt=state.failures)
+            output = self._checked("instruction", output)
+        else:
+            output = await self.aresponse_to_multi_turn_instruction(dialogue=state.dialogue, attempt=state.failures)
+            output = self._checked("response", output)
+        return None if output is None else output.content
+
+    def _advance(self, state, text, on_step):
+        """
+        Apply the output `text` (None when the call failed) of the current stage of `state`. Returns False
+        once the turn ran out of retries.
+        """
+        if text is None:
+            state.fail()
+        else:
+            state.apply(text)
+        if on_step is not None:
+            on_step(state)
+
+        if state.failures > self.turn_retries:
+            state.abandoned = True
+            return False
+        return True
+
+    def few_shot_generate(self, examples, turns, instruction_filter=None, state=None, on_step=None):
+        """
+        Generate a conversation of `turns` turns, or finish `state` (a PartialConversation of an earlier run).
+        Every step is retried up to `turn_retries` times and `on_step(state)` is called after each call, so
+        the caller can persist it. Returns the dialogue, or [] when the conversation was abandoned.
+        """
+        state = state if state is not None else PartialConversation(turns)
 
-        print("Me => " + dialogue[0]["instruction"])
-        print("AI => " + dialogue[0]["output"])
+        while state.stage() != "done":
+            stage = state.stage()
+            text = self._step(state, examples, instruction_filter)
+            if text is not None:
+                print(("AI => " if stage == "response" else "Me => ") + text)
+            if not self._advance(state, text, on_step):
+                return []
 
-        for i in range(turns - 1):
-            instruction = self.generate_multi_turn_instruction(dialogue=dialogue)
-            if instruction is None:
-                continue
+        return state.dialogue
 
-            print("Me => " + instruction.content)
+    async def afew_shot_generate(self, examples, turns, instruction_filter=None, state=None, on_step=None):
+        state = state if state is not None else PartialConversation(turns)
 
-            dialogue.append({
-                "instruction": instruction.content
-            })
+        while state.stage() != "done":
+            text = await self._astep(state, examples, instruction_filter)
+            if not self._advance(state, text, on_step):
+                return []
 
-            response = self.response_to_multi_turn_instruction(dialogue=dialogue)
+        return state.dialogue
 
-            if response is None:
-                dialogue.pop()
-                continue
+    def generate_first_instruction(self, examples, attempt=0):
+        prompt = render_first_instruction_prompt_v3(examples)
 
-            print("AI => " + response.content)
+        try:
+            instr = self.call_llm("first_instruction", prompt, attempt)
+            return instr
+        except Exception as e:
+            print(e)
+            return None
+    
+    async def agenerate_first_instruction(self, examples, attempt=0):
+        prompt = render_first_instruction_prompt_v3(examples)
 
-            dialogue[-1]["output"] = response.content
-        
-        return dialogue
+        try:
+            instr = await self.acall_llm("first_instruction", prompt, attempt)
+            return instr
+        except Exception as e:
+            print(e)
+            return None
 
-    def generate_first_instruction(self, examples):
-        prompt_template = create_first_instruction_prompt_v3(examples)
+    def _instruction_candidates_prompt(self, examples):
+        parser = instruction_candidates_parser()
+        return render_instruction_candidates_prompt(examples, self.n_candidates, parser.get_format_instructions())
 
-        chain = prompt_template | self.agent
+    def generate_instruction_candidates(self, examples, attempt=0):
+        prompt = self._instruction_candidates_prompt(examples)
 
         try:
-            instr = chain.invoke({})
-            return instr
+            output = self.call_llm("instruction_candidates", prompt, attempt)
+            return instruction_candidates_parser().parse(output.content).instructions
         except Exception as e:
             print(e)
-            return None
-    
-    def response_to_multi_turn_instruction(self, dialogue):
-        prompt = []
-        for context in dialogue:
-            if "instruction" in context:
-                prompt.append(HumanMessage(content=context["instruction"]))
-            if "output" in context:
-                prompt.append(AIMessage(content=context["output"]))
+            return []
+
+    async def agenerate_instruction_candidates(self, examples, attempt=0):
+        prompt = self._instruction_candidates_prompt(examples)
+
+        try:
+            output = await self.acall_llm("instruction_candidates", prompt, attempt)
+            return instruction_candidates_parser().parse(output.content).instructions
+        except Exception as e:
+            print(e)
+            return []
+
+    def _dialogue_to_messages(self, dialogue):
+        return self.context.to_messages(dialogue, provider=self.prompt_provider)
+
+    def _multi_turn_prompt(self, dialogue):
+        dialogue, _ = self.context.fit(dialogue)
+        return self.context.split_prompt(multi_turn_prompt_v3_parts(dialogue), provider=self.prompt_provider)
+
+    def response_to_multi_turn_instruction(self, dialogue, attempt=0):
+        prompt = self._dialogue_to_messages(dialogue)
         
         try:
-            output = self.agent.invoke(prompt)
+            output = self.call_llm("response", prompt, attempt)
             return output
         except Exception as e:
             print(e)
             return None
-        
-    def generate_multi_turn_instruction(self, dialogue):
-        prompt_template = create_multi_turn_prompt_v3(dialogue)
 
-        chain = prompt_template | self.agent
+    async def aresponse_to_multi_turn_instruction(self, dialogue, attempt=0):
+        prompt = self._dialogue_to_messages(dialogue)
+
+        try:
+            output = await self.acall_llm("response", prompt, attempt)
+            return output
+        except Exception as e:
+            print(e)
+            return None
+        
+    def generate_multi_turn_instruction(self, dialogue, attempt=0):
+        prompt = self._multi_turn_prompt(dialogue)
         
         try:
-            output = chain.invoke({})
+            output = self.call_llm("follow_up_instruction", prompt, attempt)
+            return output
+        except Exception as e:
+            print(e)
+            return None
+
+    async def agenerate_multi_turn_instruction(self, dialogue, attempt=0):
+        prompt = self._multi_turn_prompt(dialogue)
+
+        try:
+            output = await self.acall_llm("follow_up_instruction", prompt, attempt)
             return output
         except Exception as e:
             print(e)
             return None
 
 class Claude3DataGenerator(DataGenerator):
+    # The langchain chains used here are imported by each method, so that LLMDataGenerator doesn't pay for them.
     def __init__(self, model_name):
+        from langchain_anthropic import ChatAnthropic
+
         config = dotenv.dotenv_values(".env")
         self.model_name = model_name
         self.agent = ChatAnthropic(model=model_name, anthropic_api_key=config["ANTHROPIC_API_KEY"])
     
     def generate(self):
+        from langchain.prompts.prompt import PromptTemplate
+        from langchain.output_parsers import PydanticOutputParser
+        from schema import Instruction
+
         parser = PydanticOutputParser(pydantic_object=Instruction)
         prompt_template = PromptTemplate(
             template="你是一個好奇心旺盛的人類，你現在在和一個大型語言模型進行互動。請向這個大型語言模型進行提問\n"
@@ -153,6 +354,10 @@ class Claude3DataGenerator(DataGenerator):
             return None
 
     def generate_first_instruction(self, examples):
+        from langchain.prompts.prompt import PromptTemplate
+        from langchain.output_parsers import PydanticOutputParser
+        from schema import Instruction
+
         parser = PydanticOutputParser(pydantic_object=Instruction)
 
         example_sentences = "\n".join([f"問題 {i + 1}: {e['instruction']}" for i, e in enumerate(examples)])
@@ -173,6 +378,10 @@ class Claude3DataGenerator(DataGenerator):
             return None
     
     def generate_first_inputs(self, examples, instruction):
+        from langchain.prompts.prompt import PromptTemplate
+        from langchain.output_parsers import PydanticOutputParser
+        from schema import InstructionInputs
+
         parser = PydanticOutputParser(pydantic_object=InstructionInputs)
 
         example_sentences = "\n\n".join([f"指示: {e['instruction']}\n輸入: {e['input']}" for i, e in enumerate(examples)])
@@ -196,6 +405,8 @@ class Claude3DataGenerator(DataGenerator):
             return None
 
     def response_to_instruction(self, instruction):
+        from langchain.prompts.prompt import PromptTemplate
+
         prompt = PromptTemplate(
             template=instruction,
             input_variables=[]
@@ -223,6 +434,8 @@ class Claude3DataGenerator(DataGenerator):
             return None
     
     def generate_multi_turn_instruction(self, dialogue):
+        from langchain.prompts.prompt import PromptTemplate
+
         multi_turn = "\n\n".join([f"我:\n{data['instruction']}\n\n對方:\n{data['output']}" for data in dialogue['conversation']])
         
         prompt = PromptTemplate(
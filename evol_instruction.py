@@ -45,3 +45,32 @@ def createDeepenPromptTraditionalChinese(instruction):
 	prompt += "＃給定提示＃:\n{}\n".format(instruction)
 	prompt += "＃重寫提示＃:\n"
 	return prompt
+
+
+def createBreadthPrompt(instruction):
+	prompt = "I want you act as a Prompt Creator.\r\n\
+			Your goal is to draw inspiration from the #Given Prompt# to create a brand new prompt.\r\n\
+			This new prompt should belong to the same domain as the #Given Prompt# but be even more rare.\r\n\
+			The LENGTH and complexity of the #Created Prompt# should be similar to that of the #Given Prompt#.\r\n\
+			The #Created Prompt# must be reasonable and must be understood and responded by humans.\r\n\
+			'#Given Prompt#', '#Created Prompt#', 'given prompt' and 'created prompt' are not allowed to appear in #Created Prompt#\r\n"
+	prompt += "#Given Prompt#: \r\n {} \r\n".format(instruction)
+	prompt += "#Created Prompt#:\r\n"
+	return prompt
+
+
+# The evolution strategies by name. Depth strategies make an instruction harder, breadth ones create a new
+# instruction of the same domain.
+DEPTH_STRATEGIES = {
+	"constraints": createConstraintsPrompt,
+	"deepen": createDeepenPrompt,
+	"concretizing": createConcretizingPrompt,
+	"reasoning": createReasoningPrompt,
+	"deepen_zh": createDeepenPromptTraditionalChinese,
+}
+
+BREADTH_STRATEGIES = {
+	"breadth": createBreadthPrompt,
+}
+
+EVOL_STRATEGIES = { **DEPTH_STRATEGIES, **BREADTH_STRATEGIES }
@@ -0,0 +1,182 @@
+import asyncio
+import random
+import re
+from evol_instruction import BREADTH_STRATEGIES, EVOL_STRATEGIES
+from novelty import char_ngrams
+from streaming import StreamAborted
+
+# Markers of the evolution prompts. A rewritten instruction containing them copied the prompt's scaffolding.
+# Only the exact markers count, an instruction may well mention "the given prompt" in plain text.
+LEAKED_MARKERS = re.compile(
+    r"[#＃]\s*(The Given Prompt|Given Prompt|Rewritten Prompt|Created Prompt|給定提示|重寫提示)\s*[#＃]"
+)
+
+
+class EvolutionNode:
+    """
+    An instruction in the evolution DAG, derived from `parent` by `strategy` (None for the original).
+    """
+    def __init__(self, instruction, root, parent=None, strategy=None):
+        self.instruction = instruction
+        self.root = root
+        self.parent = parent
+        self.strategy = strategy
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def path(self):
+        """
+        The strategies applied to the original instruction to get this one.
+        """
+        node, strategies = self, []
+        while node.parent is not None:
+            strategies.append(node.strategy)
+            node = node.parent
+        return strategies[::-1]
+
+
+def prune_reason(instruction, parent, max_length_ratio=3.0, length_slack=100):
+    """
+    Why the evolution of `parent` into `instruction` failed, or None when it didn't. A copy adds no character
+    bigram to its parent, a length blow-up is longer than `max_length_ratio` times the parent plus `length_slack`.
+    """
+    if not instruction.strip():
+        return "empty"
+    if LEAKED_MARKERS.search(instruction):
+        return "leaked_marker"
+    if len(instruction) > max_length_ratio * len(parent) + length_slack:
+        return "length"
+
+    if char_ngrams(instruction) <= char_ngrams(parent):
+        return "copied"
+    return None
+
+
+class EvolutionEngine:
+    """
+    Multi-round instruction evolution. Every round applies `branching` of the `strategies` (picked at random)
+    to each live instruction, all steps of a round in flight at once with `aevolve`. Failed evolutions are
+    pruned after each round, so later rounds don't spend calls on dead branches.
+
+    The result for an original instruction is its deepest surviving evolution, or the original when
+    every branch was pruned.
+    """
+    def __init__(self, strategies=("deepen_zh",), rounds=1, branching=1, max_length_ratio=3.0, length_slack=100):
+        for strategy in strategies:
+            if not strategy in EVOL_STRATEGIES:
+                raise ValueError(
+                    f"The evolution strategy {strategy} doesn't exist"
+                )
+
+        self.strategies = list(strategies)
+        self.rounds = rounds
+        self.branching = branching
+        self.max_length_ratio = max_length_ratio
+        self.length_slack = length_slack
+        self.steps = 0
+        self.pruned = {}
+
+    def _plan(self, live, breadth):
+        """
+        The (node, strategy) steps of a round. Breadth strategies replace the instruction with a new one, so
+        they're only used with `breadth` (single-turn rows), where no later turn depends on it.
+        """
+        plan = []
+        for node in live:
+            strategies = [strategy for strategy in self.strategies if breadth or not strategy in BREADTH_STRATEGIES]
+            plan += [(node, strategy) for strategy in random.sample(strategies, min(self.branching, len(strategies)))]
+        return plan
+
+    def _select(self, plan, outputs, best):
+        """
+        The children of `plan` that survive pruning. `best` keeps the deepest node of every root.
+        """
+        live = []
+        for (node, strategy), output in zip(plan, outputs):
+            self.steps += 1
+            if isinstance(output, StreamAborted):
+                reason = output.abort_reason
+            else:
+                reason = prune_reason(output, node.instruction, self.max_length_ratio, self.length_slack)
+            if reason is not None:
+                self.pruned[reason] = self.pruned.get(reason, 0) + 1
+                continue
+
+            child = EvolutionNode(output.strip(), node.root, parent=node, strategy=strategy)
+            if child.depth > best[child.root].depth:
+                best[child.root] = child
+            live.append(child)
+        return live
+
+    @staticmethod
+    def _step(agent, instruction, strategy):
+        """
+        The evolution of `instruction` by `strategy`, or the StreamAborted of a stop check, which only prunes
+        this branch.
+        """
+        try:
+            return agent.rewrite(instruction, EVOL_STRATEGIES[strategy])
+        except StreamAborted as e:
+            return e
+
+    @staticmethod
+    async def _astep(agent, instruction, strategy):
+        try:
+            return await agent.arewrite(instruction, EVOL_STRATEGIES[strategy])
+        except StreamAborted as e:
+            return e
+
+    def evolve(self, agent, instructions):
+        """
+        Evolve `instructions` with `agent.rewrite`. Returns the evolved instructions and their strategy paths.
+        """
+        live = [EvolutionNode(instruction, root) for root, instruction in enumerate(instructions)]
+        best = list(live)
+
+        for _ in range(self.rounds):
+            if not live:
+                break
+            plan = self._plan(live, breadth=len(instructions) == 1)
+            outputs = [self._step(agent, node.instruction, strategy) for node, strategy in plan]
+            live = self._select(plan, outputs, best)
+
+        return [node.instruction for node in best], [node.path() for node in best]
+
+    async def aevolve(self, agent, instructions):
+        live = [EvolutionNode(instruction, root) for root, instruction in enumerate(instructions)]
+        best = list(live)
+
+        for _ in range(self.rounds):
+            if not live:
+                break
+            plan = self._plan(live, breadth=len(instructions) == 1)
+            outputs = await asyncio.gather(*[self._astep(agent, node.instruction, strategy) for node, strategy in plan])
+            live = self._select(plan, outputs, best)
+
+        return [node.instruction for node in best], [node.path() for node in best]
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "pruned": dict(self.pruned),
+        }
+
+
+def add_evolution_args(parser):
+    parser.add_argument("--evol_strategies", type=str, nargs="+", default=["deepen_zh"],
+                        choices=list(EVOL_STRATEGIES),
+                        help="Evolution strategies picked from at every round")
+    parser.add_argument("--evol_rounds", type=int, default=1,
+                        help="Number of evolution generations of every user message")
+    parser.add_argument("--evol_branching", type=int, default=1,
+                        help="Number of strategies applied to every live instruction per round")
+    parser.add_argument("--evol_max_length_ratio", type=float, default=3.0,
+                        help="Prune evolutions longer than this many times their parent (plus 100 characters)")
+
+
+def evolution_engine_from_args(args):
+    return EvolutionEngine(
+        strategies=args.evol_strategies,
+        rounds=args.evol_rounds,
+        branching=args.evol_branching,
+        max_length_ratio=args.evol_max_length_ratio,
+    )
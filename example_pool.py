@@ -0,0 +1,150 @@
+import random
+import zlib
+from novelty import char_ngrams
+
+SOURCES = ["seed", "generated"]
+
+
+def has_input(example):
+    return example.get("input", "None") not in ["None", "", None]
+
+
+def topic_cluster(text, n_clusters, ngram=2):
+    """
+    Cheap topic bucket of `text`: the minimum hash over its character n-grams (one-permutation MinHash),
+    so two texts land in the same bucket with probability equal to their n-gram Jaccard similarity.
+    """
+    grams = char_ngrams(text, ngram)
+    if not grams:
+        return 0
+    return min(zlib.crc32(gram.encode("utf8")) for gram in grams) % n_clusters
+
+
+class ExamplePool:
+    """
+    Few-shot example pool with index lists partitioned by source ("seed" / "generated"), whether the example
+    has an input, and topic cluster. The partitions are updated as examples are added, so sampling costs
+    O(k) instead of filtering the whole pool on every call.
+
+    `sample(..., diverse=True)` picks clusters uniformly and one example per cluster, so a topic that is
+    generated often doesn't get sampled more and snowball.
+
+    For long runs, generated examples added with an `offset` only keep that offset in memory and are read
+    back with `load(offset)` when sampled, and `max_generated` caps them with reservoir sampling, so the
+    pool stays a uniform sample of everything generated at a constant memory footprint.
+    """
+    def __init__(self, examples=(), n_clusters=64, ngram=2, load=None, max_generated=None):
+        self.n_clusters = n_clusters
+        self.ngram = ngram
+        self.load = load
+        self.max_generated = max_generated
+        self.n_generated = 0
+        self.examples = []
+        self.partitions = {}
+        self.clusters = {}
+        self.cluster_keys = {}
+        self.placements = {}
+        self.generated = []
+        self.extend(examples)
+
+    def __len__(self):
+        return len(self.examples)
+
+    def add(self, example, generated=False, offset=None):
+        """
+        Add `example`, or only its `offset` when the pool has a `load` function. Past `max_generated`,
+        a generated example replaces a random one with probability max_generated / n_generated.
+        """
+        item = offset if offset is not None and self.load is not None else example
+        if generated:
+            self.n_generated += 1
+            if self.max_generated is not None and len(self.generated) >= self.max_generated:
+                position = random.randrange(self.n_generated)
+                if position >= self.max_generated:
+                    return
+                idx = self.generated[position]
+                self._remove(idx)
+                self.examples[idx] = item
+                self._place(idx, example, generated)
+                return
+
+        idx = len(self.examples)
+        self.examples.append(item)
+        if generated:
+            self.generated.append(idx)
+        self._place(idx, example, generated)
+
+    def _place(self, idx, example, generated):
+        partition = ("generated" if generated else "seed", has_input(example))
+        cluster = topic_cluster(example["instruction"], self.n_clusters, self.ngram)
+        self.partitions.setdefault(partition, []).append(idx)
+        if not (partition, cluster) in self.clusters:
+            self.clusters[(partition, cluster)] = []
+            self.cluster_keys.setdefault(partition, []).append((partition, cluster))
+        self.clusters[(partition, cluster)].append(idx)
+        if self.max_generated is not None and generated:
+            self.placements[idx] = (partition, cluster)
+
+    def _remove(self, idx):
+        # O(max_generated), and only for the replaced examples, which is negligible next to an LLM call.
+        partition, cluster = self.placements.pop(idx)
+        self.partitions[partition].remove(idx)
+        key = (partition, cluster)
+        self.clusters[key].remove(idx)
+        if not self.clusters[key]:
+            del self.clusters[key]
+            self.cluster_keys[partition].remove(key)
+
+    def extend(self, examples, generated=False):
+        for example in examples:
+            self.add(example, generated=generated)
+
+    def _example(self, idx):
+        item = self.examples[idx]
+        return self.load(item) if isinstance(item, int) else item
+
+    def _partitions(self, source, with_input):
+        sources = SOURCES if source == "all" else [source]
+        inputs = [True, False] if with_input is None else [with_input]
+        return [(s, i) for s in sources for i in inputs if (s, i) in self.partitions]
+
+    def count(self, source="all", with_input=None):
+        return sum(len(self.partitions[partition]) for partition in self._partitions(source, with_input))
+
+    def sample(self, n, source="all", with_input=None, diverse=False):
+        """
+        `n` distinct examples from `source` ("seed", "generated" or "all"), optionally restricted to examples
+        with (True) or without (False) an input. Raises ValueError when fewer than `n` are available.
+        """
+        partitions = self._partitions(source, with_input)
+        if diverse:
+            indices = self._sample_diverse(n, partitions)
+        else:
+            indices = self._sample_uniform(n, partitions)
+        return [self._example(idx) for idx in indices]
+
+    def _sample_uniform(self, n, partitions):
+        lists = [self.partitions[partition] for partition in partitions]
+        total = sum(len(indices) for indices in lists)
+
+        selected = []
+        for position in random.sample(range(total), n):
+            for indices in lists:
+                if position < len(indices):
+                    selected.append(indices[position])
+                    break
+                position -= len(indices)
+        return selected
+
+    def _sample_diverse(self, n, partitions):
+        if n > sum(len(self.partitions[partition]) for partition in partitions):
+            raise ValueError("Sample larger than population")
+
+        keys = [key for partition in partitions for key in self.cluster_keys[partition]]
+        selected = set()
+        while len(selected) < n:
+            # One example from each of up to n clusters, repeated over the clusters until n are picked.
+            for key in random.sample(keys, min(len(keys), n - len(selected))):
+                cluster = self.clusters[key]
+                selected.add(cluster[random.randrange(len(cluster))])
+        return list(selected)
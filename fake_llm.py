@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from langchain_core.messages import AIMessage, AIMessageChunk
+from cache import content_text, normalize_messages
+
+# The K-candidate first instruction prompt of prompts.py, answered with K fake instructions in JSON.
+_CANDIDATES_PROMPT = re.compile(r"生成 (\d+) 個全新的指令")
+
+# Common Traditional Chinese characters used to build fake responses.
+_CHARS = "的一是不了人我在有他這中大來上個國到說們為子和你地出道也時年得就那要下以生會自著去之過家學對可她裡後小麼心多天而能好都然沒日於起還發成事只作當想看文無開手十用主行方又如前所本見經頭面公同三已老從動兩長知民樣現分將外但身些與高意進把法此實回二理美點月明其種聲全工己話兒者向情部正名定女問力機給等幾很業最間新什打便位因重被走電四第門相次東政海口使教西再平真聽世氣信北少關並內加化由卻代軍產入先山五太水萬市眼體別處總才場師書比住員九笑性通目華報立馬命張活難神數件安表原車白應路期叫死常提感金何更反合放做系計或司利受光王果親界及今京務制解各任至清物台"
+
+
+class FakeLLMError(Exception):
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class FakeChatModel:
+    """
+    Deterministic offline stand-in for a chat model. The response text only depends on the prompt and `seed`,
+    latency and failures are drawn from the configured distributions.
+
+    Streams deliver the first chunk after the sampled latency, and the rest at `tokens_per_second`
+    (one token per character, 0 for no delay).
+    """
+    def __init__(self, model_name="fake", latency=0.5, latency_dist="lognormal", latency_sigma=0.5,
+                 error_rate=0.0, response_length=200, seed=0, tokens_per_second=0, chunk_size=16):
+        if not latency_dist in ["constant", "exponential", "lognormal"]:
+            raise ValueError(
+                f"The latency distribution {latency_dist} doesn't exist"
+            )
+
+        self.model_name = model_name
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.response_length = response_length
+        self.seed = seed
+        self.tokens_per_second = tokens_per_second
+        self.chunk_size = chunk_size
+        self._timing = random.Random(seed)
+
+    def _rng(self, prompt):
+        digest = hashlib.sha256(repr((self.seed, normalize_messages(prompt))).encode("utf8")).digest()
+        return random.Random(digest)
+
+    def _sample_latency(self):
+        if self.latency_dist == "constant":
+            return self.latency
+        if self.latency_dist == "exponential":
+            return self._timing.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+        # lognormal with mean `latency`
+        mu = -self.latency_sigma ** 2 / 2
+        return self.latency * self._timing.lognormvariate(mu, self.latency_sigma)
+
+    def _respond(self, prompt, max_tokens=None):
+        if self._timing.random() < self.error_rate:
+            raise FakeLLMError("Fake LLM error")
+
+        rng = self._rng(prompt)
+        length = max(1, int(rng.gauss(self.response_length, self.response_length / 4)))
+        content = "".join(rng.choices(_CHARS, k=length))
+
+        candidates = _CANDIDATES_PROMPT.search(content_text(normalize_messages(prompt)[-1][1]))
+        if candidates is not None:
+            content = json.dumps({
+                "instructions": [
+                    { "instruction": "".join(rng.choices(_CHARS, k=length)), "input": "None" }
+                    for _ in range(int(candidates.group(1)))
+                ]
+            }, ensure_ascii=False)
+
+        if max_tokens is not None:
+            content = content[:max_tokens]
+
+        input_tokens = sum(len(content_text(text)) for _, text in normalize_messages(prompt))
+        return AIMessage(
+            content=content,
+            response_metadata={
+                "model": self.model_name,
+                "usage": { "input_tokens": input_tokens, "output_tokens": len(content) }
+            }
+        )
+
+    def _chunks(self, message):
+        # The usage only comes with the last chunk, like the providers' streams.
+        content = message.content
+        for start in range(0, len(content), self.chunk_size):
+            last = start + self.chunk_size >= len(content)
+            yield AIMessageChunk(content=content[start:start + self.chunk_size],
+                                 response_metadata=message.response_metadata if last else {})
+
+    def _chunk_delay(self):
+        return self.chunk_size / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def invoke(self, prompt, max_tokens=None, **kwargs):
+        time.sleep(self._sample_latency())
+        return self._respond(prompt, max_tokens)
+
+    async def ainvoke(self, prompt, max_tokens=None, **kwargs):
+        await asyncio.sleep(self._sample_latency())
+        return self._respond(prompt, max_tokens)
+
+    def stream(self, prompt, max_tokens=None, **kwargs):
+        time.sleep(self._sample_latency())
+        for i, chunk in enumerate(self._chunks(self._respond(prompt, max_tokens))):
+            if i:
+                time.sleep(self._chunk_delay())
+            yield chunk
+
+    async def astream(self, prompt, max_tokens=None, **kwargs):
+        await asyncio.sleep(self._sample_latency())
+        for i, chunk in enumerate(self._chunks(self._respond(prompt, max_tokens))):
+            if i:
+                await asyncio.sleep(self._chunk_delay())
+            yield chunk
+
+
+def add_fake_llm_args(parser):
+    parser.add_argument("--fake_latency", type=float, default=0.5,
+                        help="Mean latency in seconds of the fake LLM (--llm fake)")
+    parser.add_argument("--fake_latency_dist", choices=["constant", "exponential", "lognormal"], default="lognormal")
+    parser.add_argument("--fake_error_rate", type=float, default=0.0)
+    parser.add_argument("--fake_response_length", type=int, default=200,
+                        help="Mean number of characters in a fake response")
+    parser.add_argument("--fake_seed", type=int, default=0)
+    parser.add_argument("--fake_tokens_per_second", type=float, default=0,
+                        help="Output speed of fake streams after the first chunk, 0 for no delay")
+
+
+def fake_llm_from_args(args):
+    if args.llm != "fake":
+        return None
+
+    return FakeChatModel(
+        model_name=args.model_name,
+        latency=args.fake_latency,
+        latency_dist=args.fake_latency_dist,
+        error_rate=args.fake_error_rate,
+        response_length=args.fake_response_length,
+        seed=args.fake_seed,
+        tokens_per_second=args.fake_tokens_per_second,
+    )
@@ -1,91 +1,398 @@
 import argparse
+import hashlib
 import json
+import os
+from itertools import islice
+from multiprocessing import Pool
 from opencc import OpenCC
+from shards import MANIFEST, ParquetShardWriter
 from tqdm import tqdm
 
+_cc = None
 
-def format_syn(file_path, output_path):
-    with open(file_path, "r", encoding="utf8") as reader:
-        all_data = json.load(reader)
-    
-    instructions = [[ { "from": "human", "value": conv["instruction"] } for conv in data["conversation"]] for data in all_data]
-    outputs = [[ { "from": "gpt", "value": conv["output"] } for conv in data["conversation"]] for data in all_data]
-    cc = OpenCC("s2twp")
-
-    conversations = [
-        { "conversations": [item for pair in zip(instructions[i], outputs[i]) for item in pair] }
-        for i in range(len(instructions))
-    ]
-    cc_conversations = [
-        [ { "from": conv["from"], "value": cc.convert(conv["value"]) } for conv in conversations[i]["conversations"] ]
-        for i in tqdm(range(len(conversations)))
-    ]
-    for i in range(len(conversations)):
-        conversations[i]["converted_conversations"] = cc_conversations[i]
-
-    conv_len = {}
-    print(len(conversations))
-    for conv in conversations:
-        val = len(conv["conversations"])
-        if not val in conv_len:
-            conv_len[val] = 0
-        conv_len[val] += 1
-    print(conv_len)
 
-    with open(output_path, "w", encoding="utf8") as writer:
-        for conv in conversations:
-            data = json.dumps(conv, ensure_ascii=False) + "\n"
-            writer.write(data)
-    
-    # with open(output_path, "w", encoding="utf8") as writer:
-    #     json.dump(conversations, writer, indent="\t", ensure_ascii=False)
-    
+def _init_worker():
+    global _cc
+    _cc = OpenCC("s2twp")
+
 
-def format_evol(file_path, output_path):
+def iter_json_array(file_path, chunk_size=1 << 20):
+    """
+    Yield the items of a top-level JSON array one at a time without loading the whole file.
+    """
+    decoder = json.JSONDecoder()
     with open(file_path, "r", encoding="utf8") as reader:
-        all_data = json.load(reader)
-    
-    cc = OpenCC("s2twp")
-    indices = [idx for idx in range(len(all_data)) if "responses" in all_data[idx]]
-    instructions = [
-        [{ "from": "human", "value": instr } for instr in all_data[idx]["instructions"]]
-        for idx in indices
-    ]
-    responses = [
-        [{ "from": "gpt", "value": res } for res in all_data[idx]["responses"]]
-        for idx in indices
+        buffer, pos, started = "", 0, False
+        while True:
+            chunk = reader.read(chunk_size)
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError(f"{file_path} is not a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == "]":
+                    return
+
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break
+                if end == len(buffer) and chunk:
+                    # A scalar at the end of the buffer may continue in the next chunk.
+                    break
+                yield item
+                pos = end
+
+            if not chunk:
+                return
+
+
+def iter_records(file_path):
+    """
+    Stream records from either the JSON file written by gen_data.py / rewrite.py or their JSONL checkpoint log.
+    """
+    if file_path.endswith(".jsonl"):
+        with open(file_path, "r", encoding="utf8") as reader:
+            for line in reader:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+    else:
+        yield from iter_json_array(file_path)
+
+
+def iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def syn_to_conversation(data):
+    return [
+        item for conv in data["conversation"]
+        for item in ({ "from": "human", "value": conv["instruction"] }, { "from": "gpt", "value": conv["output"] })
     ]
-    conversations = [
-        { "conversations": [item for pair in zip(instructions[idx], responses[idx]) for item in pair] }
-        for idx in range(len(responses))
+
+
+def evol_to_conversation(data):
+    return [
+        item for instr, res in zip(data["instructions"], data["responses"])
+        for item in ({ "from": "human", "value": instr }, { "from": "gpt", "value": res })
     ]
-    print(len(conversations))
-    conversations = [conv for conv in conversations if len(conv["conversations"])]
-    print(len(conversations))
 
-    cc_conversations = [
-        [ { "from": conv["from"], "value": cc.convert(conv["value"]) } for conv in conversations[i]["conversations"] ]
-        for i in tqdm(range(len(conversations)))
+
+def _convert_batch(batch):
+    return [
+        {
+            "conversations": conversations,
+            "converted_conversations": [
+                { "from": conv["from"], "value": _cc.convert(conv["value"]) } for conv in conversations
+            ]
+        }
+        for conversations in batch
     ]
-    for i in range(len(conversations)):
-        conversations[i]["converted_conversations"] = cc_conversations[i]
 
 
-    with open(output_path, "w", encoding="utf8") as writer:
-        for conv in conversations:
-            data = json.dumps(conv, ensure_ascii=False) + "\n"
-            writer.write(data)
+class JsonlWriter:
+    def __init__(self, output_path, columns, append=False):
+        self.columns = columns
+        self.writer = open(output_path, "a" if append else "w", encoding="utf8")
+
+    def write(self, record):
+        self.writer.write(json.dumps({ column: record[column] for column in self.columns }, ensure_ascii=False) + "\n")
+
+    def close(self, stats=None):
+        self.writer.close()
+
+
+def create_writer(output_path, output_format="jsonl", drop_original=False, max_shard_size=256, row_group_size=1024,
+                  append=False):
+    """
+    `drop_original` only keeps `converted_conversations`. Parquet output is a directory of zstd shards of
+    at most `max_shard_size` MB, see shards.py. `append` adds to the existing output.
+    """
+    columns = ["converted_conversations"] if drop_original else ["conversations", "converted_conversations"]
+    if output_format == "parquet":
+        return ParquetShardWriter(output_path, columns, max_shard_bytes=max_shard_size << 20,
+                                  row_group_size=row_group_size, append=append)
+    return JsonlWriter(output_path, columns, append=append)
+
+
+def write_converted(conversations, writer, num_workers, chunk_size, conv_len=None):
+    """
+    Convert conversations with OpenCC in a process pool and write them in the input order.
+    Returns a histogram of conversation lengths, continuing `conv_len`, which is also stored with the output.
+    """
+    conv_len = dict(conv_len or {})
+    try:
+        with Pool(processes=num_workers, initializer=_init_worker) as pool:
+            progress = tqdm()
+            for batch in pool.imap(_convert_batch, iter_batches(conversations, chunk_size)):
+                for conv in batch:
+                    val = len(conv["conversations"])
+                    conv_len[val] = conv_len.get(val, 0) + 1
+                    writer.write(conv)
+                progress.update(len(batch))
+            progress.close()
+    finally:
+        writer.close({ "conv_len": conv_len })
+
+    return conv_len
+
+
+class SourceChanged(Exception):
+    pass
+
+
+def conversation_digest(conversations):
+    return hashlib.blake2b(json.dumps(conversations, ensure_ascii=False).encode("utf8"), digest_size=8).hexdigest()
+
+
+def _tail_digest(reader, offset, size=1 << 16):
+    start = max(0, offset - size)
+    reader.seek(start)
+    return hashlib.blake2b(reader.read(offset - start), digest_size=16).hexdigest()
+
+
+class Watermark:
+    """
+    What earlier runs wrote to `output_path`, kept in `{output_path}.watermark.json`: how far the source
+    was read (a byte offset into a JSONL checkpoint log, checked against a hash of the bytes before it),
+    a content hash of every written record and the size of the output.
+
+    gen_data.py and rewrite.py only add records, so a later run only converts the new ones and appends
+    them. A rewritten source, a changed record or different output settings start the output over.
+    """
+    def __init__(self, output_path, settings):
+        self.path = output_path.rstrip("/") + ".watermark.json"
+        self.output_path = output_path
+        self.settings = settings
+        self.state = None
+
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf8") as reader:
+                state = json.load(reader)
+            if state["settings"] == settings:
+                self.state = state
+
+    def reset(self):
+        self.state = {
+            "settings": self.settings,
+            "src_offset": 0,
+            "src_tail": "",
+            "n_records": 0,
+            "n_written": 0,
+            "output_size": 0,
+            "keys": {},
+            "conv_len": {},
+        }
+
+    @property
+    def conv_len(self):
+        return { int(length): count for length, count in self.state["conv_len"].items() }
+
+    def _written(self):
+        if self.settings["output_format"] == "parquet":
+            manifest_path = os.path.join(self.output_path, MANIFEST)
+            if not os.path.exists(manifest_path):
+                return False
+            with open(manifest_path, "r", encoding="utf8") as reader:
+                return json.load(reader)["num_rows"] == self.state["n_written"]
+        return os.path.exists(self.output_path) and os.path.getsize(self.output_path) >= self.state["output_size"]
+
+    def resumable(self, src_path):
+        if self.state is None or not self._written():
+            return False
+        if not src_path.endswith(".jsonl"):
+            return True
+
+        offset = self.state["src_offset"]
+        if os.path.getsize(src_path) < offset:
+            return False
+        with open(src_path, "rb") as reader:
+            return _tail_digest(reader, offset) == self.state["src_tail"]
+
+    def start(self, src_path):
+        """
+        Position in the source of the first record `iter_source` yields.
+        """
+        return self.state["n_records"] if src_path.endswith(".jsonl") else 0
+
+    def iter_source(self, src_path):
+        """
+        The records of a JSONL source after the watermark, or all records of a JSON source, which is
+        rewritten as a whole by every compaction.
+        """
+        if not src_path.endswith(".jsonl"):
+            yield from iter_records(src_path)
+            return
+
+        offset = self.state["src_offset"]
+        with open(src_path, "rb") as reader:
+            reader.seek(offset)
+            for line in reader:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                self.state["n_records"] += 1
+                yield json.loads(line)
+
+            self.state["src_offset"] = offset
+            self.state["src_tail"] = _tail_digest(reader, offset)
+
+    def truncate_output(self):
+        # Drop what a run that crashed before saving the watermark appended.
+        if self.settings["output_format"] == "jsonl":
+            os.truncate(self.output_path, self.state["output_size"])
+
+    def save(self, conv_len):
+        self.state["conv_len"] = conv_len
+        self.state["n_written"] = sum(conv_len.values())
+        if self.settings["output_format"] == "jsonl":
+            self.state["output_size"] = os.path.getsize(self.output_path)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as writer:
+            json.dump(self.state, writer)
+        os.replace(tmp_path, self.path)
+
+
+def new_conversations(items, keys, unique_keys):
+    """
+    The non-empty conversations of `items` ((key, conversations) pairs) whose key isn't in `keys` yet,
+    recording their hashes in `keys`. With `unique_keys`, a known key with another hash raises SourceChanged,
+    otherwise later records with a known key are ignored.
+    """
+    for key, conversations in items:
+        digest = conversation_digest(conversations)
+        if key in keys:
+            if unique_keys and keys[key] != digest:
+                raise SourceChanged(key)
+            continue
+
+        keys[key] = digest
+        if len(conversations):
+            yield conversations
+
+
+def format_items(items, file_path, output_path, num_workers=None, chunk_size=64, incremental=False,
+                 unique_keys=True, task=None, **writer_args):
+    """
+    Convert and write the conversations of `items(records, start)`. With `incremental`, only the ones
+    past the watermark of the previous run are converted and appended.
+
+    Returns the histogram of conversation lengths of the whole output and the number of new keys.
+    """
+    settings = {
+        "task": task,
+        "src_path": os.path.abspath(file_path),
+        "output_format": writer_args.get("output_format", "jsonl"),
+        "drop_original": writer_args.get("drop_original", False),
+    }
+    watermark = Watermark(output_path, settings) if incremental else None
+
+    if watermark is not None and watermark.resumable(file_path):
+        keys = watermark.state["keys"]
+        n_keys = len(keys)
+        try:
+            # The delta is small, so it's collected first to notice a changed source before appending anything.
+            conversations = list(new_conversations(
+                items(watermark.iter_source(file_path), watermark.start(file_path)), keys, unique_keys
+            ))
+        except SourceChanged as e:
+            print(f"Record {e} of {file_path} changed, formatting it again from scratch")
+        else:
+            watermark.truncate_output()
+            writer = create_writer(output_path, append=True, **writer_args)
+            conv_len = write_converted(conversations, writer, num_workers, chunk_size, conv_len=watermark.conv_len)
+            watermark.save(conv_len)
+            return conv_len, len(keys) - n_keys
+
+    keys = {}
+    source = iter_records(file_path)
+    if watermark is not None:
+        watermark.reset()
+        keys = watermark.state["keys"]
+        source = watermark.iter_source(file_path)
+
+    writer = create_writer(output_path, **writer_args)
+    conv_len = write_converted(new_conversations(items(source, 0), keys, unique_keys), writer, num_workers, chunk_size)
+    if watermark is not None:
+        watermark.save(conv_len)
+    return conv_len, len(keys)
+
+
+def format_syn(file_path, output_path, num_workers=None, chunk_size=64, incremental=False, **writer_args):
+    def items(records, start):
+        # Keyed by position, the JSON list and the checkpoint log of gen_data.py keep the generation order.
+        for i, data in enumerate(records, start):
+            yield str(i), syn_to_conversation(data)
+
+    conv_len, _ = format_items(items, file_path, output_path, num_workers, chunk_size, incremental,
+                               unique_keys=True, task="syn", **writer_args)
+
+    print(sum(conv_len.values()))
+    print(conv_len)
+
+
+def format_evol(file_path, output_path, num_workers=None, chunk_size=64, incremental=False, **writer_args):
+    def items(records, start):
+        # The first record of an id with responses wins, later ones come from reruns.
+        for data in records:
+            if "responses" in data:
+                yield str(data["id"]), evol_to_conversation(data)
+
+    conv_len, with_responses = format_items(items, file_path, output_path, num_workers, chunk_size, incremental,
+                                            unique_keys=False, task="evol", **writer_args)
+
+    print(with_responses)
+    print(sum(conv_len.values()))
+
 
 if __name__ == "__main__":
-	parser = argparse.ArgumentParser()
-	parser.add_argument("--task", choices=["evol", "gen"])
-	parser.add_argument("--src_path", type=str, required=True)
-	parser.add_argument("--output_path", type=str, required=True)
-
-	args= parser.parse_args()
-	
-	if args.task == "evol":
-		format_evol(file_path=args.src_path, output_path=args.output_path)
-	elif args.task == "gen":)
-		format_syn(file_path=args.src_path, output_path=args.output_path)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", choices=["evol", "syn", "gen"])
+    parser.add_argument("--src_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of processes running the OpenCC conversion")
+    parser.add_argument("--chunk_size", type=int, default=64,
+                        help="Number of conversations sent to a worker at a time")
+    parser.add_argument("--output_format", choices=["jsonl", "parquet"], default="jsonl",
+                        help="parquet writes a directory of zstd-compressed shards to `output_path`")
+    parser.add_argument("--drop_original", action="store_true",
+                        help="Only write `converted_conversations`, not the conversations before the OpenCC conversion")
+    parser.add_argument("--max_shard_size", type=int, default=256,
+                        help="Size in MB at which a new Parquet shard is started")
+    parser.add_argument("--row_group_size", type=int, default=1024,
+                        help="Number of conversations per Parquet row group, the unit of random reads")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only convert the records added since the last run and append them to `output_path`")
+
+    args = parser.parse_args()
 
+    writer_args = {
+        "output_format": args.output_format,
+        "drop_original": args.drop_original,
+        "max_shard_size": args.max_shard_size,
+        "row_group_size": args.row_group_size,
+    }
+    if args.task == "evol":
+        format_evol(file_path=args.src_path, output_path=args.output_path, num_workers=args.num_workers,
+                    chunk_size=args.chunk_size, incremental=args.incremental, **writer_args)
+    elif args.task in ["syn", "gen"]:
+        format_syn(file_path=args.src_path, output_path=args.output_path, num_workers=args.num_workers,
+                   chunk_size=args.chunk_size, incremental=args.incremental, **writer_args)
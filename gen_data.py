@@ -1,44 +1,55 @@
 import argparse
+import asyncio
 import dotenv
 import json
 import os
 import random
+import uuid
 from datetime import datetime
 from tqdm import tqdm
-from data_generator import LLMDataGenerator
+from cache import add_cache_args, cache_from_args
+from checkpoint import CheckpointStore, default_checkpoint_path
+from context import add_context_args, context_from_args, track_usage
+from fake_llm import add_fake_llm_args, fake_llm_from_args
+from metrics import add_metrics_args, metrics_from_args
+from rate_limit import add_rate_limit_args, rate_limiter_from_args, retry_policy_from_args
+from data_generator import LLMDataGenerator, PartialConversation
+from example_pool import ExamplePool
+from novelty import NoveltyFilter
+from providers import provider_names
+from quality import add_quality_args, quality_gate_from_args
+from streaming import add_streaming_args, stream_policy_from_args
+from work_queue import add_worker_args, arun_worker, default_worker_id, run_worker, work_queue_from_args, worker_shard_path
+from router import add_router_args, router_from_args
 
 class ExampleSelector:
     @staticmethod
-    def random_select(examples, n_examples):
-        return random.sample(examples, n_examples)
+    def random_select(pool, n_examples, diverse=False):
+        return pool.sample(n_examples, source="seed", diverse=diverse)
     
     @staticmethod
-    def balanced_random_select(examples, n_examples):
-        examples_with_input = [e for e in examples if e["input"] != "None"]
-        examples_without_input = [e for e in examples if e["input"] == "None"]
-
-        selected_with_input = random.sample(examples_with_input, n_examples // 2)
-        selected_without_input = random.sample(examples_without_input, n_examples - n_examples // 2)
+    def balanced_random_select(pool, n_examples, diverse=False):
+        selected_with_input = pool.sample(n_examples // 2, source="seed", with_input=True, diverse=diverse)
+        selected_without_input = pool.sample(n_examples - n_examples // 2, source="seed", with_input=False, diverse=diverse)
 
         selected = selected_with_input + selected_without_input
         random.shuffle(selected)
         return selected
     
     @staticmethod
-    def random_select_examples_without_input(examples, n_examples):
-        examples_without_input = [e for e in examples if e["input"] == "None"]
-        selected_without_input = random.sample(examples_without_input, n_examples)
+    def random_select_examples_without_input(pool, n_examples, diverse=False):
+        selected_without_input = pool.sample(n_examples, source="seed", with_input=False, diverse=diverse)
 
         random.shuffle(selected_without_input)
         return selected_without_input
     
     @staticmethod
-    def random_select_with_generated(real_examples, gen_examples, n_examples, real_ratio=0.8):
+    def random_select_with_generated(pool, n_examples, real_ratio=0.8, diverse=False):
         n_real = round(n_examples * real_ratio)
         n_gen = n_examples - n_real
 
-        selected_real = random.sample(real_examples, n_real)
-        selected_gen = random.sample(gen_examples, n_gen)
+        selected_real = pool.sample(n_real, source="seed", diverse=diverse)
+        selected_gen = pool.sample(n_gen, source="generated", diverse=diverse)
 
         selected = selected_real + selected_gen
         random.shuffle(selected)
@@ -46,73 +57,309 @@ class ExampleSelector:
         return selected
 
 
+def select_examples(args, pool, position):
+    diverse = args.example_sampling == "diverse"
+    if position <= args.warmup or not args.add_to_pool:
+        return ExampleSelector.random_select(pool, n_examples=args.n_examples, diverse=diverse)
+    return ExampleSelector.random_select_with_generated(
+        pool=pool,
+        n_examples=args.n_examples,
+        diverse=diverse,
+    )
+
+
+def build_novelty_filter(args, examples, store):
+    if args.novelty_threshold >= 1:
+        return None
+
+    # Generated instructions stay in the checkpoint log, the filter only keeps their offsets.
+    novelty_filter = NoveltyFilter(threshold=args.novelty_threshold, ngram=args.novelty_ngram,
+                                   load=lambda offset: store.read(offset)["conversation"][0]["instruction"])
+    novelty_filter.extend([e["instruction"] for e in examples])
+    for offset, data in store.iter_records(offsets=True):
+        novelty_filter.add(data["conversation"][0]["instruction"], offset=offset)
+    return novelty_filter
+
+
+def make_record(slot, data, usage):
+    record = { "conversation": data, "usage": usage.to_dict() }
+    if slot is not None:
+        record = { "id": slot, **record }
+    return record
+
+
+def add_record(store, pool, record, novelty_filter=None):
+    offset = store.append(record)
+    pool.add(record["conversation"][0], generated=True, offset=offset)
+    if novelty_filter is not None:
+        novelty_filter.stored(record["conversation"][0]["instruction"], offset)
+
+
+# Key of the partial log entry holding the instruction candidates left unused by a run (--n_candidates).
+CANDIDATES_KEY = "candidates"
+
+
+def partial_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + ".partial.jsonl"
+
+
+def pending_conversations(args, partial, pool, slots=None):
+    """
+    The conversations to generate: one per work queue item in `slots`, or the ones missing to reach
+    `args.n_data`. Conversations left unfinished in the `partial` log by an earlier run are resumed.
+    """
+    unfinished = {}
+    for data in partial.load():
+        if data.get("closed") or data["key"] == CANDIDATES_KEY:
+            continue
+        state = PartialConversation.from_dict(data)
+        # A finished state still in the log was stored right before the run stopped.
+        if state.stage() != "done":
+            unfinished[state.key] = state
+
+    if slots is not None:
+        return [unfinished.get(slot) or PartialConversation(args.turns, key=slot, slot=slot) for slot in slots]
+
+    n = max(0, args.n_data - pool.n_generated)
+    resumed = list(unfinished.values())[:n]
+    return resumed + [PartialConversation(args.turns, key=uuid.uuid4().hex) for _ in range(n - len(resumed))]
+
+
+def close_conversation(store, partial, pool, state, novelty_filter=None):
+    """
+    Move a finished conversation from the partial log to the checkpoint. Returns whether it was stored.
+    """
+    if state.abandoned:
+        print("[x] Failed")
+    else:
+        add_record(store, pool, make_record(state.slot, state.dialogue, state.usage), novelty_filter)
+    partial.append({ "key": state.key, "closed": True })
+    return not state.abandoned
+
+
+def generate_sequentially(agent, args, store, partial, pool, novelty_filter=None, slots=None):
+    """
+    Generate the conversations missing to reach `args.n_data`, or one per work queue item in `slots`
+    (stored under the item's id). Returns the slots that produced a conversation.
+
+    Every call is logged to `partial`, so a conversation interrupted by an error or a crash stays there and
+    is resumed from its last finished call.
+    """
+    conversations = pending_conversations(args, partial, pool, slots)
+    finished = []
+
+    for i, state in enumerate(tqdm(conversations)):
+        selected = None
+        if state.stage() == "first_instruction":
+            selected = select_examples(args, pool, position=pool.n_generated + i + 1)
+
+            print("= = = = = = Example = = = = = =")
+            print("\n> > >\n".join([s["instruction"] for s in selected]))
+            print("= = = = = = = = = = = = = = = =")
+
+        try:
+            with track_usage(state.usage):
+                agent.few_shot_generate(examples=selected, turns=args.turns, instruction_filter=novelty_filter,
+                                        state=state, on_step=lambda state: partial.append(state.to_dict()))
+        except Exception as e:
+            print(e)
+            print("[x] Failed")
+            continue
+
+        if close_conversation(store, partial, pool, state, novelty_filter):
+            finished.append(state.slot)
+
+    return finished
+
+
+async def generate_concurrently(agent, args, store, partial, pool, novelty_filter=None, slots=None):
+    """
+    Keep `args.concurrency` conversations in flight. Turns inside a conversation stay sequential,
+    finished conversations are added to the example pool as soon as they complete.
+    """
+    conversations = pending_conversations(args, partial, pool, slots)
+    pending = iter(conversations)
+    progress = tqdm(total=len(conversations))
+    finished = []
+
+    async def worker():
+        for state in pending:
+            selected = None
+            if state.stage() == "first_instruction":
+                selected = select_examples(args, pool, position=pool.n_generated + 1)
+
+            try:
+                with track_usage(state.usage):
+                    await agent.afew_shot_generate(examples=selected, turns=args.turns, instruction_filter=novelty_filter,
+                                                   state=state, on_step=lambda state: partial.append(state.to_dict()))
+            except Exception as e:
+                print(e)
+                print("[x] Failed")
+                continue
+            finally:
+                progress.update(1)
+
+            if close_conversation(store, partial, pool, state, novelty_filter):
+                finished.append(state.slot)
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    progress.close()
+
+    return finished
+
+
+def run_generation_worker(agent, args, store, partial, pool, novelty_filter=None):
+    """
+    Generate one conversation per item of the shared work queue, whose items are the slots 0..n_data-1.
+    """
+    queue = work_queue_from_args(args)
+    queue.populate(range(args.n_data))
+    worker_id = args.worker_id or default_worker_id()
+
+    try:
+        if args.concurrency > 1:
+            asyncio.run(arun_worker(
+                queue, worker_id,
+                aprocess=lambda slots: generate_concurrently(agent, args, store, partial, pool, novelty_filter, slots),
+                lease_size=args.lease_size,
+                poll_interval=args.queue_poll_interval,
+            ))
+        else:
+            run_worker(
+                queue, worker_id,
+                process=lambda slots: generate_sequentially(agent, args, store, partial, pool, novelty_filter, slots),
+                lease_size=args.lease_size,
+                poll_interval=args.queue_poll_interval,
+            )
+    finally:
+        queue.close()
+
+
 def main(args):
     config = dotenv.dotenv_values(".env")
-    if args.llm == "claude":
+    if args.endpoints is not None:
+        # The endpoints file gives the keys.
+        api_key = None
+    elif args.llm == "claude":
         api_key = config["ANTHROPIC_API_KEY"]
-    else:
+    elif args.llm == "openai":
         api_key = config["OPENAI_API_KEY"]
+    else:
+        api_key = None
 
+    router = router_from_args(args, config, max_concurrency=args.concurrency)
+    cache = cache_from_args(args)
+    metrics = metrics_from_args(args)
+    rate_limiter = rate_limiter_from_args(args, max_concurrency=args.concurrency)
     agent = LLMDataGenerator(
         llm=args.llm,
         model_name=args.model_name,
-        api_key=api_key
+        api_key=api_key,
+        cache=cache,
+        agent=router if router is not None else fake_llm_from_args(args),
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+        retry=retry_policy_from_args(args),
+        context=context_from_args(args),
+        quality_gate=quality_gate_from_args(args),
+        n_candidates=args.n_candidates,
+        streaming=stream_policy_from_args(args),
+        turn_retries=args.turn_retries
     )
 
     with open(args.begin_examples_path, "r", encoding="utf8") as reader:
         examples = json.load(reader)
     
-    with open(args.saved_path, "r", encoding="utf8") as reader:
-        all_data = json.load(reader)
-    
-    target_num = args.n_data - len(all_data)
-    gen_examples = [data["conversation"][0] for data in all_data]
+    if args.queue_path is not None:
+        # Workers only write their own shard. merge.py builds 'saved_path' once the queue is drained.
+        store = CheckpointStore(worker_shard_path(args.saved_path, args.worker_id or default_worker_id()))
+    else:
+        store = CheckpointStore(args.checkpoint_path or default_checkpoint_path(args.saved_path))
+        store.import_json(args.saved_path)
+    # Generated examples stay in the checkpoint log, the pool only keeps their offsets.
+    pool = ExamplePool(examples, n_clusters=args.n_clusters, max_generated=args.max_pool_size,
+                       load=lambda offset: store.read(offset)["conversation"][0])
+    for offset, data in store.iter_records(offsets=True):
+        pool.add(data["conversation"][0], generated=True, offset=offset)
+    novelty_filter = build_novelty_filter(args, examples, store)
+    # Conversations in progress, keyed so that the last state of each one wins.
+    partial = CheckpointStore(partial_path(store.path), key=lambda data: data["key"])
+    for data in partial.load():
+        if data["key"] == CANDIDATES_KEY:
+            agent.candidates.extend(data["candidates"])
 
-    for i in tqdm(range(target_num)):
-        if len(all_data) + i + 1 <= args.warmup or not args.add_to_pool:
-            selected = ExampleSelector.random_select(examples, n_examples=args.n_examples)
+    try:
+        if args.queue_path is not None:
+            run_generation_worker(agent, args, store, partial, pool, novelty_filter)
+        elif args.concurrency > 1:
+            asyncio.run(generate_concurrently(agent, args, store, partial, pool, novelty_filter))
         else:
-            selected = ExampleSelector.random_select_with_generated(
-                real_examples=examples,
-                gen_examples=gen_examples,
-                n_examples=args.n_examples,
-            )
-
-        print("= = = = = = Example = = = = = =")
-        print("\n> > >\n".join([s["instruction"] for s in selected]))
-        print("= = = = = = = = = = = = = = = =")
-
-        try:
-            data = agent.few_shot_generate(examples=selected, turns=3)
-        except:
-            print("[x] Failed")
-            continue
-
-        if not len(data):
-            print("[x] Failed")
-            continue
-
-        all_data.append({ "conversation": data })
-        gen_examples.append(data[0])
+            generate_sequentially(agent, args, store, partial, pool, novelty_filter)
+    finally:
+        store.close()
+        if args.queue_path is None:
+            store.compact(args.saved_path)
+        # Unused candidates were already paid for, the next run starts with them.
+        unfinished = [data for data in partial.load() if not data.get("closed") and data["key"] != CANDIDATES_KEY]
+        if agent.candidates:
+            print(f"Kept {len(agent.candidates)} unused instruction candidates for the next run")
+            unfinished.append({ "key": CANDIDATES_KEY, "candidates": list(agent.candidates) })
+        partial.rewrite(unfinished)
 
-        with open(args.saved_path, "w", encoding="utf8") as writer:
-            json.dump(all_data, writer, indent="\t", ensure_ascii=False)    
+        if novelty_filter is not None:
+            print(f"Rejected {novelty_filter.n_rejected} near-duplicate instructions")
+        if agent.quality_gate is not None:
+            print(f"Quality gate: {agent.quality_gate.stats()}")
+        if cache is not None:
+            print(f"Cache: {cache.stats()}")
+            cache.close()
+        metrics.export()
+        print(f"Rate limiter: {rate_limiter.stats()}")
+        if router is not None:
+            print(f"Endpoints: {router.stats()}")
+            router.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--llm", choices=["claude", "openai"], default="claude")
+    parser.add_argument("--llm", choices=provider_names(), default="claude")
     parser.add_argument("--model_name", choices=["claude-3-opus-20240229", "gpt-4-0613", "gpt-4-0125-preview",
-                                                 "gpt-3.5-turbo-0125", "claude-3-sonnet-20240229"],
+                                                 "gpt-3.5-turbo-0125", "claude-3-sonnet-20240229", "fake"],
                         default="claude-3-sonnet-20240229")
     parser.add_argument("--begin_examples_path", type=str, required=True)
     parser.add_argument("--n_examples", type=int, default=6)
     parser.add_argument("--n_data", type=int, default=1)
     parser.add_argument("--warmup", type=int, default=10)
     parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--turn_retries", type=int, default=2,
+                        help="Retries of a failed or rejected call before its conversation is abandoned")
     parser.add_argument("--saved_path", type=str, required=True)
     parser.add_argument("--dot-env", type=str, default=".env")
     parser.add_argument("--add_to_pool", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of conversations generated at the same time")
+    parser.add_argument("--checkpoint_path", type=str, default=None,
+                        help="Append-only JSONL log of finished samples. Defaults to `saved_path` with a .ckpt.jsonl suffix")
+    parser.add_argument("--novelty_threshold", type=float, default=0.7,
+                        help="Reject a first instruction whose ROUGE-L against the pool reaches this value. 1 disables the check")
+    parser.add_argument("--novelty_ngram", type=int, default=2)
+    parser.add_argument("--example_sampling", choices=["uniform", "diverse"], default="uniform",
+                        help="diverse samples topic clusters uniformly so frequent topics don't snowball")
+    parser.add_argument("--n_clusters", type=int, default=64,
+                        help="Number of n-gram topic clusters of the example pool")
+    parser.add_argument("--max_pool_size", type=int, default=None,
+                        help="Keep a uniform reservoir sample of at most this many generated examples in the pool")
+    parser.add_argument("--n_candidates", type=int, default=1,
+                        help="First instructions asked for in one structured call, the extras start the next conversations")
+    add_cache_args(parser)
+    add_fake_llm_args(parser)
+    add_metrics_args(parser)
+    add_rate_limit_args(parser)
+    add_router_args(parser)
+    add_context_args(parser)
+    add_quality_args(parser)
+    add_streaming_args(parser)
+    add_worker_args(parser)
 
     args = parser.parse_args()
     print(args)
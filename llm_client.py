@@ -0,0 +1,267 @@
+import asyncio
+import time
+from cache import ResponseCache, sampling_params
+from context import ContextWindow, current_usage
+from metrics import CallMetrics, token_usage
+from providers import create_chat_model, provider_names
+from rate_limit import RateLimiter, RetryPolicy, classify_error, estimate_tokens
+from router import AllEndpointsUnavailable, Router
+from streaming import StreamAborted, StreamPolicy
+
+
+class LLMClient:
+    """
+    Owns the chat model (`self.agent`) of LLMDataGenerator and InstructionRewriter. Every model call goes
+    through `call_llm` / `acall_llm` so caching, instrumentation, rate limiting, retries and streaming are
+    handled in one place.
+    """
+    def _init_agent(self, llm, model_name, api_key, cache=None, agent=None, metrics=None,
+                    rate_limiter=None, retry=None, context=None, streaming=None):
+        self._validation(llm)
+
+        self.llm = llm
+        self.model_name = model_name
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else CallMetrics()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.context = context if context is not None else ContextWindow()
+        self.streaming = streaming if streaming is not None else StreamPolicy()
+
+        self.agent = agent if agent is not None else create_chat_model(llm, model_name, api_key)
+        # With a Router, every call is cached, rate limited and sent under the endpoint serving it. Prompts
+        # get prompt caching markers when one of the endpoints needs them, the others get them stripped.
+        self.router = self.agent if isinstance(self.agent, Router) else None
+        if self.router is None:
+            self.prompt_provider = llm
+        else:
+            self.prompt_provider = "claude" if any(endpoint.provider == "claude" for endpoint in self.router.endpoints) else None
+
+    def _validation(self, llm):
+        if not llm in provider_names():
+            raise ValueError(
+                f"The LLM {llm} doesn't exist"
+            )
+
+    def _cache_key(self, kind, prompt, attempt=0, endpoint=None):
+        agent = self.agent if endpoint is None else endpoint.agent
+        params = { **sampling_params(agent), **self.streaming.call_kwargs(kind) }
+        if attempt:
+            # A retry of a rejected output must not get the same output back from the cache.
+            params["attempt"] = attempt
+        if endpoint is None:
+            return ResponseCache.make_key(self.llm, self.model_name, prompt, params)
+        return ResponseCache.make_key(endpoint.provider, endpoint.model_name, prompt, params)
+
+    def _invoke(self, kind, agent, prompt):
+        kwargs = self.streaming.call_kwargs(kind)
+        if not self.streaming.stream:
+            return agent.invoke(prompt, **kwargs)
+
+        watcher = self.streaming.watch(kind)
+        stream = agent.stream(prompt, **kwargs)
+        try:
+            for chunk in stream:
+                watcher.add(chunk)
+        finally:
+            # Closing the stream early cancels the request.
+            stream.close()
+        return watcher.finish()
+
+    async def _ainvoke(self, kind, agent, prompt):
+        kwargs = self.streaming.call_kwargs(kind)
+        if not self.streaming.stream:
+            return await agent.ainvoke(prompt, **kwargs)
+
+        watcher = self.streaming.watch(kind)
+        stream = agent.astream(prompt, **kwargs)
+        try:
+            async for chunk in stream:
+                watcher.add(chunk)
+        finally:
+            await stream.aclose()
+        return watcher.finish()
+
+    def _should_retry(self, error, retries):
+        error_kind = classify_error(error)
+        if error_kind == "rate_limit" and self.router is None:
+            self.rate_limiter.on_rate_limited()
+        return error_kind is not None and retries < self.retry.max_retries
+
+    def _on_success(self, estimated_tokens, output):
+        input_tokens, output_tokens = token_usage(output)
+        self.rate_limiter.record_usage(estimated_tokens, input_tokens + output_tokens)
+        self.rate_limiter.on_success()
+
+        usage = current_usage()
+        if usage is not None:
+            usage.add(output)
+
+    def _call_direct(self, kind, prompt, attempt):
+        """
+        One try of a call to the client's own chat model. Returns the output and whether it came from the cache.
+        """
+        key = None if self.cache is None else self._cache_key(kind, prompt, attempt)
+        output = None if key is None else self.cache.get(key)
+        if output is not None:
+            return output, True
+
+        estimated_tokens = estimate_tokens(prompt)
+        self.rate_limiter.acquire(estimated_tokens)
+        output = self._invoke(kind, self.agent, prompt)
+        self._on_success(estimated_tokens, output)
+        if key is not None:
+            self.cache.put(key, output)
+        return output, False
+
+    async def _acall_direct(self, kind, prompt, attempt):
+        key = None if self.cache is None else self._cache_key(kind, prompt, attempt)
+        output = None if key is None else self.cache.get(key)
+        if output is not None:
+            return output, True
+
+        estimated_tokens = estimate_tokens(prompt)
+        await self.rate_limiter.aacquire(estimated_tokens)
+        try:
+            output = await self._ainvoke(kind, self.agent, prompt)
+        finally:
+            await self.rate_limiter.arelease()
+        self._on_success(estimated_tokens, output)
+        if key is not None:
+            self.cache.put(key, output)
+        return output, False
+
+    def _call_routed(self, kind, prompt, attempt):
+        """
+        One try of a call through the router, failing over to the next endpoint on endpoint errors.
+        """
+        tried, error = set(), None
+        while True:
+            endpoint = self.router.next_endpoint(tried, error)
+            endpoint_prompt = endpoint.prompt(prompt)
+            key = None if self.cache is None else self._cache_key(kind, endpoint_prompt, attempt, endpoint)
+            output = None if key is None else self.cache.get(key)
+            if output is not None:
+                return output, True
+
+            estimated_tokens = estimate_tokens(endpoint_prompt)
+            endpoint.rate_limiter.acquire(estimated_tokens)
+            endpoint.begin()
+            start = time.perf_counter()
+            try:
+                output = self._invoke(kind, endpoint.agent, endpoint_prompt)
+            except StreamAborted:
+                # The output was bad, not the endpoint.
+                raise
+            except Exception as e:
+                if not self.router.record_failure(endpoint, e):
+                    raise
+                error = e
+                continue
+            finally:
+                endpoint.end()
+
+            self.router.record_success(endpoint, time.perf_counter() - start, estimated_tokens, output)
+            usage = current_usage()
+            if usage is not None:
+                usage.add(output)
+            if key is not None:
+                self.cache.put(key, output)
+            return output, False
+
+    async def _acall_routed(self, kind, prompt, attempt):
+        tried, error = set(), None
+        while True:
+            endpoint = self.router.next_endpoint(tried, error)
+            endpoint_prompt = endpoint.prompt(prompt)
+            key = None if self.cache is None else self._cache_key(kind, endpoint_prompt, attempt, endpoint)
+            output = None if key is None else self.cache.get(key)
+            if output is not None:
+                return output, True
+
+            estimated_tokens = estimate_tokens(endpoint_prompt)
+            await endpoint.rate_limiter.aacquire(estimated_tokens)
+            endpoint.begin()
+            start = time.perf_counter()
+            try:
+                output = await self._ainvoke(kind, endpoint.agent, endpoint_prompt)
+            except StreamAborted:
+                raise
+            except Exception as e:
+                if not self.router.record_failure(endpoint, e):
+                    raise
+                error = e
+                continue
+            finally:
+                endpoint.end()
+                await endpoint.rate_limiter.arelease()
+
+            self.router.record_success(endpoint, time.perf_counter() - start, estimated_tokens, output)
+            usage = current_usage()
+            if usage is not None:
+                usage.add(output)
+            if key is not None:
+                self.cache.put(key, output)
+            return output, False
+
+    def call_llm(self, kind, prompt, attempt=0):
+        """
+        Send a prompt (a string or a list of messages) to the chat model and return its AIMessage.
+        `kind` names the call (e.g. "response") in the metrics. Retryable errors are retried with backoff.
+        `attempt` counts the earlier outputs of this prompt the caller rejected, each attempt is cached apart.
+        """
+        start = time.perf_counter()
+        call = self._call_direct if self.router is None else self._call_routed
+        retries = 0
+
+        try:
+            while True:
+                try:
+                    output, cached = call(kind, prompt, attempt)
+                except AllEndpointsUnavailable as e:
+                    if e.retry_after is None:
+                        raise
+                    # Waiting out the cooldown isn't a failed try, it doesn't use up a retry.
+                    time.sleep(e.retry_after)
+                    continue
+                except Exception as e:
+                    if not self._should_retry(e, retries):
+                        raise
+                    time.sleep(self.retry.delay(retries, e))
+                    retries += 1
+                    continue
+                break
+        except Exception as e:
+            self.metrics.record(kind, time.perf_counter() - start, retries=retries, error=e)
+            raise
+
+        self.metrics.record(kind, time.perf_counter() - start, message=output, retries=retries, cached=cached)
+        return output
+
+    async def acall_llm(self, kind, prompt, attempt=0):
+        start = time.perf_counter()
+        call = self._acall_direct if self.router is None else self._acall_routed
+        retries = 0
+
+        try:
+            while True:
+                try:
+                    output, cached = await call(kind, prompt, attempt)
+                except AllEndpointsUnavailable as e:
+                    if e.retry_after is None:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except Exception as e:
+                    if not self._should_retry(e, retries):
+                        raise
+                    await asyncio.sleep(self.retry.delay(retries, e))
+                    retries += 1
+                    continue
+                break
+        except Exception as e:
+            self.metrics.record(kind, time.perf_counter() - start, retries=retries, error=e)
+            raise
+
+        self.metrics.record(kind, time.perf_counter() - start, message=output, retries=retries, cached=cached)
+        return output
@@ -0,0 +1,43 @@
+import argparse
+import glob
+import os
+from checkpoint import CheckpointStore, write_json_list
+
+
+def default_shard_pattern(saved_path):
+    return os.path.splitext(saved_path)[0] + ".*.ckpt.jsonl"
+
+
+def merge_shards(shard_paths, output_path):
+    """
+    Merge the checkpoint shards written by workers into one JSON list sorted by id.
+
+    An id processed by more than one worker (e.g. after a lease was reclaimed) keeps its latest record,
+    unless only an earlier one has responses. Records without an id are kept as they are.
+    """
+    records, unkeyed = {}, []
+    for path in sorted(shard_paths):
+        for data in CheckpointStore(path).iter_records(repair=False):
+            if not "id" in data:
+                unkeyed.append(data)
+                continue
+            previous = records.get(data["id"])
+            if previous is None or "responses" in data or not "responses" in previous:
+                records[data["id"]] = data
+
+    all_data = [records[idx] for idx in sorted(records)] + unkeyed
+    write_json_list(all_data, output_path)
+    return all_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the worker shards of gen_data.py / rewrite.py into 'saved_path'")
+    parser.add_argument("--saved_path", type=str, required=True)
+    parser.add_argument("--shards", type=str, nargs="*", default=None,
+                        help="Shard files, defaults to every worker shard next to `saved_path`")
+
+    args = parser.parse_args()
+    shard_paths = args.shards if args.shards else glob.glob(default_shard_pattern(args.saved_path))
+
+    all_data = merge_shards(shard_paths, args.saved_path)
+    print(f"Merged {len(all_data)} records from {len(shard_paths)} shards")
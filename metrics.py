@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+TOKEN_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384]
+TTFT_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+THROUGHPUT_BUCKETS = [5, 10, 20, 40, 60, 80, 100, 150, 200, 400]
+
+
+def token_usage(message):
+    """
+    Input and output token counts of an AIMessage, from whichever field the provider filled in.
+    """
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+
+    metadata = getattr(message, "response_metadata", None) or {}
+    if "usage" in metadata:
+        usage = metadata["usage"]
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    if "token_usage" in metadata:
+        usage = metadata["token_usage"]
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return 0, 0
+
+
+def input_token_breakdown(message):
+    """
+    (cached, uncached) input tokens of an AIMessage, where cached tokens were read from the provider's prompt cache.
+    """
+    usage = getattr(message, "usage_metadata", None)
+    if usage and "input_token_details" in usage:
+        cached = usage["input_token_details"].get("cache_read", 0) or 0
+        return cached, usage.get("input_tokens", 0) - cached
+
+    metadata = getattr(message, "response_metadata", None) or {}
+    if "usage" in metadata:
+        usage = metadata["usage"]
+        cached = usage.get("cache_read_input_tokens", 0) or 0
+        return cached, usage.get("input_tokens", 0) + (usage.get("cache_creation_input_tokens", 0) or 0)
+    if "token_usage" in metadata:
+        usage = metadata["token_usage"]
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+        return cached, usage.get("prompt_tokens", 0) - cached
+
+    input_tokens, _ = token_usage(message)
+    return 0, input_tokens
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile.
+        """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets + [float("inf")], self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": { str(bound): n for bound, n in zip(self.buckets + ["+Inf"], self.counts) },
+        }
+
+
+class KindStats:
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.cached_input_tokens = 0
+        self.failures = {}
+        self.aborted = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.input_tokens = Histogram(TOKEN_BUCKETS)
+        self.output_tokens = Histogram(TOKEN_BUCKETS)
+        self.ttft = Histogram(TTFT_BUCKETS)
+        self.tokens_per_second = Histogram(THROUGHPUT_BUCKETS)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "cached_input_tokens": self.cached_input_tokens,
+            "failures": dict(self.failures),
+            "aborted": dict(self.aborted),
+            "latency_seconds": self.latency.to_dict(),
+            "input_tokens": self.input_tokens.to_dict(),
+            "output_tokens": self.output_tokens.to_dict(),
+            "ttft_seconds": self.ttft.to_dict(),
+            "output_tokens_per_second": self.tokens_per_second.to_dict(),
+        }
+
+
+class CallMetrics:
+    """
+    Per call kind (e.g. "first_instruction", "response") latency, token, retry and failure statistics.
+
+    When `json_path` / `prometheus_path` are set the summary is exported there at most every
+    `export_interval` seconds while recording, and once more by `export()` at the end of a run.
+    """
+    def __init__(self, json_path=None, prometheus_path=None, export_interval=30):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.export_interval = export_interval
+        self.kinds = {}
+        self.started = time.time()
+        self._last_export = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, kind, seconds, message=None, retries=0, error=None, cached=False):
+        with self._lock:
+            stats = self.kinds.setdefault(kind, KindStats())
+            stats.calls += 1
+            stats.retries += retries
+            stats.latency.observe(seconds)
+
+            if cached:
+                stats.cache_hits += 1
+            if error is not None:
+                name = type(error).__name__
+                stats.failures[name] = stats.failures.get(name, 0) + 1
+                # Streamed calls cancelled by a stop check, by check.
+                reason = getattr(error, "abort_reason", None)
+                if reason is not None:
+                    stats.aborted[reason] = stats.aborted.get(reason, 0) + 1
+            if message is not None:
+                input_tokens, output_tokens = token_usage(message)
+                stats.input_tokens.observe(input_tokens)
+                stats.output_tokens.observe(output_tokens)
+                stats.cached_input_tokens += input_token_breakdown(message)[0]
+
+                timings = (message.response_metadata or {}).get("streaming")
+                if timings is not None and not cached:
+                    stats.ttft.observe(timings["ttft_seconds"])
+                    stats.tokens_per_second.observe(timings["tokens_per_second"])
+
+        if time.monotonic() - self._last_export >= self.export_interval:
+            self.export()
+
+    def summary(self):
+        with self._lock:
+            return {
+                "started": self.started,
+                "elapsed_seconds": time.time() - self.started,
+                "kinds": { kind: stats.to_dict() for kind, stats in self.kinds.items() },
+            }
+
+    def to_prometheus(self):
+        lines = []
+
+        def histogram(name, help_text, attr):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for kind, stats in self.kinds.items():
+                hist = getattr(stats, attr)
+                cumulative = 0
+                for bound, n in zip(hist.buckets + ["+Inf"], hist.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{kind="{kind}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{kind="{kind}"}} {hist.sum}')
+                lines.append(f'{name}_count{{kind="{kind}"}} {hist.count}')
+
+        def counter(name, help_text, value):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for kind, stats in self.kinds.items():
+                lines.append(f'{name}{{kind="{kind}"}} {value(stats)}')
+
+        with self._lock:
+            histogram("llm_call_duration_seconds", "Wall time of LLM calls", "latency")
+            histogram("llm_call_input_tokens", "Input tokens per LLM call", "input_tokens")
+            histogram("llm_call_output_tokens", "Output tokens per LLM call", "output_tokens")
+            histogram("llm_call_ttft_seconds", "Time to first token of streamed LLM calls", "ttft")
+            histogram("llm_call_output_tokens_per_second", "Output tokens per second of streamed LLM calls",
+                      "tokens_per_second")
+            counter("llm_call_retries_total", "Retries of LLM calls", lambda stats: stats.retries)
+            counter("llm_call_cache_hits_total", "LLM calls answered from the response cache", lambda stats: stats.cache_hits)
+            counter("llm_call_cached_input_tokens_total", "Input tokens read from the provider prompt cache",
+                    lambda stats: stats.cached_input_tokens)
+
+            lines.append("# HELP llm_call_failures_total Failed LLM calls by error type")
+            lines.append("# TYPE llm_call_failures_total counter")
+            for kind, stats in self.kinds.items():
+                for error, n in stats.failures.items():
+                    lines.append(f'llm_call_failures_total{{kind="{kind}",error="{error}"}} {n}')
+
+            lines.append("# HELP llm_call_aborted_total Streamed LLM calls cancelled by a stop check")
+            lines.append("# TYPE llm_call_aborted_total counter")
+            for kind, stats in self.kinds.items():
+                for reason, n in stats.aborted.items():
+                    lines.append(f'llm_call_aborted_total{{kind="{kind}",check="{reason}"}} {n}')
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write_atomic(path, content):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as writer:
+            writer.write(content)
+        os.replace(tmp_path, path)
+
+    def export(self):
+        self._last_export = time.monotonic()
+        if self.json_path is not None:
+            self._write_atomic(self.json_path, json.dumps(self.summary(), indent="\t", ensure_ascii=False))
+        if self.prometheus_path is not None:
+            self._write_atomic(self.prometheus_path, self.to_prometheus())
+
+
+def add_metrics_args(parser):
+    parser.add_argument("--metrics_path", type=str, default=None,
+                        help="Write a JSON summary of LLM call latency, tokens, retries and failures")
+    parser.add_argument("--prometheus_path", type=str, default=None,
+                        help="Write the same metrics as a Prometheus textfile")
+    parser.add_argument("--metrics_interval", type=float, default=30,
+                        help="Seconds between metric exports during the run")
+
+
+def metrics_from_args(args):
+    return CallMetrics(
+        json_path=args.metrics_path,
+        prometheus_path=args.prometheus_path,
+        export_interval=args.metrics_interval,
+    )
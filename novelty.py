@@ -0,0 +1,167 @@
+import re
+import zlib
+import numpy as np
+
+_IGNORED = re.compile(r"[\s\W_]+")
+_PRIME = (1 << 61) - 1
+
+
+def char_ngrams(text, n=2):
+    """
+    Character n-grams of `text` with whitespace and punctuation removed, which suits Chinese better
+    than whitespace tokenization.
+    """
+    text = _IGNORED.sub("", text.lower())
+    if len(text) <= n:
+        return { text } if text else set()
+    return { text[i:i + n] for i in range(len(text) - n + 1) }
+
+
+def rouge_l(candidate, reference):
+    """
+    Character-level ROUGE-L F-measure.
+    """
+    a = _IGNORED.sub("", candidate.lower())
+    b = _IGNORED.sub("", reference.lower())
+    if not a or not b:
+        return 0.0
+
+    if len(a) < len(b):
+        a, b = b, a
+    previous = [0] * (len(b) + 1)
+    for ca in a:
+        current = [0]
+        for j, cb in enumerate(b):
+            current.append(previous[j] + 1 if ca == cb else max(previous[j + 1], current[j]))
+        previous = current
+
+    lcs = previous[-1]
+    if not lcs:
+        return 0.0
+    precision, recall = lcs / len(a), lcs / len(b)
+    return 2 * precision * recall / (precision + recall)
+
+
+class NoveltyFilter:
+    """
+    Self-instruct style novelty gate. An instruction is novel when its ROUGE-L score against every instruction
+    already in the pool is below `threshold`.
+
+    Candidates are retrieved with MinHash-LSH over character n-grams, so only a handful of instructions are
+    scored with ROUGE-L no matter how large the pool grows.
+
+    Instructions added with an `offset` only keep that offset in memory and are read back with `load(offset)`
+    when they are a candidate. Instructions accepted by `__call__` are kept as text until `stored` gives
+    the offset of their record. What remains in memory per instruction is its place in the LSH buckets, one
+    hashed key per band (about 2 KB with the default 32 bands).
+    """
+    def __init__(self, threshold=0.7, ngram=2, num_perm=128, bands=32, seed=42, load=None):
+        if num_perm % bands:
+            raise ValueError(
+                f"num_perm {num_perm} should be divisible by bands {bands}"
+            )
+
+        self.threshold = threshold
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = num_perm // bands
+
+        rng = np.random.RandomState(seed)
+        # crc32 hashes are below 2 ** 32, so (a * h + b) never overflows uint64.
+        self._a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+        self.load = load
+        self.items = []
+        self._unstored = {}
+        self._buckets = [{} for _ in range(bands)]
+        self.n_rejected = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _text(self, idx):
+        item = self.items[idx]
+        return self.load(item) if isinstance(item, int) else item
+
+    def _signature(self, grams):
+        hashes = np.fromiter((zlib.crc32(g.encode("utf8")) for g in grams), dtype=np.uint64, count=len(grams))
+        values = (self._a[None, :] * hashes[:, None] + self._b[None, :]) % _PRIME
+        return values.min(axis=0)
+
+    def _band_keys(self, signature):
+        # A hash collision only adds a candidate, which ROUGE-L then scores.
+        return [hash(signature[i * self.rows:(i + 1) * self.rows].tobytes()) for i in range(self.bands)]
+
+    def _candidates(self, keys):
+        candidates = set()
+        for bucket, key in zip(self._buckets, keys):
+            # Most buckets hold a single instruction, stored as its index rather than a list.
+            entry = bucket.get(key, ())
+            candidates.update((entry,) if isinstance(entry, int) else entry)
+        return candidates
+
+    def _keys(self, text):
+        grams = char_ngrams(text, self.ngram)
+        if not grams:
+            return None
+        return self._band_keys(self._signature(grams))
+
+    def most_similar(self, text):
+        keys = self._keys(text)
+        if keys is None:
+            return 0.0, None
+
+        best_score, best_text = 0.0, None
+        for idx in self._candidates(keys):
+            other = self._text(idx)
+            score = rouge_l(text, other)
+            if score > best_score:
+                best_score, best_text = score, other
+        return best_score, best_text
+
+    def add(self, text, offset=None):
+        """
+        Add `text`, or only its `offset` when the filter has a `load` function.
+        """
+        keys = self._keys(text)
+        idx = len(self.items)
+        self.items.append(offset if offset is not None and self.load is not None else text)
+        if keys is None:
+            return idx
+
+        for bucket, key in zip(self._buckets, keys):
+            entry = bucket.get(key)
+            if entry is None:
+                bucket[key] = idx
+            elif isinstance(entry, int):
+                bucket[key] = [entry, idx]
+            else:
+                entry.append(idx)
+        return idx
+
+    def stored(self, text, offset):
+        """
+        Replace the text of an instruction accepted by `__call__` with the `offset` of its stored record.
+        """
+        idx = self._unstored.pop(text, None)
+        if idx is not None and self.load is not None:
+            self.items[idx] = offset
+
+    def extend(self, texts):
+        for text in texts:
+            self.add(text)
+
+    def is_novel(self, text):
+        score, _ = self.most_similar(text)
+        return score < self.threshold
+
+    def __call__(self, text):
+        """
+        Add `text` to the pool if it is novel. Returns whether it was accepted.
+        """
+        if not self.is_novel(text):
+            self.n_rejected += 1
+            return False
+        self._unstored[text] = self.add(text)
+        return True
@@ -1,10 +1,75 @@
-from langchain.prompts.prompt import PromptTemplate
+FIRST_INSTRUCTION_V3_HEAD = (
+    "我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
+    "以下為一些範例的指示：\n\n"
+)
+FIRST_INSTRUCTION_V3_TAIL = (
+    "\n\n"
+    "請仿造這些指示範例，生成一個全新的指令。\n"
+    "這個指示必須要是繁體中文。我會把你的回應直接貼給對方，請不要在回應中與我互動，也不要將 '範例指示' 和 '新的指示' 加入在你的回應中。\n\n"
+    "新的指示：\n"
+)
+MULTI_TURN_V3_HEAD = (
+    "我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
+    "以下是我和 AI System 的對話：\n\n"
+)
+MULTI_TURN_V3_TAIL = (
+    "\n\n"
+    "請基於我們的對話內容，幫我構思下一輪的指示。這個指示必須和我們的對話主題相關，或者是針對 AI System 的回覆做進一步詢問。這個指示裡面最多只能有一個問題。\n"
+    "這個指示必須要是繁體中文。而你的回應不需要包含針對對話內容的評論，也不要將 '下一輪的指示' 加入到回應中。我會把你的回應直接貼給對方。\n\n"
+    "下一輪的指示："
+)
+
+
+def _prompt_template(**kwargs):
+    # langchain takes about half a second to import, so only the PromptTemplate builders below pay for it.
+    from langchain.prompts.prompt import PromptTemplate
+    return PromptTemplate(**kwargs)
+
+def render_first_instruction_prompt_v3(examples):
+    """
+    The text of `create_first_instruction_prompt_v3(examples).format()`, filled into the precompiled parts.
+    Examples are pasted as they are, so braces in them aren't parsed as template variables.
+    """
+    return FIRST_INSTRUCTION_V3_HEAD + "\n\n".join([f"指示範例: {e['instruction']}" for e in examples]) + FIRST_INSTRUCTION_V3_TAIL
+
+INSTRUCTION_CANDIDATES_TAIL = (
+    "\n\n"
+    "請仿造這些指示範例，生成 {n_candidates} 個全新的指令，彼此的主題和任務類型都要不同。\n"
+    "這些指示必須要是繁體中文。如果指示需要額外的輸入（例如一段文章、程式碼或表格），請把它放在 input 中，否則 input 為 None。\n\n"
+    "{format}"
+)
+
+def render_instruction_candidates_prompt(examples, n_candidates, format_instructions):
+    """
+    The first instruction prompt asking for `n_candidates` instructions (with inputs) in one structured reply.
+    """
+    example_sentences = "\n\n".join([f"指示範例: {e['instruction']}" for e in examples])
+    return FIRST_INSTRUCTION_V3_HEAD + example_sentences + INSTRUCTION_CANDIDATES_TAIL.format(
+        n_candidates=n_candidates, format=format_instructions
+    )
+
+def _multi_turn_v3_turn(data):
+    return f"我:\n{data['instruction']}\n\nAI System:\n{data['output']}"
+
+def multi_turn_prompt_v3_parts(dialogue):
+    """
+    `render_multi_turn_prompt_v3(dialogue)` split after the header and every turn, so the parts of one call
+    are the leading parts of the next call once another turn is added.
+    """
+    turns = [_multi_turn_v3_turn(data) for data in dialogue]
+    return [MULTI_TURN_V3_HEAD] + [turn + "\n\n" for turn in turns[:-1]] + [turns[-1] + MULTI_TURN_V3_TAIL]
+
+def render_multi_turn_prompt_v3(dialogue):
+    """
+    The text of `create_multi_turn_prompt_v3(dialogue).format()`, filled into the precompiled parts.
+    """
+    return "".join(multi_turn_prompt_v3_parts(dialogue))
 
 def create_first_instruction_prompt(parser, examples, input_variables=[]):
     # example_sentences = "\n".join([f"問題 {i + 1}: {e['instruction']}" for i, e in enumerate(examples)])
     example_sentences = "\n".join([f"問題: {e['instruction']}" for i, e in enumerate(examples)])
 
-    prompt_template = PromptTemplate(
+    prompt_template = _prompt_template(
         template="以下是一系列的問題：\n\n" + example_sentences + "\n\n" + "請仿造這些指示範例，生成一個新的指示。\n" + "{format}",
         input_variables=input_variables,
         partial_variables={ "format": parser.get_format_instructions() }
@@ -16,7 +81,7 @@ def create_first_instruction_prompt_v2(examples, input_variables=[]):
     # example_sentences = "\n".join([f"問題 {i + 1}: {e['instruction']}" for i, e in enumerate(examples)])
     example_sentences = "\n\n".join([f"指示範例: {e['instruction']}" for i, e in enumerate(examples)])
 
-    prompt_template = PromptTemplate(
+    prompt_template = _prompt_template(
         template="我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
                  "以下為一些範例的指示：\n\n" + example_sentences + "\n\n"
                  "請仿造這些指示範例，生成一個全新的指令。這個指令必須要是繁體中文。\n\n"
@@ -29,12 +94,8 @@ def create_first_instruction_prompt_v2(examples, input_variables=[]):
 def create_first_instruction_prompt_v3(examples, input_variables=[]):
     example_sentences = "\n\n".join([f"指示範例: {e['instruction']}" for i, e in enumerate(examples)])
 
-    prompt_template = PromptTemplate(
-        template="我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
-                 "以下為一些範例的指示：\n\n" + example_sentences + "\n\n"
-                 "請仿造這些指示範例，生成一個全新的指令。\n"
-                 "這個指示必須要是繁體中文。我會把你的回應直接貼給對方，請不要在回應中與我互動，也不要將 '範例指示' 和 '新的指示' 加入在你的回應中。\n\n"
-                 "新的指示：\n",
+    prompt_template = _prompt_template(
+        template=FIRST_INSTRUCTION_V3_HEAD + example_sentences + FIRST_INSTRUCTION_V3_TAIL,
         input_variables=input_variables,
     )
 
@@ -43,7 +104,7 @@ def create_first_instruction_prompt_v3(examples, input_variables=[]):
 def create_multi_turn_prompt(dialogue):
     multi_turn = "\n\n".join([f"我:\n{data['instruction']}\n\n對方:\n{data['output']}" for data in dialogue])
         
-    prompt_template = PromptTemplate(
+    prompt_template = _prompt_template(
         template="我現在在和另一個人進行對話，以下為我們的對話內容:\n\n" + multi_turn +
                     "\n\n請幫我構思接下來我下一句要怎麼回應，才能讓對話進行下去，並且主題必須要和我們現在討論的主題連貫。這個問題裡面最多只能有一個問題。\n"
                     "我會把你的回應直接貼給對方。",
@@ -55,7 +116,7 @@ def create_multi_turn_prompt(dialogue):
 def create_multi_turn_prompt_v2(dialogue, input_variables=[]):
     multi_turn = "\n\n".join([f"我:\n{data['instruction']}\n\nAI System:\n{data['output']}" for data in dialogue])
 
-    prompt_template = PromptTemplate(
+    prompt_template = _prompt_template(
         template="我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
                  "以下是我和 AI System 的對話：\n\n" + multi_turn + "\n\n"
                  "請基於我們的對話內容，幫我構思下一輪的指示。這個指示必須和我們的對話主題相關，或者是針對 AI System 的回覆做進一步詢問。這個指示裡面最多只能有一個問題。\n"
@@ -67,15 +128,11 @@ def create_multi_turn_prompt_v2(dialogue, input_variables=[]):
     return prompt_template
 
 def create_multi_turn_prompt_v3(dialogue, input_variables=[]):
-    multi_turn = "\n\n".join([f"我:\n{data['instruction']}\n\nAI System:\n{data['output']}" for data in dialogue])
+    multi_turn = "\n\n".join([_multi_turn_v3_turn(data) for data in dialogue])
 
-    prompt_template = PromptTemplate(
-        template="我要你創造出一個能夠輸入給 AI Systems (e.g., GPT4 and Antropic) 的指示\n"
-                 "以下是我和 AI System 的對話：\n\n" + multi_turn + "\n\n"
-                 "請基於我們的對話內容，幫我構思下一輪的指示。這個指示必須和我們的對話主題相關，或者是針對 AI System 的回覆做進一步詢問。這個指示裡面最多只能有一個問題。\n"
-                 "這個指示必須要是繁體中文。而你的回應不需要包含針對對話內容的評論，也不要將 '下一輪的指示' 加入到回應中。我會把你的回應直接貼給對方。\n\n"
-                 "下一輪的指示：",
+    prompt_template = _prompt_template(
+        template=MULTI_TURN_V3_HEAD + multi_turn + MULTI_TURN_V3_TAIL,
         input_variables=input_variables
     )
 
-    return prompt_template    
\ No newline at end of file
+    return prompt_template
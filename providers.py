@@ -0,0 +1,88 @@
+import functools
+
+
+_PROVIDERS = {}
+
+
+def register_provider(name):
+    """
+    Register `factory(model_name, api_key, timeout=60, http_client=None, http_async_client=None)` as the chat
+    model backend of `--llm name`. Factories import their client library themselves, so a run only imports
+    the provider it uses. The httpx clients, when given, are shared keep-alive connection pools.
+    """
+    def register(factory):
+        _PROVIDERS[name] = factory
+        return factory
+    return register
+
+
+def provider_names():
+    return list(_PROVIDERS)
+
+
+def create_chat_model(llm, model_name, api_key, **options):
+    if not llm in _PROVIDERS:
+        raise ValueError(
+            f"The LLM {llm} doesn't exist"
+        )
+    return _PROVIDERS[llm](model_name, api_key, **options)
+
+
+def restore_cache_control(messages, formatted_messages):
+    """
+    Put the `cache_control` marks of the text blocks of `messages` back on the Anthropic request messages
+    `formatted_messages`, which langchain-anthropic 0.1 builds without them.
+    """
+    marks = [
+        block for message in messages if isinstance(message.content, list)
+        for block in message.content if isinstance(block, dict) and "cache_control" in block
+    ]
+    for message in formatted_messages:
+        if not marks:
+            return
+        if not isinstance(message["content"], list):
+            continue
+        for block in message["content"]:
+            if marks and isinstance(block, dict) and block.get("text") == marks[0].get("text"):
+                block["cache_control"] = marks.pop(0)["cache_control"]
+
+
+@functools.lru_cache(maxsize=None)
+def _chat_anthropic_class():
+    from langchain_anthropic import ChatAnthropic
+
+    class CacheControlChatAnthropic(ChatAnthropic):
+        """
+        ChatAnthropic sending the `cache_control` marks of `--prompt_cache` along with the request.
+        """
+        def _format_params(self, *, messages, stop=None, **kwargs):
+            params = super()._format_params(messages=messages, stop=stop, **kwargs)
+            restore_cache_control(messages, params["messages"])
+            return params
+
+    return CacheControlChatAnthropic
+
+
+@register_provider("claude")
+def _claude(model_name, api_key, timeout=60, http_client=None, http_async_client=None):
+    agent = _chat_anthropic_class()(model=model_name, anthropic_api_key=api_key, default_request_timeout=timeout, max_retries=0)
+    if http_client is not None:
+        # langchain-anthropic has no http_client option, its clients are private attributes.
+        import anthropic
+        client_params = { "api_key": api_key, "base_url": agent.anthropic_api_url, "max_retries": 0, "timeout": timeout }
+        agent.__dict__["_client"] = anthropic.Client(http_client=http_client, **client_params)
+        agent.__dict__["_async_client"] = anthropic.AsyncClient(http_client=http_async_client, **client_params)
+    return agent
+
+
+@register_provider("openai")
+def _openai(model_name, api_key, timeout=60, http_client=None, http_async_client=None):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=model_name, openai_api_key=api_key, timeout=timeout, max_retries=0,
+                      http_client=http_client, http_async_client=http_async_client)
+
+
+@register_provider("fake")
+def _fake(model_name, api_key, **options):
+    from fake_llm import FakeChatModel
+    return FakeChatModel(model_name=model_name)
@@ -0,0 +1,144 @@
+import re
+from novelty import char_ngrams
+
+STAGES = ["instruction", "response"]
+
+# Frequent characters that only appear in Simplified Chinese. Their share among the CJK characters of a text
+# tells Simplified from Traditional without a conversion table.
+SIMPLIFIED_ONLY = set(
+    "们这说为国时会来对过还没发经样问题实现关开学长见让给进动应则东车门书认识语话请间买卖钱电脑网络欢难边头讲"
+    "该爱觉确选择数处设计务产业总结报专历简单备写观热带员质华区级场术标变资复杂转达运输"
+)
+
+_CJK = re.compile(r"[㐀-鿿豈-﫿]")
+_LATIN_WORD = re.compile(r"[A-Za-z]+")
+
+REFUSAL_PATTERNS = re.compile(
+    r"^\s*(很?抱歉|對不起|对不起|我無法|我无法|我不能|作為一個?\s*(AI|人工智慧|語言模型)|作为一个?\s*(AI|人工智能|语言模型)|"
+    r"I'm sorry|I am sorry|I cannot|I can't|As an AI)",
+    re.IGNORECASE
+)
+
+# Instructions are the user's voice, where 「抱歉」 or 「我不能」 are ordinary openings. Only the assistant's voice
+# is a refusal there.
+INSTRUCTION_REFUSAL_PATTERNS = re.compile(
+    r"^\s*(很?抱歉[，,]?\s*我(無法|无法|不能)(協助|协助|提供)|作為一個?\s*(AI|人工智慧|語言模型)|"
+    r"作为一个?\s*(AI|人工智能|语言模型)|As an AI)",
+    re.IGNORECASE
+)
+
+# Headings of the generation prompts in prompts.py. A generated instruction containing them copied the prompt.
+PROMPT_LEAK_PATTERNS = re.compile(r"指示範例|新的指示|下一輪的指示|範例指示|AI System:|以下為一些範例|以下是我和 AI System 的對話")
+
+
+class QualityRule:
+    """
+    A named check `check(text, examples) -> bool` (True when the text is fine) run at the given stages.
+    """
+    def __init__(self, name, check, stages=STAGES):
+        self.name = name
+        self.check = check
+        self.stages = stages
+
+
+def cjk_ratio(text):
+    """
+    Share of CJK characters among CJK characters and Latin words, which weighs a Chinese character
+    about as much as an English word.
+    """
+    cjk = len(_CJK.findall(text))
+    units = cjk + len(_LATIN_WORD.findall(text))
+    return cjk / units if units else 0.0
+
+
+def simplified_ratio(text):
+    cjk = _CJK.findall(text)
+    if not cjk:
+        return 0.0
+    return sum(1 for char in cjk if char in SIMPLIFIED_ONLY) / len(cjk)
+
+
+def is_echo(text, examples, threshold=0.8, ngram=2):
+    """
+    Whether `text` is (nearly) a copy of one of the few-shot `examples`, by character n-gram Jaccard similarity.
+    """
+    grams = char_ngrams(text, ngram)
+    if not grams:
+        return False
+    for example in examples or []:
+        other = char_ngrams(example["instruction"], ngram)
+        if other and len(grams & other) / len(grams | other) >= threshold:
+            return True
+    return False
+
+
+def default_rules(min_instruction_chars=4, max_instruction_chars=2000, min_response_chars=2,
+                  min_instruction_cjk_ratio=0.2, min_response_cjk_ratio=0.05, max_simplified_ratio=0.02):
+    return [
+        QualityRule("empty", lambda text, examples: bool(text.strip())),
+        QualityRule("instruction_length",
+                    lambda text, examples: min_instruction_chars <= len(text.strip()) <= max_instruction_chars,
+                    stages=["instruction"]),
+        QualityRule("response_length", lambda text, examples: len(text.strip()) >= min_response_chars,
+                    stages=["response"]),
+        QualityRule("not_chinese", lambda text, examples: cjk_ratio(text) >= min_instruction_cjk_ratio,
+                    stages=["instruction"]),
+        QualityRule("not_chinese", lambda text, examples: cjk_ratio(text) >= min_response_cjk_ratio,
+                    stages=["response"]),
+        # Responses are converted with s2twp by format.py, only instructions (the few-shot pool) must be Traditional.
+        QualityRule("simplified_chinese", lambda text, examples: simplified_ratio(text) <= max_simplified_ratio,
+                    stages=["instruction"]),
+        QualityRule("refusal", lambda text, examples: not REFUSAL_PATTERNS.search(text[:100]), stages=["response"]),
+        QualityRule("refusal", lambda text, examples: not INSTRUCTION_REFUSAL_PATTERNS.search(text[:100]),
+                    stages=["instruction"]),
+        QualityRule("prompt_leak", lambda text, examples: not PROMPT_LEAK_PATTERNS.search(text),
+                    stages=["instruction"]),
+        QualityRule("echo", lambda text, examples: not is_echo(text, examples), stages=["instruction"]),
+    ]
+
+
+class QualityGate:
+    """
+    Cheap local checks on every generated instruction and response, so a conversation whose first
+    instruction is bad is cut after one call instead of paying for its responses and follow-up turns.
+
+    Rejections are counted per rule. Rules are pluggable: pass `rules`, or `add_rule` to the defaults.
+    """
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else default_rules()
+        self.checked = { stage: 0 for stage in STAGES }
+        self.rejections = {}
+
+    def add_rule(self, rule):
+        self.rules.append(rule)
+
+    def check(self, text, stage, examples=None):
+        """
+        The name of the first rule `text` fails at `stage`, or None when it passes.
+        """
+        self.checked[stage] = self.checked.get(stage, 0) + 1
+        for rule in self.rules:
+            if stage in rule.stages and not rule.check(text, examples):
+                self.rejections[rule.name] = self.rejections.get(rule.name, 0) + 1
+                return rule.name
+        return None
+
+    def stats(self):
+        return {
+            "checked": dict(self.checked),
+            "rejections": dict(self.rejections),
+        }
+
+
+def add_quality_args(parser):
+    parser.add_argument("--skip_quality_rules", type=str, nargs="*", default=[],
+                        help="Names of quality gate rules to turn off, or 'all' to turn the gate off")
+    parser.add_argument("--max_simplified_ratio", type=float, default=0.02,
+                        help="Reject instructions whose share of Simplified-only characters exceeds this")
+
+
+def quality_gate_from_args(args):
+    if "all" in args.skip_quality_rules:
+        return None
+    rules = default_rules(max_simplified_ratio=args.max_simplified_ratio)
+    return QualityGate([rule for rule in rules if not rule.name in args.skip_quality_rules])
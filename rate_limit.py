@@ -0,0 +1,231 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from cache import content_text, normalize_messages
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate_per_minute`. Callers reserve tokens up front and sleep off the debt,
+    so waiters are served in arrival order.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, amount=1):
+        delay = self._reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, amount=1):
+        delay = self._reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def available(self):
+        """
+        Tokens left right now, negative while callers sleep off a debt.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            return self.tokens
+
+    def take(self, amount=1):
+        """
+        Reserve `amount` without waiting, possibly going into debt.
+        """
+        self._reserve(amount)
+
+    def adjust(self, amount):
+        """
+        Take `amount` more tokens (or give some back when negative) once the real cost of a call is known.
+        """
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+def estimate_tokens(prompt):
+    # Roughly one token per character for Chinese text, which overestimates English.
+    return sum(len(content_text(content)) for _, content in normalize_messages(prompt))
+
+
+class RateLimiter:
+    """
+    Client-side limits on requests/min, tokens/min and in-flight async requests for one provider + model.
+
+    The concurrency limit adapts (AIMD): it is halved when a call gets rate limited and grows by one after
+    `limit` successful calls, up to `max_concurrency`.
+    """
+    def __init__(self, rpm=None, tpm=None, max_concurrency=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._successes = 0
+        self._condition = None
+
+    def acquire(self, estimated_tokens):
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None:
+            self.tokens.acquire(estimated_tokens)
+
+    async def aacquire(self, estimated_tokens):
+        if self.max_concurrency is not None:
+            if self._condition is None:
+                self._condition = asyncio.Condition()
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < self.limit)
+                self.in_flight += 1
+
+        if self.requests is not None:
+            await self.requests.aacquire(1)
+        if self.tokens is not None:
+            await self.tokens.aacquire(estimated_tokens)
+
+    async def arelease(self):
+        if self.max_concurrency is None:
+            return
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        if self.tokens is not None and used_tokens:
+            self.tokens.adjust(used_tokens - estimated_tokens)
+
+    def on_success(self):
+        if self.max_concurrency is None or self.limit >= self.max_concurrency:
+            return
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            self.limit += 1
+
+    def on_rate_limited(self):
+        self.rate_limited += 1
+        self._successes = 0
+        if self.max_concurrency is not None:
+            self.limit = max(1, self.limit // 2)
+
+    def stats(self):
+        return {
+            "rate_limited": self.rate_limited,
+            "concurrency_limit": self.limit,
+        }
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff for retryable errors, honoring Retry-After when the provider sends it.
+    """
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        wait = retry_after(error)
+        if wait is not None:
+            delay = max(delay, min(wait, self.max_delay))
+        return delay
+
+
+def classify_error(error):
+    """
+    "rate_limit", "server", "timeout" or "connection" for errors worth retrying, None otherwise.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    name = type(error).__name__
+
+    if status == 429 or "RateLimit" in name:
+        return "rate_limit"
+    if (isinstance(status, int) and status >= 500) or "InternalServer" in name or "Overloaded" in name:
+        return "server"
+    if status == 408 or "Timeout" in name:
+        return "timeout"
+    if "Connection" in name:
+        return "connection"
+    return None
+
+
+def retry_after(error):
+    """
+    Seconds to wait according to the Retry-After headers of the error's response, if any.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider, model_name, rpm=None, tpm=None, max_concurrency=None):
+    """
+    The limiter shared by every client of `provider` + `model_name` in this process.
+    """
+    with _limiters_lock:
+        key = (provider, model_name)
+        if not key in _limiters:
+            _limiters[key] = RateLimiter(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+        return _limiters[key]
+
+
+def add_rate_limit_args(parser):
+    parser.add_argument("--rpm", type=int, default=None,
+                        help="Client-side limit on requests per minute to the model")
+    parser.add_argument("--tpm", type=int, default=None,
+                        help="Client-side limit on tokens per minute to the model")
+    parser.add_argument("--max_retries", type=int, default=5,
+                        help="Retries of rate limited, overloaded or timed out calls")
+    parser.add_argument("--retry_base_delay", type=float, default=1.0)
+    parser.add_argument("--retry_max_delay", type=float, default=60.0)
+
+
+def rate_limiter_from_args(args, max_concurrency=None):
+    return get_rate_limiter(args.llm, args.model_name, rpm=args.rpm, tpm=args.tpm, max_concurrency=max_concurrency)
+
+
+def retry_policy_from_args(args):
+    return RetryPolicy(max_retries=args.max_retries, base_delay=args.retry_base_delay, max_delay=args.retry_max_delay)
@@ -1,47 +1,63 @@
 import argparse
+import asyncio
 import dotenv
-import json
 import os
-import random
-from datasets import load_dataset
-from datetime import datetime
+import sys
 from evol_instruction import *
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from tqdm import tqdm
+from batch import BatchJobLog, BatchRewriter, add_batch_args, batch_backend_from_args
+from cache import add_cache_args, cache_from_args
+from checkpoint import CheckpointStore, default_checkpoint_path
+from context import add_context_args, context_from_args, track_usage
+from evolution import EvolutionEngine, add_evolution_args, evolution_engine_from_args
+from fake_llm import add_fake_llm_args, fake_llm_from_args
+from metrics import add_metrics_args, metrics_from_args
+from rate_limit import add_rate_limit_args, rate_limiter_from_args, retry_policy_from_args
+from streaming import add_streaming_args, stream_policy_from_args
+from llm_client import LLMClient
+from providers import provider_names
+from work_queue import add_worker_args, arun_worker, default_worker_id, run_worker, work_queue_from_args, worker_shard_path
+from router import add_router_args, router_from_args
 
-class InstructionRewriter:
-    def __init__(self, llm, model_name, api_key):
-        self._validation(llm)
-
-        self.llm = llm
-        self.model_name = model_name
-
-        if self.llm == "claude":
-            self.agent = ChatAnthropic(model=self.model_name, anthropic_api_key=api_key, default_request_timeout=60)
-        elif self.llm == "openai":
-            self.agent = ChatOpenAI(model=self.model_name, openai_api_key=api_key, timeout=60)
-
-    def _validation(self, llm):
-        if not llm in ["claude", "openai"]:
-            raise ValueError(
-                f"The LLM {llm} doesn't exist"
-            )
+class InstructionRewriter(LLMClient):
+    def __init__(self, llm, model_name, api_key, cache=None, agent=None, metrics=None, rate_limiter=None, retry=None,
+                 context=None, evolution=None, streaming=None):
+        self._init_agent(llm, model_name, api_key, cache=cache, agent=agent, metrics=metrics,
+                         rate_limiter=rate_limiter, retry=retry, context=context, streaming=streaming)
+        self.evolution = evolution if evolution is not None else EvolutionEngine()
     
     def rewrite(self, instruction, rewrite_func=createDeepenPrompt):
         prompt = rewrite_func(instruction)
-        output = self.agent.invoke(prompt)
+        output = self.call_llm("rewrite", prompt)
+        return output.content
+    
+    async def arewrite(self, instruction, rewrite_func=createDeepenPrompt):
+        prompt = rewrite_func(instruction)
+        output = await self.acall_llm("rewrite", prompt)
         return output.content
     
     def response_to_multi_turn_instruction(self, instructions):
-        prompt, responses = [], []
+        dialogue, responses = [], []
+        
+        for instruction in instructions:
+            dialogue.append({ "instruction": instruction })
+            prompt = self.context.to_messages(dialogue, provider=self.prompt_provider)
+            response = self.call_llm("response", prompt)
+            responses.append(response.content)
+            dialogue[-1]["output"] = response.content
+        
+        return responses
+    
+    async def aresponse_to_multi_turn_instruction(self, instructions):
+        dialogue, responses = [], []
         
         for instruction in instructions:
-            prompt.append(HumanMessage(content=instruction))
-            response = self.agent.invoke(prompt)
+            dialogue.append({ "instruction": instruction })
+            prompt = self.context.to_messages(dialogue, provider=self.prompt_provider)
+            response = await self.acall_llm("response", prompt)
             responses.append(response.content)
-            prompt.append(AIMessage(content=response.content))
+            dialogue[-1]["output"] = response.content
         
         return responses
     
@@ -51,85 +67,325 @@ class InstructionRewriter:
             return []
         instructions = [self.rewrite(instruction, rewrite_func) for instruction in instructions]
         return instructions
+    
+    def evolve_log(self, log_data):
+        """
+        The user messages of a log evolved by `self.evolution`, and the strategies applied to each of them.
+        """
+        instructions = [msg["content"] for msg in log_data["messages"] if msg["from"] == "user"]
+        return self.evolution.evolve(self, instructions)
 
-def rewrite_instructions(agent, args):
-    dataset = load_dataset(args.dataset, split=args.split)
-    n_data = len(dataset)
+    async def aevolve_log(self, log_data):
+        # All evolution steps of a round, over every user message of the log, are in flight at once.
+        instructions = [msg["content"] for msg in log_data["messages"] if msg["from"] == "user"]
+        return await self.evolution.aevolve(self, instructions)
 
-    with open(args.saved_path, "r", encoding="utf8") as reader:
-        all_data = json.load(reader)
-    
-    indices = list(range(n_data))
-    for data in all_data:
-        indices.remove(data["id"])
+def parse_shard(shard):
+    index, n_shards = [int(value) for value in shard.split("/")]
+    if not 0 <= index < n_shards:
+        raise ValueError(
+            f"The shard {shard} doesn't exist"
+        )
+    return index, n_shards
 
-    for idx in tqdm(indices):
-        instructions = agent.rewrite_log(dataset[idx], rewrite_func=createDeepenPromptTraditionalChinese)
-        all_data.append({
-            "id": idx,
-            "original_conversation": dataset[idx]["messages"],
-            "instructions": instructions
-        })
+def select_ids(n_data, shard=None, id_range=None):
+    """
+    `n_data` is None for a stream of unknown length, which is read to the end unless `id_range` has an end.
+    """
+    start, end = 0, n_data if n_data is not None else sys.maxsize
+    if id_range is not None:
+        begin, _, finish = id_range.partition(":")
+        start = max(start, int(begin) if begin else 0)
+        end = min(end, int(finish) if finish else end)
 
-        all_data = sorted(all_data, key=lambda data: data["id"])
+    if shard is not None:
+        if end == sys.maxsize:
+            raise ValueError(
+                f"The shard {shard} needs the dataset size, which the stream doesn't have. Use --id_range instead"
+            )
+        index, n_shards = parse_shard(shard)
+        size = end - start
+        start, end = start + size * index // n_shards, start + size * (index + 1) // n_shards
+
+    return range(start, end)
+
+def load_messages(args):
+    """
+    Only the `messages` column of the dataset, memory-mapped Arrow by default or a stream with `--streaming`,
+    so a multi-million-row dump is neither resident in memory nor downloaded up front.
+    """
+    from datasets import load_dataset
+
+    dataset = load_dataset(args.dataset, split=args.split, streaming=args.streaming)
+    return dataset.select_columns(["messages"])
 
-        with open(args.saved_path, "w", encoding="utf8") as writer:
-            json.dump(all_data, writer, indent="\t", ensure_ascii=False)
+def is_stream(dataset):
+    return not hasattr(dataset, "__len__")
 
-    all_data = sorted(all_data, key=lambda data: data["id"])
+def dataset_size(dataset):
+    if not is_stream(dataset):
+        return len(dataset)
+    splits = dataset.info.splits or {}
+    split = splits.get(str(dataset.split))
+    return split.num_examples if split is not None and split.num_examples else None
 
-    with open(args.saved_path, "w", encoding="utf8") as writer:
-        json.dump(all_data, writer, indent="\t", ensure_ascii=False)
+def has_user_turn(row):
+    return any(msg["from"] == "user" for msg in row["messages"])
+
+def iter_rows(dataset, ids, done, skipped=None):
+    """
+    (id, row) of the `ids` that aren't `done`, read sequentially. Rows without a user turn are skipped
+    before any LLM work. The ids of both are collected in `skipped`.
+    """
+    if is_stream(dataset):
+        rows = zip(ids, dataset.skip(ids.start).take(len(ids)))
+    else:
+        rows = zip(ids, dataset.select(ids))
+
+    for idx, row in rows:
+        if idx in done or not has_user_turn(row):
+            if skipped is not None:
+                skipped.append(idx)
+            continue
+        yield idx, row
+
+
+def rewrite_rows(agent, store, rows, records):
+    """
+    Rewrite and answer the (id, row) pairs of `rows` one after another. `records` holds the rows rewritten
+    by an earlier run that still miss responses. Returns the ids that got responses.
+    """
+    finished = []
+
+    for idx, row in tqdm(rows):
+        try:
+            data = records.get(idx)
+            if data is None:
+                instructions, evolution = agent.evolve_log(row)
+                records[idx] = data = {
+                    "id": idx,
+                    "original_conversation": row["messages"],
+                    "instructions": instructions,
+                    "evolution": evolution
+                }
+                store.append(data)
+
+            with track_usage() as usage:
+                responses = agent.response_to_multi_turn_instruction(data["instructions"])
+            data["responses"] = responses
+            data["usage"] = usage.to_dict()
+        except Exception as e:
+            print(e)
+            continue
+
+        store.append(records.pop(idx))
+        finished.append(idx)
+
+    return finished
+
+
+async def rewrite_concurrently(agent, args, store, rows, records):
+    """
+    Keep `args.concurrency` conversations in flight. Each one is rewritten (all user messages at once) and
+    then answered turn by turn, so the rewrite and response phases of different conversations overlap.
+    Returns the ids that got responses.
+    """
+    progress = tqdm()
+    finished = []
+
+    async def worker():
+        for idx, row in rows:
+            try:
+                data = records.get(idx)
+                if data is None:
+                    instructions, evolution = await agent.aevolve_log(row)
+                    records[idx] = data = {
+                        "id": idx,
+                        "original_conversation": row["messages"],
+                        "instructions": instructions,
+                        "evolution": evolution
+                    }
+                    store.append(data)
+
+                with track_usage() as usage:
+                    data["responses"] = await agent.aresponse_to_multi_turn_instruction(data["instructions"])
+                data["usage"] = usage.to_dict()
+                store.append(records.pop(idx))
+                finished.append(idx)
+            except Exception as e:
+                print(e)
+            progress.update(1)
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    progress.close()
+
+    return finished
+
+
+def run_rewrite_worker(agent, args, store, dataset, ids, done, records):
+    queue = work_queue_from_args(args)
+    queue.populate(ids)
+    worker_id = args.worker_id or default_worker_id()
+
+    # Rows already answered by an earlier run or without a user turn have nothing to do, so they count as finished.
+    def process(leased):
+        skipped = []
+        return rewrite_rows(agent, store, iter_rows(dataset, leased, done, skipped), records) + skipped
+
+    async def aprocess(leased):
+        skipped = []
+        return await rewrite_concurrently(agent, args, store, iter_rows(dataset, leased, done, skipped), records) + skipped
+
+    try:
+        if args.concurrency > 1:
+            asyncio.run(arun_worker(
+                queue, worker_id, aprocess,
+                lease_size=args.lease_size,
+                poll_interval=args.queue_poll_interval,
+            ))
+        else:
+            run_worker(
+                queue, worker_id, process,
+                lease_size=args.lease_size,
+                poll_interval=args.queue_poll_interval,
+            )
+    finally:
+        queue.close()
+
+
+def rewrite_with_batches(agent, args, store, api_key):
+    dataset = load_messages(args)
+    ids = select_ids(len(dataset), args.shard, args.id_range)
+
+    runner = BatchRewriter(
+        backend=batch_backend_from_args(args, api_key, agent.agent),
+        store=store,
+        job_log=BatchJobLog(os.path.splitext(args.saved_path)[0] + ".batches.json"),
+        dataset=dataset,
+        rewrite_func=createDeepenPromptTraditionalChinese,
+        max_requests_per_job=args.batch_max_requests,
+        poll_interval=args.batch_poll_interval,
+        max_attempts=args.batch_max_attempts,
+    )
+    runner.run(ids)
 
 
 def main(args):
-    config = dotenv.dotenv_values(args.dot-env)
-    if args.llm == "claude":
+    if args.streaming and (args.batch or args.queue_path is not None):
+        raise ValueError(
+            "--streaming reads the dataset in order and can't be combined with --batch or --queue_path"
+        )
+    if args.batch and args.endpoints is not None:
+        raise ValueError(
+            "--batch sends every job with the --llm key, it can't be combined with --endpoints"
+        )
+    if args.batch and (args.evol_rounds != 1 or args.evol_strategies != ["deepen_zh"]):
+        raise ValueError(
+            "--batch only runs a single deepen_zh rewrite, it can't be combined with other evolution settings"
+        )
+
+    config = dotenv.dotenv_values(args.dot_env)
+    if args.endpoints is not None:
+        # The endpoints file gives the keys.
+        api_key = None
+    elif args.llm == "claude":
         api_key = config["ANTHROPIC_API_KEY"]
-    else:
+    elif args.llm == "openai":
         api_key = config["OPENAI_API_KEY"]
+    else:
+        api_key = None
 
+    router = router_from_args(args, config, max_concurrency=args.concurrency)
+    cache = cache_from_args(args)
+    metrics = metrics_from_args(args)
+    rate_limiter = rate_limiter_from_args(args, max_concurrency=args.concurrency)
     agent = InstructionRewriter(
         llm=args.llm,
         model_name=args.model_name,
-        api_key=api_key
+        api_key=api_key,
+        cache=cache,
+        agent=router if router is not None else fake_llm_from_args(args),
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+        retry=retry_policy_from_args(args),
+        context=context_from_args(args),
+        evolution=evolution_engine_from_args(args),
+        # Rows and their rewrites may be in any language, format.py converts them to Traditional Chinese.
+        streaming=stream_policy_from_args(args, language_checks=False)
     )
 
-	rewrite_instructions(agent, args)
+    if args.queue_path is not None:
+        # Workers only write their own shard. merge.py builds 'saved_path' once the queue is drained.
+        worker_id = args.worker_id or default_worker_id()
+        store = CheckpointStore(worker_shard_path(args.saved_path, worker_id), key=lambda data: data["id"])
+    else:
+        store = CheckpointStore(args.checkpoint_path or default_checkpoint_path(args.saved_path), key=lambda data: data["id"])
+        store.import_json(args.saved_path)
 
-    with open(args.saved_path, "r", encoding="utf8") as reader:
-        all_data = json.load(reader)
-    
-    n_data = len(all_data)
-    
-    for idx in tqdm(range(n_data)):
-        if "responses" in all_data[idx]:
-            continue
-        
-        try:
-            instructions = all_data[idx]["instructions"]
-            responses = agent.response_to_multi_turn_instruction(instructions)
-            all_data[idx]["responses"] = responses
-        except Exception as e:
-            print(e)
-            continue
+    try:
+        if args.batch:
+            rewrite_with_batches(agent, args, store, api_key)
+            return
 
-        with open(args.saved_path, "w", encoding="utf8") as writer:
-            json.dump(all_data, writer, indent="\t", ensure_ascii=False)
-    
-    with open(args.saved_path, "w", encoding="utf8") as writer:
-        json.dump(all_data, writer, indent="\t", ensure_ascii=False)
+        dataset = load_messages(args)
+        ids = select_ids(dataset_size(dataset), args.shard, args.id_range)
+
+        # Only rows rewritten without responses yet are kept in memory, finished ones are a bitmap.
+        done = store.done_ids(predicate=lambda data: "responses" in data)
+        # Rows a --batch run gave up on start over.
+        records = { data["id"]: data for data in store.iter_records() if not data["id"] in done and not "failed" in data }
+
+        if args.queue_path is not None:
+            run_rewrite_worker(agent, args, store, dataset, ids, done, records)
+        elif args.concurrency > 1:
+            asyncio.run(rewrite_concurrently(agent, args, store, iter_rows(dataset, ids, done), records))
+        else:
+            rewrite_rows(agent, store, iter_rows(dataset, ids, done), records)
+    finally:
+        store.close()
+        if args.queue_path is None:
+            store.compact(args.saved_path, sort_key=lambda data: data["id"])
+
+        print(f"Evolution: {agent.evolution.stats()}")
+        if cache is not None:
+            print(f"Cache: {cache.stats()}")
+            cache.close()
+        metrics.export()
+        print(f"Rate limiter: {rate_limiter.stats()}")
+        if router is not None:
+            print(f"Endpoints: {router.stats()}")
+            router.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--llm", choices=["claude", "openai"], default="claude")
+    parser.add_argument("--llm", choices=provider_names(), default="claude")
     parser.add_argument("--model_name", choices=["claude-3-opus-20240229", "gpt-4-0613", "gpt-4-0125-preview",
-                                                 "gpt-3.5-turbo-0125", "claude-3-sonnet-20240229"],
+                                                 "gpt-3.5-turbo-0125", "claude-3-sonnet-20240229", "fake"],
                         default="claude-3-opus-20240229")
     parser.add_argument("--saved_path", type=str, required=True)
     parser.add_argument("--dot-env", type=str, default=".env")
-	parser.add_argument("--dataset", type=str, required=True)
-	parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--dataset", type=str, required=True)
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--checkpoint_path", type=str, default=None,
+                        help="Append-only JSONL log of finished samples. Defaults to `saved_path` with a .ckpt.jsonl suffix")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Only process shard `i/N` of the dataset ids, e.g. 0/4")
+    parser.add_argument("--id_range", type=str, default=None,
+                        help="Only process dataset ids in `start:end` (end exclusive)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Stream the dataset instead of downloading and memory-mapping it first")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of conversations rewritten and answered at the same time")
+    add_cache_args(parser)
+    add_batch_args(parser)
+    add_context_args(parser)
+    add_evolution_args(parser)
+    add_fake_llm_args(parser)
+    add_metrics_args(parser)
+    add_rate_limit_args(parser)
+    add_router_args(parser)
+    add_streaming_args(parser)
+    add_worker_args(parser)
 
     args = parser.parse_args()
     print(args)
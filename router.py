@@ -0,0 +1,338 @@
+import json
+import os
+import random
+import time
+from langchain_core.messages import BaseMessage
+from metrics import token_usage
+from providers import create_chat_model
+from rate_limit import RateLimiter, classify_error, estimate_tokens, retry_after
+
+
+class AllEndpointsUnavailable(Exception):
+    """
+    Every endpoint is cooling down or disabled. Classified as a server error, so LLMClient backs off and retries.
+    `retry_after` is the time left until the first cooldown ends (None when every endpoint is disabled).
+    """
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def strip_cache_control(prompt):
+    """
+    `prompt` without the Anthropic prompt caching marks of its content blocks, for other providers.
+    """
+    if isinstance(prompt, str):
+        return prompt
+
+    messages = []
+    for message in prompt:
+        if isinstance(message, BaseMessage) and isinstance(message.content, list):
+            content = [
+                { key: value for key, value in block.items() if key != "cache_control" } if isinstance(block, dict) else block
+                for block in message.content
+            ]
+            message = message.__class__(content=content)
+        messages.append(message)
+    return messages
+
+
+class Endpoint:
+    """
+    One (provider, model, key) of the pool, with its own rate limiter and its health: an EWMA of its latency,
+    in-flight calls, failures by kind and a cooldown after failures.
+    """
+    def __init__(self, name, provider, model_name, agent, rpm=None, tpm=None, weight=1.0, max_concurrency=None):
+        self.name = name
+        self.provider = provider
+        self.model_name = model_name
+        self.agent = agent
+        self.weight = weight
+        self.rate_limiter = RateLimiter(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+
+        self.latency = None
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = {}
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.disabled = False
+
+    def available(self, now):
+        return not self.disabled and self.cooldown_until <= now
+
+    def quota(self):
+        """
+        Fraction of the requests/min and tokens/min quota left, the scarcer of the two.
+        """
+        buckets = (self.rate_limiter.requests, self.rate_limiter.tokens)
+        fractions = [bucket.available() / bucket.capacity for bucket in buckets if bucket is not None]
+        return min(fractions, default=1.0)
+
+    def prompt(self, prompt):
+        return prompt if self.provider == "claude" else strip_cache_control(prompt)
+
+    def begin(self):
+        self.in_flight += 1
+
+    def end(self):
+        self.in_flight -= 1
+
+    def on_success(self, seconds, alpha=0.2):
+        self.calls += 1
+        self.consecutive_failures = 0
+        self.latency = seconds if self.latency is None else (1 - alpha) * self.latency + alpha * seconds
+
+    def on_failure(self, kind, cooldown):
+        self.calls += 1
+        self.consecutive_failures += 1
+        self.failures[kind] = self.failures.get(kind, 0) + 1
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+    def stats(self):
+        return {
+            "provider": self.provider,
+            "model_name": self.model_name,
+            "calls": self.calls,
+            "failures": dict(self.failures),
+            "in_flight": self.in_flight,
+            "latency_seconds": self.latency,
+            "quota": self.quota(),
+            "cooldown_seconds": max(0.0, self.cooldown_until - time.monotonic()),
+            "disabled": self.disabled,
+            **self.rate_limiter.stats(),
+        }
+
+
+class Router:
+    """
+    A pool of (provider, model, key) endpoints. `next_endpoint` picks the one with the lowest expected wait
+    (latency EWMA times calls in flight, over weight and quota left) and `record_failure` decides whether
+    a call fails over: a retryable error puts the endpoint in an exponentially growing cooldown and an
+    authentication error disables it.
+
+    LLMClient drives the endpoints itself, so its cache, limits and prompts follow the endpoint serving each
+    call. The Router is also a chat model on its own (`invoke`, `stream`, ...); its streams fail over until
+    their first chunk.
+    """
+    def __init__(self, endpoints, base_cooldown=1.0, max_cooldown=60.0, http_clients=()):
+        self.endpoints = endpoints
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.http_clients = list(http_clients)
+
+    def _choose(self, tried):
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now) and not endpoint in tried]
+        if not candidates:
+            return None
+
+        def expected_wait(endpoint):
+            # Unmeasured endpoints go first, so every endpoint gets a latency estimate.
+            latency = endpoint.latency if endpoint.latency is not None else 0.0
+            return latency * (endpoint.in_flight + 1) / endpoint.weight / max(endpoint.quota(), 0.05)
+
+        best = min(expected_wait(endpoint) for endpoint in candidates)
+        return random.choice([endpoint for endpoint in candidates if expected_wait(endpoint) <= best])
+
+    def next_endpoint(self, tried, error=None):
+        """
+        The best endpoint not in `tried` (which it is added to). When none is left, `error` (the failure of the
+        last endpoint) is raised, or AllEndpointsUnavailable.
+        """
+        endpoint = self._choose(tried)
+        if endpoint is None:
+            if error is not None:
+                raise error
+            cooldowns = [endpoint.cooldown_until for endpoint in self.endpoints if not endpoint.disabled]
+            wait = max(0.0, min(cooldowns) - time.monotonic()) if cooldowns else None
+            raise AllEndpointsUnavailable("Every endpoint is cooling down or disabled", retry_after=wait)
+        tried.add(endpoint)
+        return endpoint
+
+    def record_failure(self, endpoint, error):
+        """
+        Record the failure of `endpoint` and return whether another endpoint should be tried.
+        """
+        response = getattr(error, "response", None)
+        status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+        if status in [401, 403]:
+            endpoint.disabled = True
+            endpoint.on_failure("auth", 0.0)
+            return True
+
+        kind = classify_error(error)
+        if kind is None:
+            # The request itself is bad, another endpoint wouldn't do better.
+            endpoint.on_failure("request", 0.0)
+            return False
+        if kind == "rate_limit":
+            endpoint.rate_limiter.on_rate_limited()
+
+        cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** endpoint.consecutive_failures)
+        wait = retry_after(error)
+        if wait is not None:
+            cooldown = max(cooldown, min(wait, self.max_cooldown))
+        endpoint.on_failure(kind, cooldown)
+        return True
+
+    @staticmethod
+    def record_success(endpoint, seconds, estimated_tokens, output=None):
+        endpoint.on_success(seconds)
+        endpoint.rate_limiter.on_success()
+        if output is not None:
+            input_tokens, output_tokens = token_usage(output)
+            endpoint.rate_limiter.record_usage(estimated_tokens, input_tokens + output_tokens)
+
+    def invoke(self, prompt, **kwargs):
+        estimated_tokens = estimate_tokens(prompt)
+        tried, error = set(), None
+        while True:
+            endpoint = self.next_endpoint(tried, error)
+            endpoint.rate_limiter.acquire(estimated_tokens)
+            endpoint.begin()
+            start = time.perf_counter()
+            try:
+                output = endpoint.agent.invoke(endpoint.prompt(prompt), **kwargs)
+            except Exception as e:
+                if not self.record_failure(endpoint, e):
+                    raise
+                error = e
+                continue
+            finally:
+                endpoint.end()
+            self.record_success(endpoint, time.perf_counter() - start, estimated_tokens, output)
+            return output
+
+    async def ainvoke(self, prompt, **kwargs):
+        estimated_tokens = estimate_tokens(prompt)
+        tried, error = set(), None
+        while True:
+            endpoint = self.next_endpoint(tried, error)
+            await endpoint.rate_limiter.aacquire(estimated_tokens)
+            endpoint.begin()
+            start = time.perf_counter()
+            try:
+                output = await endpoint.agent.ainvoke(endpoint.prompt(prompt), **kwargs)
+            except Exception as e:
+                if not self.record_failure(endpoint, e):
+                    raise
+                error = e
+                continue
+            finally:
+                endpoint.end()
+                await endpoint.rate_limiter.arelease()
+            self.record_success(endpoint, time.perf_counter() - start, estimated_tokens, output)
+            return output
+
+    def stream(self, prompt, **kwargs):
+        estimated_tokens = estimate_tokens(prompt)
+        tried, error = set(), None
+        while True:
+            endpoint = self.next_endpoint(tried, error)
+            endpoint.rate_limiter.acquire(estimated_tokens)
+            endpoint.begin()
+            start, started = time.perf_counter(), False
+            try:
+                for chunk in endpoint.agent.stream(endpoint.prompt(prompt), **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                # Chunks already went to the caller, so only a stream that hasn't started can fail over.
+                if not self.record_failure(endpoint, e) or started:
+                    raise
+                error = e
+                continue
+            finally:
+                # Also when the caller stopped reading, e.g. a stop check aborted the stream.
+                endpoint.end()
+            self.record_success(endpoint, time.perf_counter() - start, estimated_tokens)
+            return
+
+    async def astream(self, prompt, **kwargs):
+        estimated_tokens = estimate_tokens(prompt)
+        tried, error = set(), None
+        while True:
+            endpoint = self.next_endpoint(tried, error)
+            await endpoint.rate_limiter.aacquire(estimated_tokens)
+            endpoint.begin()
+            start, started = time.perf_counter(), False
+            try:
+                async for chunk in endpoint.agent.astream(endpoint.prompt(prompt), **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not self.record_failure(endpoint, e) or started:
+                    raise
+                error = e
+                continue
+            finally:
+                endpoint.end()
+                await endpoint.rate_limiter.arelease()
+            self.record_success(endpoint, time.perf_counter() - start, estimated_tokens)
+            return
+
+    def stats(self):
+        return { endpoint.name: endpoint.stats() for endpoint in self.endpoints }
+
+    def close(self):
+        # The async client's connections belong to the event loop that used them and close with it.
+        for client in self.http_clients:
+            client.close()
+
+
+def load_endpoints(path, config=None, timeout=60, max_concurrency=None):
+    """
+    A Router over the endpoints listed in the JSON file `path`, e.g.
+
+        [{"provider": "claude", "model_name": "claude-3-opus-20240229", "api_key_env": "ANTHROPIC_API_KEY", "rpm": 50},
+         {"provider": "openai", "model_name": "gpt-4-0125-preview", "api_key_env": "OPENAI_API_KEY_2", "weight": 0.5}]
+
+    Keys are read from `api_key`, or the variable `api_key_env` of `config` (the .env values) or the environment.
+    Every endpoint has its own rpm/tpm limits and adaptive concurrency limit (up to `max_concurrency`), and all
+    endpoints share one keep-alive connection pool per host.
+    """
+    import httpx
+
+    with open(path, "r", encoding="utf8") as reader:
+        entries = json.load(reader)
+
+    config = config or {}
+    http_client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_keepalive_connections=64))
+    http_async_client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_keepalive_connections=64))
+
+    endpoints = []
+    for i, entry in enumerate(entries):
+        api_key = entry.get("api_key")
+        if api_key is None and "api_key_env" in entry:
+            api_key = config.get(entry["api_key_env"]) or os.environ.get(entry["api_key_env"])
+
+        agent = create_chat_model(entry["provider"], entry["model_name"], api_key, timeout=timeout,
+                                  http_client=http_client, http_async_client=http_async_client)
+        endpoints.append(Endpoint(
+            name=entry.get("name", f"{entry['provider']}/{entry['model_name']}/{i}"),
+            provider=entry["provider"],
+            model_name=entry["model_name"],
+            agent=agent,
+            rpm=entry.get("rpm"),
+            tpm=entry.get("tpm"),
+            weight=entry.get("weight", 1.0),
+            max_concurrency=max_concurrency,
+        ))
+
+    return Router(endpoints, http_clients=[http_client])
+
+
+def add_router_args(parser):
+    parser.add_argument("--endpoints", type=str, default=None,
+                        help="JSON file of (provider, model, key) endpoints to load-balance and fail over between")
+    parser.add_argument("--request_timeout", type=float, default=60,
+                        help="Timeout in seconds of a request to an endpoint")
+
+
+def router_from_args(args, config=None, max_concurrency=None):
+    if args.endpoints is None:
+        return None
+    return load_endpoints(args.endpoints, config=config, timeout=args.request_timeout, max_concurrency=max_concurrency)
@@ -1,3 +1,4 @@
+from typing import List
 from langchain_core.pydantic_v1 import BaseModel, Field, validator
 
 class Instruction(BaseModel):
@@ -6,3 +7,9 @@ class Instruction(BaseModel):
 class InstructionInputs(BaseModel):
     inputs: str = Field(description="The input based on the instruction. If there's no input, return `None`")
 
+class InstructionCandidate(BaseModel):
+    instruction: str = Field(description="A new instruction in Traditional Chinese")
+    input: str = Field(description="The input the instruction works on, e.g. an article, code or a table. If there's no input, return `None`")
+
+class InstructionCandidates(BaseModel):
+    instructions: List[InstructionCandidate] = Field(description="The new instructions, each on a different topic")
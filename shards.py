@@ -0,0 +1,172 @@
+import json
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+
+MANIFEST = "manifest.json"
+
+# pyarrow is imported by the functions using it, so format.py's JSONL output doesn't need it.
+
+
+def message_type():
+    import pyarrow as pa
+    return pa.list_(pa.struct([("from", pa.string()), ("value", pa.string())]))
+
+
+class ParquetShardWriter:
+    """
+    Writes conversation records as zstd-compressed Parquet shards `{output_dir}/part-00000.parquet`, ...
+    A new shard is started once the current one reaches `max_shard_bytes` on disk, checked after every
+    row group of `row_group_size` records.
+
+    `close(stats)` writes a manifest with the row count of every shard and `stats`, so readers can
+    index the shards without opening them. With `append`, new shards are added after the ones in the
+    existing manifest.
+    """
+    def __init__(self, output_dir, columns, max_shard_bytes=256 << 20, row_group_size=1024,
+                 compression="zstd", compression_level=None, append=False):
+        import pyarrow as pa
+
+        self.output_dir = output_dir
+        self.columns = columns
+        self.max_shard_bytes = max_shard_bytes
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.schema = pa.schema([(column, message_type()) for column in columns])
+
+        self.shards = []
+        manifest_path = os.path.join(output_dir, MANIFEST)
+        if append and os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf8") as reader:
+                self.shards = json.load(reader)["shards"]
+        self._rows = []
+        self._sink = None
+        self._writer = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _open(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        name = f"part-{len(self.shards):05d}.parquet"
+        self._sink = pa.OSFile(os.path.join(self.output_dir, name), "wb")
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression=self.compression,
+                                        compression_level=self.compression_level)
+        self.shards.append({ "path": name, "num_rows": 0 })
+
+    def _close_shard(self):
+        self._writer.close()
+        self._sink.close()
+        self._writer = self._sink = None
+
+    def _flush(self):
+        import pyarrow as pa
+
+        if not self._rows:
+            return
+        if self._writer is None:
+            self._open()
+
+        table = pa.Table.from_pylist(self._rows, schema=self.schema)
+        self._writer.write_table(table, row_group_size=len(self._rows))
+        self.shards[-1]["num_rows"] += len(self._rows)
+        self._rows = []
+
+        if self._sink.tell() >= self.max_shard_bytes:
+            self._close_shard()
+
+    def write(self, record):
+        self._rows.append({ column: record[column] for column in self.columns })
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+    def close(self, stats=None):
+        self._flush()
+        if self._writer is not None:
+            self._close_shard()
+
+        manifest = {
+            "columns": self.columns,
+            "shards": self.shards,
+            "num_rows": sum(shard["num_rows"] for shard in self.shards),
+            "stats": stats or {},
+        }
+        with open(os.path.join(self.output_dir, MANIFEST), "w", encoding="utf8") as writer:
+            json.dump(manifest, writer, ensure_ascii=False, indent=2)
+
+
+class ShardedDataset:
+    """
+    Random access to the shards written by `ParquetShardWriter`. Shards are memory-mapped and opened
+    lazily, and the last `cache_row_groups` decoded row groups are kept so nearby reads don't
+    decompress again.
+    """
+    def __init__(self, path, columns=None, cache_row_groups=8):
+        with open(os.path.join(path, MANIFEST), "r", encoding="utf8") as reader:
+            self.manifest = json.load(reader)
+
+        self.path = path
+        self.columns = columns or self.manifest["columns"]
+        self.cache_row_groups = cache_row_groups
+        self._offsets = []
+        total = 0
+        for shard in self.manifest["shards"]:
+            self._offsets.append(total)
+            total += shard["num_rows"]
+        self._files = {}
+        self._row_groups = {}
+        self._cache = OrderedDict()
+
+    @property
+    def stats(self):
+        return self.manifest["stats"]
+
+    def __len__(self):
+        return self.manifest["num_rows"]
+
+    def _file(self, shard):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not shard in self._files:
+            source = pa.memory_map(os.path.join(self.path, self.manifest["shards"][shard]["path"]))
+            parquet_file = pq.ParquetFile(source)
+            self._files[shard] = parquet_file
+
+            offsets, total = [], 0
+            for i in range(parquet_file.metadata.num_row_groups):
+                offsets.append(total)
+                total += parquet_file.metadata.row_group(i).num_rows
+            self._row_groups[shard] = offsets
+        return self._files[shard]
+
+    def _row_group(self, shard, group):
+        key = (shard, group)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        rows = self._file(shard).read_row_group(group, columns=self.columns).to_pylist()
+        self._cache[key] = rows
+        if len(self._cache) > self.cache_row_groups:
+            self._cache.popitem(last=False)
+        return rows
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+
+        shard = bisect_right(self._offsets, idx) - 1
+        row = idx - self._offsets[shard]
+        self._file(shard)
+        group = bisect_right(self._row_groups[shard], row) - 1
+        return self._row_group(shard, group)[row - self._row_groups[shard][group]]
+
+    def __iter__(self):
+        for shard in range(len(self.manifest["shards"])):
+            parquet_file = self._file(shard)
+            for batch in parquet_file.iter_batches(columns=self.columns):
+                yield from batch.to_pylist()
@@ -0,0 +1,169 @@
+import time
+from langchain_core.messages import AIMessage
+from cache import content_text
+from metrics import token_usage
+from quality import INSTRUCTION_REFUSAL_PATTERNS, REFUSAL_PATTERNS, cjk_ratio, simplified_ratio
+
+# The stage of the text each call kind produces, for the stop checks. Kinds that aren't listed (e.g. the
+# JSON of "instruction_candidates") are only capped by their max output tokens.
+KIND_STAGES = {
+    "first_instruction": "instruction",
+    "follow_up_instruction": "instruction",
+    "rewrite": "instruction",
+    "response": "response",
+}
+
+
+class StreamAborted(Exception):
+    """
+    A streamed response cancelled by a stop check. Like any failed call, the caller drops its output.
+    """
+    def __init__(self, abort_reason, text):
+        super().__init__(f"Stream aborted by the {abort_reason} check after {len(text)} characters")
+        self.abort_reason = abort_reason
+        self.text = text
+
+
+class StopCheck:
+    """
+    A named check `check(text) -> bool` (True when the partial text is already bad) run at the given stages.
+    """
+    def __init__(self, name, check, stages=("instruction", "response")):
+        self.name = name
+        self.check = check
+        self.stages = stages
+
+
+def default_stop_checks(min_chars=64, min_instruction_cjk_ratio=0.2, min_response_cjk_ratio=0.05,
+                        max_simplified_ratio=0.02, language_checks=True):
+    """
+    Prefix versions of the quality gate rules: a refusal shows in the first characters, and the script
+    is judged once `min_chars` characters arrived. Without `language_checks` only refusals are checked,
+    for outputs that may be in any language (rewrite.py keeps the language of the dataset row).
+    """
+    refusal = [
+        StopCheck("refusal", lambda text: bool(REFUSAL_PATTERNS.search(text[:100])), stages=("response",)),
+        # Instructions are the user's voice, only the assistant's voice is a refusal there.
+        StopCheck("refusal", lambda text: bool(INSTRUCTION_REFUSAL_PATTERNS.search(text[:100])),
+                  stages=("instruction",)),
+    ]
+    if not language_checks:
+        return refusal
+
+    return refusal + [
+        StopCheck("not_chinese", lambda text: len(text) >= min_chars and cjk_ratio(text) < min_instruction_cjk_ratio,
+                  stages=("instruction",)),
+        StopCheck("not_chinese", lambda text: len(text) >= min_chars and cjk_ratio(text) < min_response_cjk_ratio,
+                  stages=("response",)),
+        StopCheck("simplified_chinese",
+                  lambda text: len(text) >= min_chars and simplified_ratio(text) > max_simplified_ratio,
+                  stages=("instruction",)),
+    ]
+
+
+class StreamWatcher:
+    """
+    Accumulates the chunks of one streamed call, runs the stop checks every `check_interval` new characters
+    and measures time to first token and output tokens per second.
+    """
+    def __init__(self, checks, check_interval=32):
+        self.checks = checks
+        self.check_interval = check_interval
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.message = None
+        self.text = ""
+        self._checked = 0
+
+    def add(self, chunk):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.message = chunk if self.message is None else self.message + chunk
+        self.text += content_text(chunk.content)
+
+        if len(self.text) - self._checked < self.check_interval:
+            return
+        self._checked = len(self.text)
+        self.check()
+
+    def check(self):
+        for check in self.checks:
+            if check.check(self.text):
+                raise StreamAborted(check.name, self.text)
+
+    def finish(self):
+        """
+        The whole response as an AIMessage, with the stream timings in `response_metadata["streaming"]`.
+        """
+        self.check()
+        end = time.perf_counter()
+        message = self.message if self.message is not None else AIMessage(content="")
+
+        output = AIMessage(
+            content=self.text,
+            response_metadata=dict(message.response_metadata or {}),
+            usage_metadata=getattr(message, "usage_metadata", None)
+        )
+        # Providers that don't report usage on streams are counted one token per character.
+        output_tokens = token_usage(output)[1] or len(self.text)
+        first_token = self.first_token if self.first_token is not None else end
+        output.response_metadata["streaming"] = {
+            "ttft_seconds": first_token - self.start,
+            "tokens_per_second": output_tokens / (end - first_token) if end > first_token else 0.0,
+        }
+        return output
+
+
+class StreamPolicy:
+    """
+    How LLMClient gets outputs. `max_output_tokens` ({kind: tokens}) is sent to the provider with every
+    call of that kind, which stops runaway outputs there. With `stream`, outputs are streamed so `stop_checks`
+    can cancel a call as soon as its partial text fails, and time to first token and tokens/sec are recorded.
+    """
+    def __init__(self, stream=False, max_output_tokens=None, stop_checks=None, check_interval=32):
+        self.stream = stream
+        self.max_output_tokens = max_output_tokens or {}
+        self.stop_checks = stop_checks if stop_checks is not None else default_stop_checks()
+        self.check_interval = check_interval
+
+    def call_kwargs(self, kind):
+        max_tokens = self.max_output_tokens.get(kind)
+        return {} if max_tokens is None else { "max_tokens": max_tokens }
+
+    def watch(self, kind):
+        stage = KIND_STAGES.get(kind)
+        checks = [check for check in self.stop_checks if stage in check.stages]
+        return StreamWatcher(checks, check_interval=self.check_interval)
+
+
+def parse_max_output_tokens(values):
+    max_output_tokens = {}
+    for value in values:
+        kind, _, tokens = value.partition("=")
+        if not tokens:
+            raise ValueError(
+                f"The max output tokens {value} should be given as kind=tokens"
+            )
+        max_output_tokens[kind] = int(tokens)
+    return max_output_tokens
+
+
+def add_streaming_args(parser):
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream outputs, cancel them early when a stop check fails and record time to first token")
+    parser.add_argument("--max_output_tokens", type=str, nargs="*", default=[],
+                        help="Max output tokens per call kind, e.g. response=2048 first_instruction=256")
+    parser.add_argument("--skip_stop_checks", type=str, nargs="*", default=[],
+                        help="Names of stop checks to turn off, or 'all'")
+
+
+def stream_policy_from_args(args, language_checks=True):
+    stop_checks = [] if "all" in args.skip_stop_checks else [
+        check for check in default_stop_checks(language_checks=language_checks)
+        if not check.name in args.skip_stop_checks
+    ]
+    return StreamPolicy(
+        stream=args.stream,
+        max_output_tokens=parse_max_output_tokens(args.max_output_tokens),
+        stop_checks=stop_checks,
+    )
@@ -0,0 +1,146 @@
+import argparse
+import email.parser
+import email.policy
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fake_llm import FakeChatModel
+
+_ROLES = { "user": "human", "assistant": "ai", "system": "system" }
+
+
+class StubBatchState:
+    """
+    In-memory files and batches of a local server speaking the subset of the OpenAI Files / Batch API
+    used by batch.OpenAIBatchBackend. Requests are answered by FakeChatModel.
+    """
+    def __init__(self, model, completion_delay=0.0):
+        self.model = model
+        self.completion_delay = completion_delay
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, filename, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = {
+                "content": content,
+                "object": {
+                    "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                    "filename": filename, "purpose": purpose, "status": "processed",
+                }
+            }
+        return self.files[file_id]["object"]
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+            "completion_window": completion_window, "status": "in_progress", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None,
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Timer(self.completion_delay, self._complete, args=(batch_id,)).start()
+        return batch
+
+    def _complete(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.files[batch["input_file_id"]]["content"].decode("utf8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            messages = [(_ROLES[m["role"]], m["content"]) for m in request["body"]["messages"]]
+            try:
+                message = self.model._respond(messages)
+                response = {
+                    "status_code": 200,
+                    "body": {
+                        "object": "chat.completion",
+                        "model": request["body"]["model"],
+                        "choices": [{ "index": 0, "message": { "role": "assistant", "content": message.content } }],
+                        "usage": message.response_metadata["usage"],
+                    }
+                }
+                error = None
+            except Exception as e:
+                response, error = None, { "message": str(e) }
+            lines.append(json.dumps({ "custom_id": request["custom_id"], "response": response, "error": error }, ensure_ascii=False))
+
+        output = self.add_file("output.jsonl", ("\n".join(lines) + "\n").encode("utf8"), "batch_output")
+        with self.lock:
+            batch["output_file_id"] = output["id"]
+            batch["status"] = "completed"
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body, ensure_ascii=False).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_POST(self):
+            if self.path.endswith("/files"):
+                raw = b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._body()
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(raw)
+                fields, filename, content = {}, "batch.jsonl", b""
+                for part in message.iter_parts():
+                    name = part.get_param("name", header="content-disposition")
+                    if name == "file":
+                        filename = part.get_filename() or filename
+                        content = part.get_payload(decode=True)
+                    else:
+                        fields[name] = part.get_payload(decode=True).decode("utf8")
+                self._send(200, state.add_file(filename, content, fields.get("purpose", "batch")))
+            elif self.path.endswith("/batches"):
+                request = json.loads(self._body())
+                self._send(200, state.create_batch(request["input_file_id"], request["endpoint"], request["completion_window"]))
+            else:
+                self._send(404, { "error": { "message": f"Unknown path {self.path}" } })
+
+        def do_GET(self):
+            parts = self.path.rstrip("/").split("/")
+            if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in state.batches:
+                self._send(200, state.batches[parts[-1]])
+            elif len(parts) >= 3 and parts[-1] == "content" and parts[-2] in state.files:
+                self._send(200, state.files[parts[-2]]["content"], "application/octet-stream")
+            else:
+                self._send(404, { "error": { "message": f"Unknown path {self.path}" } })
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8765, completion_delay=0.0, model=None):
+    state = StubBatchState(model or FakeChatModel(latency=0.0), completion_delay=completion_delay)
+    return ThreadingHTTPServer((host, port), make_handler(state))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the OpenAI Batch API answering with the fake LLM")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--completion_delay", type=float, default=0.0,
+                        help="Seconds before a submitted batch completes")
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--response_length", type=int, default=200)
+
+    args = parser.parse_args()
+    model = FakeChatModel(latency=0.0, error_rate=args.error_rate, response_length=args.response_length)
+    server = serve(args.host, args.port, args.completion_delay, model)
+    print(f"Serving on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch import BatchJobLog, BatchRewriter
+from checkpoint import CheckpointStore
+
+
+class FailingBackend:
+    """
+    A batch API whose jobs end at once without any successful result.
+    """
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, requests):
+        self.submitted.append([custom_id for custom_id, _ in requests])
+        return f"job-{len(self.submitted)}"
+
+    def status(self, job_id):
+        return "ended"
+
+    def results(self, job_id):
+        return {}
+
+
+def test_request_fails_after_max_attempts(tmp_path):
+    dataset = [{ "messages": [{ "from": "user", "content": "請介紹台灣的夜市文化。" }, { "from": "gpt", "content": "好的" }] }]
+    backend = FailingBackend()
+    store = CheckpointStore(str(tmp_path / "out.ckpt.jsonl"), key=lambda data: data["id"])
+    runner = BatchRewriter(backend, store, BatchJobLog(str(tmp_path / "out.batches.json")), dataset,
+                           rewrite_func=lambda instruction: instruction, poll_interval=0, max_attempts=2)
+    runner.run([0])
+    store.close()
+
+    assert backend.submitted == [["rewrite-0-0"], ["rewrite-0-0"]]
+    records = store.load()
+    assert len(records) == 1
+    assert records[0]["failed"] == { "custom_id": "rewrite-0-0", "attempts": 2 }
+    assert not "responses" in records[0]
+
+    # A restarted run keeps the count and doesn't resubmit.
+    runner = BatchRewriter(backend, store, BatchJobLog(str(tmp_path / "out.batches.json")), dataset,
+                           rewrite_func=lambda instruction: instruction, poll_interval=0, max_attempts=2)
+    runner.run([0])
+    store.close()
+    assert len(backend.submitted) == 2
@@ -0,0 +1,53 @@
+import os
+import sys
+
+from langchain_core.messages import AIMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResponseCache
+
+
+def totals(cache):
+    return cache.conn.execute("SELECT n_entries, n_bytes FROM totals").fetchone()
+
+
+def table_totals(cache):
+    return cache.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+
+def test_size_bound_holds_across_processes(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = ResponseCache(path, max_entries=3)
+    second = ResponseCache(path, max_entries=3)
+
+    for i in range(3):
+        first.put(f"first-{i}", AIMessage(content=f"回答 {i}"))
+        second.put(f"second-{i}", AIMessage(content=f"回答 {i}"))
+
+    assert table_totals(first)[0] == 3
+    assert totals(first) == table_totals(first)
+    assert first.get("second-2").content == "回答 2"
+    first.close()
+    second.close()
+
+
+def test_overwrite_keeps_totals_exact(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_bytes=10000)
+    cache.put("key", AIMessage(content="短"))
+    cache.put("key", AIMessage(content="比較長的回答" * 10))
+    assert totals(cache) == table_totals(cache)
+    assert totals(cache)[0] == 1
+    cache.close()
+
+
+def test_totals_of_an_existing_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path)
+    cache.put("key", AIMessage(content="回答"))
+    cache.close()
+
+    cache = ResponseCache(path, max_entries=1)
+    assert totals(cache) == table_totals(cache)
+    assert totals(cache)[0] == 1
+    cache.close()
@@ -0,0 +1,34 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from evolution import EvolutionEngine
+from streaming import StreamAborted
+
+
+class AbortingAgent:
+    """
+    Rewrites whose stream a stop check cancels.
+    """
+    def rewrite(self, instruction, rewrite_func):
+        raise StreamAborted("refusal", "抱歉，我無法協助")
+
+    async def arewrite(self, instruction, rewrite_func):
+        return self.rewrite(instruction, rewrite_func)
+
+
+def test_aborted_step_keeps_the_original_instruction():
+    engine = EvolutionEngine(rounds=2)
+    instructions, paths = engine.evolve(AbortingAgent(), ["請介紹台灣的夜市文化。", "有哪些必吃的小吃？"])
+    assert instructions == ["請介紹台灣的夜市文化。", "有哪些必吃的小吃？"]
+    assert paths == [[], []]
+    assert engine.pruned == { "refusal": 2 }
+
+
+def test_aborted_step_async():
+    engine = EvolutionEngine()
+    instructions, paths = asyncio.run(engine.aevolve(AbortingAgent(), ["請介紹台灣的夜市文化。"]))
+    assert instructions == ["請介紹台灣的夜市文化。"]
+    assert engine.pruned == { "refusal": 1 }
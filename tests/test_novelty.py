@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoint import CheckpointStore
+from novelty import NoveltyFilter
+
+
+def test_stored_instructions_are_read_back_from_the_checkpoint(tmp_path):
+    store = CheckpointStore(str(tmp_path / "out.ckpt.jsonl"))
+    offset = store.append({ "conversation": [{ "instruction": "請介紹台灣夜市文化的特色與歷史發展" }] })
+    novelty_filter = NoveltyFilter(threshold=0.7, load=lambda offset: store.read(offset)["conversation"][0]["instruction"])
+    novelty_filter.add("請介紹台灣夜市文化的特色與歷史發展", offset=offset)
+
+    assert novelty_filter.items == [offset]
+    assert not novelty_filter("請介紹台灣夜市文化的特色和歷史發展")
+    assert novelty_filter("如何用Python讀取一個CSV檔案並計算每一欄的平均值？")
+    store.close()
+
+
+def test_accepted_text_is_swapped_for_its_offset():
+    novelty_filter = NoveltyFilter(load=lambda offset: "如何用Python讀取一個CSV檔案並計算每一欄的平均值？")
+    assert novelty_filter("如何用Python讀取一個CSV檔案並計算每一欄的平均值？")
+    assert novelty_filter.items == ["如何用Python讀取一個CSV檔案並計算每一欄的平均值？"]
+
+    novelty_filter.stored("如何用Python讀取一個CSV檔案並計算每一欄的平均值？", 128)
+    assert novelty_filter.items == [128]
+    assert not novelty_filter("如何用Python讀取CSV檔案並計算每一欄的平均值？")
+    assert novelty_filter.n_rejected == 1
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from checkpoint import CheckpointStore
+from data_generator import LLMDataGenerator, PartialConversation
+from fake_llm import FakeChatModel
+
+
+class CountingChatModel(FakeChatModel):
+    def __init__(self):
+        super().__init__(latency=0.0, latency_dist="constant")
+        self.calls = 0
+
+    def invoke(self, prompt, **kwargs):
+        self.calls += 1
+        return super().invoke(prompt, **kwargs)
+
+
+class Crash(Exception):
+    pass
+
+
+def examples():
+    with open(os.path.join(ROOT, "data", "begin_examples.json"), "r", encoding="utf8") as reader:
+        return json.load(reader)[:3]
+
+
+def test_resumed_conversation_continues_from_its_last_step(tmp_path):
+    partial = CheckpointStore(str(tmp_path / "out.ckpt.partial.jsonl"), key=lambda data: data["key"])
+    first_run = CountingChatModel()
+    agent = LLMDataGenerator("fake", "fake", None, agent=first_run)
+
+    def on_step(state):
+        partial.append(state.to_dict())
+        if len(state.dialogue) == 2 and state.stage() == "response":
+            raise Crash()
+
+    with pytest.raises(Crash):
+        agent.few_shot_generate(examples(), turns=3, state=PartialConversation(3, key="a"), on_step=on_step)
+    partial.close()
+    # First instruction, its response and the second instruction.
+    assert first_run.calls == 3
+
+    [data] = partial.load()
+    state = PartialConversation.from_dict(data)
+    assert state.stage() == "response"
+
+    second_run = CountingChatModel()
+    agent = LLMDataGenerator("fake", "fake", None, agent=second_run)
+    dialogue = agent.few_shot_generate(examples(), turns=3, state=state)
+
+    assert second_run.calls == 3
+    assert len(dialogue) == 3 and all("output" in turn for turn in dialogue)
+    assert dialogue[0]["instruction"] == data["dialogue"][0]["instruction"]
+    assert dialogue[1]["instruction"] == data["dialogue"][1]["instruction"]
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "out.ckpt.jsonl")
+    store = CheckpointStore(path)
+    store.append({ "conversation": [{ "instruction": "甲", "output": "一" }] })
+    store.append({ "conversation": [{ "instruction": "乙", "output": "二" }] })
+    store.close()
+    with open(path, "ab") as writer:
+        writer.write('{"conversation": [{"instruction": "丙'.encode("utf8"))
+
+    store = CheckpointStore(path)
+    assert [data["conversation"][0]["instruction"] for data in store.load()] == ["甲", "乙"]
+    # The partial line is gone, so the next record starts on its own line.
+    store.append({ "conversation": [{ "instruction": "丙", "output": "三" }] })
+    store.close()
+    assert len(CheckpointStore(path).load()) == 3
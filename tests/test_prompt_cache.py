@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context import ContextWindow
+from providers import create_chat_model
+
+
+def claude_requests():
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={
+            "id": "msg_1", "type": "message", "role": "assistant", "model": "claude-3-haiku-20240307",
+            "content": [{ "type": "text", "text": "好的" }], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": { "input_tokens": 10, "output_tokens": 2 },
+        })
+
+    agent = create_chat_model("claude", "claude-3-haiku-20240307", "test-key",
+                              http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+                              http_async_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return agent, requests
+
+
+def test_cache_control_reaches_the_request():
+    agent, requests = claude_requests()
+    dialogue = [
+        { "instruction": "請介紹台灣的夜市文化。" * 200, "output": "台灣的夜市……" * 200 },
+        { "instruction": "有哪些必吃的小吃？" },
+    ]
+    agent.invoke(ContextWindow(cache_prefix=True).to_messages(dialogue, provider="claude"))
+
+    messages = requests[0]["messages"]
+    assert [message["role"] for message in messages] == ["user", "assistant", "user"]
+    assert messages[1]["content"] == [{ "type": "text", "text": dialogue[0]["output"], "cache_control": { "type": "ephemeral" } }]
+    assert "cache_control" not in json.dumps(messages[0]) + json.dumps(messages[2])
+
+
+def test_split_prompt_marks_the_leading_parts():
+    agent, requests = claude_requests()
+    parts = ["以下是範例：\n" * 600, "範例二\n" * 600, "請產生新的指令。"]
+    agent.invoke(ContextWindow(cache_prefix=True).split_prompt(parts, provider="claude"))
+
+    blocks = requests[0]["messages"][0]["content"]
+    assert [block.get("cache_control") for block in blocks] == [None, { "type": "ephemeral" }, None]
+
+
+def test_no_marks_without_prompt_cache():
+    agent, requests = claude_requests()
+    agent.invoke(ContextWindow().split_prompt(["以下是範例：\n" * 600, "請產生新的指令。"], provider="claude"))
+    assert "cache_control" not in json.dumps(requests[0])
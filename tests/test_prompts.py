@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from prompts import (create_first_instruction_prompt_v3, create_multi_turn_prompt_v3, multi_turn_prompt_v3_parts,
+                     render_first_instruction_prompt_v3, render_multi_turn_prompt_v3)
+
+EXAMPLES = [{ "instruction": "請介紹台灣的夜市文化。" }, { "instruction": "如何用Python讀取CSV檔案？" }]
+DIALOGUE = [
+    { "instruction": "請介紹台灣的夜市文化。", "output": "台灣的夜市……" },
+    { "instruction": "有哪些必吃的小吃？", "output": "蚵仔煎、珍珠奶茶……" },
+]
+
+
+def test_rendered_prompts_match_the_templates():
+    assert render_first_instruction_prompt_v3(EXAMPLES) == create_first_instruction_prompt_v3(EXAMPLES).format()
+    assert render_multi_turn_prompt_v3(DIALOGUE) == create_multi_turn_prompt_v3(DIALOGUE).format()
+
+
+def test_braces_in_examples_are_kept():
+    examples = [{ "instruction": "把 {\"name\": \"小明\"} 轉成 YAML。" }]
+    assert "{\"name\": \"小明\"}" in render_first_instruction_prompt_v3(examples)
+
+
+def test_multi_turn_parts_are_a_prefix_of_the_next_turn():
+    parts = multi_turn_prompt_v3_parts(DIALOGUE[:1])
+    next_parts = multi_turn_prompt_v3_parts(DIALOGUE)
+    assert next_parts[:len(parts) - 1] == parts[:-1]
+    assert "".join(next_parts) == render_multi_turn_prompt_v3(DIALOGUE)
+
+
+def test_provider_libraries_are_imported_lazily():
+    code = (
+        "import sys, gen_data, rewrite\n"
+        "print(sorted(m for m in ['langchain_anthropic', 'langchain_openai', 'datasets', 'langchain.prompts'] if m in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
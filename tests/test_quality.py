@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality import QualityGate
+
+
+def test_apologetic_instructions_are_not_refusals():
+    gate = QualityGate()
+    assert gate.check("抱歉打擾了，請問台北有什麼好玩的地方？", "instruction") is None
+    assert gate.check("我不能決定要去哪裡旅行，可以給我一些建議嗎？", "instruction") is None
+
+
+def test_assistant_voice_refusals():
+    gate = QualityGate()
+    assert gate.check("抱歉，我無法協助這個請求。", "instruction") == "refusal"
+    assert gate.check("作為一個AI，我沒有個人的喜好。", "instruction") == "refusal"
+    assert gate.check("抱歉，我不能回答這個問題。", "response") == "refusal"
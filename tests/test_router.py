@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_generator import LLMDataGenerator
+from fake_llm import FakeChatModel
+from rate_limit import RetryPolicy
+from router import AllEndpointsUnavailable, Endpoint, Router
+
+
+def cooling_router(cooldown):
+    endpoints = [
+        Endpoint(f"fake/{i}", "fake", "fake", FakeChatModel(latency=0.0, latency_dist="constant")) for i in range(2)
+    ]
+    now = time.monotonic()
+    endpoints[0].cooldown_until = now + cooldown
+    endpoints[1].cooldown_until = now + 2 * cooldown
+    return Router(endpoints)
+
+
+def test_unavailable_carries_the_earliest_cooldown():
+    router = cooling_router(5.0)
+    with pytest.raises(AllEndpointsUnavailable) as info:
+        router.next_endpoint(set())
+    assert 4.0 < info.value.retry_after <= 5.0
+
+
+def test_unavailable_without_cooldown_when_all_disabled():
+    router = cooling_router(5.0)
+    for endpoint in router.endpoints:
+        endpoint.disabled = True
+    with pytest.raises(AllEndpointsUnavailable) as info:
+        router.next_endpoint(set())
+    assert info.value.retry_after is None
+
+
+def test_client_waits_out_the_cooldown_without_a_retry():
+    agent = LLMDataGenerator("fake", "fake", None, agent=cooling_router(0.3), retry=RetryPolicy(max_retries=0))
+    start = time.monotonic()
+    output = agent.call_llm("response", "請介紹台灣的夜市文化。")
+    assert output.content
+    assert time.monotonic() - start >= 0.25
+
+
+def test_client_waits_out_the_cooldown_async():
+    agent = LLMDataGenerator("fake", "fake", None, agent=cooling_router(0.3), retry=RetryPolicy(max_retries=0))
+    output = asyncio.run(agent.acall_llm("response", "請介紹台灣的夜市文化。"))
+    assert output.content
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from checkpoint import CheckpointStore
+from merge import merge_shards
+from work_queue import WorkQueue
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(tmp_path):
+    path = str(tmp_path / "queue.db")
+    dead = WorkQueue(path, lease_seconds=0.1)
+    alive = WorkQueue(path, lease_seconds=60)
+    dead.populate(range(4))
+
+    assert dead.lease("dead", n=2) == [0, 1]
+    assert alive.lease("alive", n=4) == [2, 3]
+
+    time.sleep(0.2)
+    assert alive.lease("alive", n=4) == [0, 1]
+    # The dead worker's renewal doesn't take the items back.
+    dead.renew("dead", [0, 1])
+    assert alive.lease("alive", n=4) == []
+
+    alive.complete([0, 1, 2, 3])
+    assert alive.counts() == { "done": 4 }
+    dead.close()
+    alive.close()
+
+
+def test_merge_gives_unique_contiguous_ids(tmp_path):
+    first = CheckpointStore(str(tmp_path / "out.a.ckpt.jsonl"))
+    second = CheckpointStore(str(tmp_path / "out.b.ckpt.jsonl"))
+    # Id 1 was reclaimed from the first worker, which had only rewritten it.
+    first.append({ "id": 0, "instructions": ["甲"], "responses": ["一"] })
+    first.append({ "id": 1, "instructions": ["乙"] })
+    second.append({ "id": 2, "instructions": ["丙"], "responses": ["三"] })
+    second.append({ "id": 1, "instructions": ["乙"], "responses": ["二"] })
+    first.close()
+    second.close()
+
+    merged = merge_shards([first.path, second.path], str(tmp_path / "out.json"))
+    assert [data["id"] for data in merged] == [0, 1, 2]
+    assert merged[1]["responses"] == ["二"]
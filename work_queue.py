@@ -0,0 +1,197 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def worker_shard_path(saved_path, worker_id):
+    return os.path.splitext(saved_path)[0] + f".{worker_id}.ckpt.jsonl"
+
+
+class WorkQueue:
+    """
+    SQLite queue of integer work items shared by worker processes, possibly on different hosts sharing
+    a filesystem (which must support POSIX locks, e.g. not every NFS setup does).
+
+    Workers lease items for `lease_seconds` and renew the lease while working on them. An expired lease
+    belongs to a dead worker and is handed out again. An item released `max_attempts` times is given up.
+    """
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "id INTEGER PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, "
+            "lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_until)")
+
+    def _transaction(self, func):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def populate(self, ids):
+        """
+        Add the items that aren't queued yet. Every worker may call this with the same ids.
+        """
+        self._transaction(lambda: self.conn.executemany(
+            "INSERT OR IGNORE INTO items (id) VALUES (?)", ((idx,) for idx in ids)
+        ))
+
+    def lease(self, worker_id, n=1):
+        def lease():
+            now = time.time()
+            ids = [row[0] for row in self.conn.execute(
+                "SELECT id FROM items WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY id LIMIT ?", (now, n)
+            )]
+            self.conn.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, lease_until = ? WHERE id = ?",
+                ((worker_id, now + self.lease_seconds, idx) for idx in ids)
+            )
+            return ids
+        return self._transaction(lease)
+
+    def renew(self, worker_id, ids):
+        lease_until = time.time() + self.lease_seconds
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE items SET lease_until = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+            ((lease_until, idx, worker_id) for idx in ids)
+        ))
+
+    def complete(self, ids):
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE items SET state = 'done', worker = NULL WHERE id = ?", ((idx,) for idx in ids)
+        ))
+
+    def release(self, ids):
+        """
+        Hand failed items back to the queue, or give them up after `max_attempts`.
+        """
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE items SET attempts = attempts + 1, worker = NULL, lease_until = 0, "
+            "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE id = ? AND state = 'leased'",
+            ((self.max_attempts, idx) for idx in ids)
+        ))
+
+    def counts(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+    def unfinished(self):
+        counts = self.counts()
+        return counts.get("pending", 0) + counts.get("leased", 0)
+
+    def close(self):
+        self.conn.close()
+
+
+class LeaseKeeper:
+    """
+    Renews the leases of `ids` from a background thread until the block exits.
+    """
+    def __init__(self, queue, worker_id, ids):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.ids = ids
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            self.queue.renew(self.worker_id, self.ids)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+
+
+def _settle(queue, ids, finished):
+    finished = set(finished)
+    queue.complete([idx for idx in ids if idx in finished])
+    queue.release([idx for idx in ids if not idx in finished])
+
+
+def run_worker(queue, worker_id, process, lease_size=32, poll_interval=30):
+    """
+    Lease items until the queue is drained. `process(ids)` returns the ids it finished, the others are
+    released for another attempt. While other workers still hold leases, wait for them to finish or expire.
+    """
+    while True:
+        ids = queue.lease(worker_id, lease_size)
+        if not len(ids):
+            if not queue.unfinished():
+                break
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            with LeaseKeeper(queue, worker_id, ids):
+                finished = process(ids)
+        except BaseException:
+            queue.release(ids)
+            raise
+        _settle(queue, ids, finished)
+
+    print(f"Work queue: {queue.counts()}")
+
+
+async def arun_worker(queue, worker_id, aprocess, lease_size=32, poll_interval=30):
+    """
+    `run_worker` for a coroutine `aprocess(ids)`, keeping every batch on the same event loop.
+    """
+    while True:
+        ids = queue.lease(worker_id, lease_size)
+        if not len(ids):
+            if not queue.unfinished():
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+
+        try:
+            with LeaseKeeper(queue, worker_id, ids):
+                finished = await aprocess(ids)
+        except BaseException:
+            queue.release(ids)
+            raise
+        _settle(queue, ids, finished)
+
+    print(f"Work queue: {queue.counts()}")
+
+
+def add_worker_args(parser):
+    parser.add_argument("--queue_path", type=str, default=None,
+                        help="SQLite work queue shared by worker processes. Each worker writes its own shard next to `saved_path`")
+    parser.add_argument("--worker_id", type=str, default=None,
+                        help="Name of this worker, defaults to hostname-pid")
+    parser.add_argument("--lease_size", type=int, default=32,
+                        help="Number of work items leased at a time")
+    parser.add_argument("--lease_seconds", type=float, default=600,
+                        help="Leases not renewed within this time are reclaimed from dead workers")
+    parser.add_argument("--queue_poll_interval", type=float, default=30)
+
+
+def work_queue_from_args(args):
+    return WorkQueue(args.queue_path, lease_seconds=args.lease_seconds)